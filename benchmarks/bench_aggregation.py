@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: © 2022 Dirk Sammel <dirk.sammel@gmail.com>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+
+import argparse
+import logging
+from time import perf_counter
+from auditor_apel_plugin.core import group_summary, create_summary
+from bench_extractor import create_config, create_records
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n", "--records", type=int, default=100000, help="Number of records"
+    )
+    parser.add_argument(
+        "-b",
+        "--backends",
+        nargs="+",
+        default=["sqlite", "dict", "numpy"],
+        help="Aggregation backends to compare",
+    )
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    config = create_config()
+    records = create_records(args.records)
+    summaries = {}
+
+    print(f"records: {args.records}")
+
+    for backend in args.backends:
+        config["aggregation"] = {"backend": backend}
+
+        start = perf_counter()
+        grouped_summary_list = group_summary(config, records)
+        duration = perf_counter() - start
+
+        summaries[backend] = create_summary(grouped_summary_list)
+        print(
+            f"{backend:>7}: {duration:8.3f} s "
+            f"({len(grouped_summary_list)} groups)"
+        )
+
+    assert len(set(summaries.values())) == 1
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: © 2022 Dirk Sammel <dirk.sammel@gmail.com>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+
+import argparse
+import gc
+import logging
+import os
+from auditor_apel_plugin.core import compact_records
+from bench_extractor import create_config, create_records
+
+
+def get_rss():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n", "--records", type=int, default=200000, help="Number of records"
+    )
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    config = create_config()
+
+    gc.collect()
+    rss_start = get_rss()
+    records = create_records(args.records)
+    gc.collect()
+    rss_records = get_rss()
+
+    # Freed memory is not handed back to the OS, so the compact records are
+    # measured while the pyauditor records are still alive
+    compacted = compact_records(config, records)
+    gc.collect()
+    rss_compacted = get_rss()
+    del records
+
+    pyauditor_size = rss_records - rss_start
+    compact_size = rss_compacted - rss_records
+
+    print(f"records:   {len(compacted)}")
+    print(f"pyauditor: {pyauditor_size / len(compacted):8.0f} B/record")
+    print(f"compact:   {compact_size / len(compacted):8.0f} B/record")
+    print(f"reduction: {pyauditor_size / compact_size:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: © 2022 Dirk Sammel <dirk.sammel@gmail.com>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+
+import argparse
+import configparser
+import json
+import logging
+from datetime import datetime, timedelta
+from timeit import timeit
+import pytz
+import pyauditor
+from auditor_apel_plugin.core import (
+    RecordExtractor,
+    get_site_id,
+    get_submit_host,
+    get_voms_info,
+    replace_record_string,
+)
+
+
+def create_config():
+    config = configparser.ConfigParser()
+    config["site"] = {
+        "site_name_mapping": '{"site-1": "SITE_1", "site-2": "SITE_2"}',
+        "sites_to_report": '["site-1", "site-2"]',
+        "default_submit_host": "https://default.submit_host.de:1234/xxx",
+        "infrastructure_type": "grid",
+        "benchmark_type": "hepscore23",
+    }
+    config["auditor"] = {
+        "benchmark_name": "hepscore23",
+        "cores_name": "Cores",
+        "cpu_time_name": "TotalCPU",
+        "nnodes_name": "NNodes",
+        "meta_key_site": "site_id",
+        "meta_key_submithost": "headnode",
+        "meta_key_voms": "voms",
+        "meta_key_username": "subject",
+    }
+
+    return config
+
+
+def create_records(n_records):
+    records = []
+    start_time = datetime(2023, 1, 1, 0, 0, 0)
+
+    for idx in range(n_records):
+        rec = pyauditor.Record(f"record-{idx}", start_time)
+        rec.with_stop_time(start_time + timedelta(seconds=3600 + idx))
+        rec.with_component(
+            pyauditor.Component("Cores", 1 + idx % 8).with_score(
+                pyauditor.Score("hepscore23", 10.0)
+            )
+        )
+        rec.with_component(pyauditor.Component("TotalCPU", 3000 + idx))
+        rec.with_component(pyauditor.Component("NNodes", 1))
+        meta = pyauditor.Meta()
+        meta.insert("site_id", [f"site-{1 + idx % 2}"])
+        meta.insert("headnode", ["https:%2F%2Fce.site.de:1234%2Fxxx"])
+        meta.insert("voms", [f"%2Fatlas%2Fgroup{idx % 5}%2FRole=production"])
+        meta.insert("subject", [f"%2FDC=ch%2FDC=cern%2FCN=user{idx % 40}"])
+        rec.with_meta(meta)
+        records.append(rec)
+
+    return records
+
+
+# Per-record conversion as done by create_summary_db before the extractor
+def legacy_summary_rows(config, records):
+    site_name_mapping = json.loads(config["site"].get("site_name_mapping"))
+    sites_to_report = json.loads(config["site"].get("sites_to_report"))
+    infrastructure = config["site"].get("infrastructure_type")
+    benchmark_type = config["site"].get("benchmark_type")
+    benchmark_name = config["auditor"].get("benchmark_name")
+    cores_name = config["auditor"].get("cores_name")
+    cpu_time_name = config["auditor"].get("cpu_time_name")
+    nnodes_name = config["auditor"].get("nnodes_name")
+    meta_key_username = config["auditor"].get("meta_key_username")
+
+    for r in records:
+        site_id = get_site_id(r, config)
+        if site_id not in sites_to_report:
+            continue
+        site_name = site_name_mapping[site_id]
+        submit_host = get_submit_host(r, config)
+        voms_dict = get_voms_info(r, config)
+        user_name = replace_record_string(r.meta.get(meta_key_username)[0])
+        year = r.stop_time.replace(tzinfo=pytz.utc).year
+        month = r.stop_time.replace(tzinfo=pytz.utc).month
+
+        component_dict = {}
+        score_dict = {}
+        for c in r.components:
+            component_dict[c.name] = c
+        cputime = component_dict[cpu_time_name].amount
+        nodecount = component_dict[nnodes_name].amount
+        cpucount = component_dict[cores_name].amount
+        for s in component_dict[cores_name].scores:
+            score_dict[s.name] = s.value
+        benchmark_value = score_dict[benchmark_name]
+
+        yield (
+            site_name,
+            submit_host,
+            voms_dict["vo"],
+            voms_dict["vogroup"],
+            voms_dict["vorole"],
+            infrastructure,
+            year,
+            month,
+            cpucount,
+            nodecount,
+            r.record_id,
+            r.runtime,
+            r.runtime * benchmark_value,
+            cputime,
+            cputime * benchmark_value,
+            r.start_time.replace(tzinfo=pytz.utc).timestamp(),
+            r.stop_time.replace(tzinfo=pytz.utc).timestamp(),
+            user_name,
+            benchmark_type,
+            benchmark_value,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n", "--records", type=int, default=100000, help="Number of records"
+    )
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=3, help="Number of repetitions"
+    )
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    config = create_config()
+    records = create_records(args.records)
+
+    assert list(legacy_summary_rows(config, records)) == list(
+        RecordExtractor(config).summary_rows(records)
+    )
+
+    legacy = timeit(
+        lambda: list(legacy_summary_rows(config, records)), number=args.repeat
+    )
+    extractor = timeit(
+        lambda: list(RecordExtractor(config).summary_rows(records)),
+        number=args.repeat,
+    )
+
+    n_calls = args.records * args.repeat
+    print(f"records:   {args.records}")
+    print(f"legacy:    {legacy / n_calls * 1e6:8.2f} us/record")
+    print(f"extractor: {extractor / n_calls * 1e6:8.2f} us/record")
+    print(f"speedup:   {legacy / extractor:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
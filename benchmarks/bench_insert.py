@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: © 2022 Dirk Sammel <dirk.sammel@gmail.com>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+
+import argparse
+import sqlite3
+from time import perf_counter
+from auditor_apel_plugin.core import init_summary_db, insert_summary_rows
+
+
+def create_rows(n_rows):
+    for idx in range(n_rows):
+        yield (
+            f"SITE_{idx % 2}",
+            "https://ce.site.de:1234/xxx",
+            "atlas",
+            f"/atlas/group{idx % 5}",
+            "Role=production",
+            "grid",
+            2023,
+            1,
+            1 + idx % 8,
+            1,
+            f"record-{idx}",
+            3600 + idx,
+            (3600 + idx) * 10.0,
+            3000 + idx,
+            (3000 + idx) * 10.0,
+            1672531200.0,
+            1672534800.0 + idx,
+            f"/DC=ch/DC=cern/CN=user{idx % 40}",
+            "hepscore23",
+            10.0,
+        )
+
+
+# Row by row insertion as done by create_summary_db before executemany
+def legacy_insert(rows):
+    schema_db = init_summary_db()
+    create_table_sql = schema_db.execute(
+        "SELECT sql FROM sqlite_master WHERE name = 'records'"
+    ).fetchone()[0]
+    schema_db.close()
+
+    conn = sqlite3.connect(":memory:")
+    cur = conn.cursor()
+    cur.execute(create_table_sql)
+    insert_sql = f"INSERT INTO records VALUES({', '.join('?' * 20)})"
+    for data_tuple in rows:
+        cur.execute(insert_sql, data_tuple)
+    conn.commit()
+    cur.close()
+
+    return conn
+
+
+def chunked_insert(rows, chunk_size):
+    conn = init_summary_db()
+    insert_summary_rows(conn, rows, chunk_size)
+
+    return conn
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n",
+        "--records",
+        type=int,
+        nargs="+",
+        default=[100000, 1000000],
+        help="Numbers of rows to insert",
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=10000, help="executemany chunk size"
+    )
+    args = parser.parse_args()
+
+    for n_rows in args.records:
+        rows = list(create_rows(n_rows))
+
+        start = perf_counter()
+        legacy_insert(rows).close()
+        legacy = perf_counter() - start
+
+        start = perf_counter()
+        chunked_insert(rows, args.chunk_size).close()
+        chunked = perf_counter() - start
+
+        print(f"rows:    {n_rows}")
+        print(f"legacy:  {legacy:8.3f} s")
+        print(f"chunked: {chunked:8.3f} s")
+        print(f"speedup: {legacy / chunked:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: © 2022 Dirk Sammel <dirk.sammel@gmail.com>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+
+import argparse
+from time import perf_counter
+from auditor_apel_plugin.core import create_summary, create_sync
+
+
+def create_groups(n_groups):
+    return [
+        {
+            "site": f"site-{idx % 2}",
+            "month": 1 + idx % 12,
+            "year": 2023,
+            "user": f"/DC=ch/DC=cern/CN=user{idx}" if idx % 4 else None,
+            "vo": "atlas",
+            "vogroup": f"/atlas/group{idx % 5}",
+            "vorole": "Role=production",
+            "submithost": "https://ce.site.de:1234/xxx",
+            "infrastructure": "grid",
+            "cpucount": 1 + idx % 8,
+            "nodecount": 1,
+            "min_stoptime": 1672531200 + idx,
+            "max_stoptime": 1672534800 + idx,
+            "runtime": 3600.0 * idx,
+            "cputime": 3000.0 * idx,
+            "norm_runtime": 36000.0 * idx,
+            "norm_cputime": 30000.0 * idx,
+            "benchmarktype": "hepscore23",
+            "benchmarkvalue": 10.0,
+            "jobcount": idx,
+        }
+        for idx in range(n_groups)
+    ]
+
+
+# Message construction as done by create_summary before the writer
+def legacy_summary(grouped_summary_list):
+    summary = "APEL-summary-job-message: v0.3\n"
+
+    for entry in grouped_summary_list:
+        summary += f"Site: {entry['site']}\n"
+        summary += f"Month: {entry['month']}\n"
+        summary += f"Year: {entry['year']}\n"
+        if entry["user"] is not None:
+            summary += f"GlobalUserName: {entry['user']}\n"
+        if entry["vo"] is not None:
+            summary += f"VO: {entry['vo']}\n"
+        if entry["vogroup"] is not None:
+            summary += f"VOGroup: {entry['vogroup']}\n"
+        if entry["vorole"] is not None:
+            summary += f"VORole: {entry['vorole']}\n"
+        summary += f"SubmitHost: {entry['submithost']}\n"
+        summary += f"Infrastructure: {entry['infrastructure']}\n"
+        summary += f"Processors: {entry['cpucount']}\n"
+        summary += f"NodeCount: {entry['nodecount']}\n"
+        summary += f"EarliestEndTime: {entry['min_stoptime']}\n"
+        summary += f"LatestEndTime: {entry['max_stoptime']}\n"
+        summary += f"WallDuration : {int(entry['runtime'])}\n"
+        summary += f"CpuDuration: {int(entry['cputime'])}\n"
+        summary += f"NormalisedWallDuration: {int(entry['norm_runtime'])}\n"
+        summary += f"NormalisedCpuDuration: {int(entry['norm_cputime'])}\n"
+        summary += f"ServiceLevelType: {entry['benchmarktype']}\n"
+        summary += f"ServiceLevel: {entry['benchmarkvalue']}\n"
+        summary += f"NumberOfJobs: {entry['jobcount']}\n"
+        summary += "%%\n"
+
+    return summary
+
+
+def legacy_sync(sync_db):
+    sync = "APEL-sync-message: v0.1\n"
+
+    for entry in sync_db:
+        sync += f"Site: {entry['site']}\n"
+        sync += f"Month: {entry['month']}\n"
+        sync += f"Year: {entry['year']}\n"
+        sync += f"SubmitHost: {entry['submithost']}\n"
+        sync += f"NumberOfJobs: {entry['jobcount']}\n"
+        sync += "%%\n"
+
+    return sync
+
+
+def timed(func, groups, repeat=3):
+    durations = []
+    for _ in range(repeat):
+        start = perf_counter()
+        result = func(groups)
+        durations.append(perf_counter() - start)
+
+    return result, min(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n", "--groups", type=int, default=100000, help="Number of groups"
+    )
+    args = parser.parse_args()
+
+    groups = create_groups(args.groups)
+    print(f"groups: {args.groups}")
+
+    for name, legacy, writer in [
+        ("summary", legacy_summary, create_summary),
+        ("sync", legacy_sync, create_sync),
+    ]:
+        legacy_msg, legacy_time = timed(legacy, groups)
+        msg, writer_time = timed(writer, groups)
+        assert msg == legacy_msg
+        print(
+            f"{name:>7}: legacy {legacy_time:.3f} s, "
+            f"writer {writer_time:.3f} s ({len(msg) / 1e6:.1f} MB)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: © 2022 Dirk Sammel <dirk.sammel@gmail.com>
+# SPDX-License-Identifier: BSD-2-Clause-Patent
+
+import logging
+import sys
+from pyauditor import AuditorClientBuilder
+import configparser
+import argparse
+from datetime import datetime
+import pytz
+from auditor_apel_plugin.core import (
+    TokenManager,
+    create_session,
+    get_time_db,
+    get_start_time,
+    update_time_db,
+    get_seen_index,
+    group_summary,
+    create_summary_chunks,
+    create_publisher,
+    create_outbox,
+    get_message_limits,
+    MessageSigner,
+    RecordStream,
+    extract_records,
+    partition_rows,
+    get_backfill_end_time,
+    get_backfilled_partitions,
+    mark_partition_backfilled,
+    clear_backfill,
+    AuditorTimeoutError,
+)
+from auditor_apel_plugin.publish import send_messages, run as run_publish
+
+
+# The publish loop continues from the latest backfilled stop time. The
+# records published by the backfill must not be summarised again by its
+# first cycle.
+def hand_over(config, conn, rows, end_time):
+    end_stamp = end_time.timestamp()
+    start_stamp = get_start_time(conn).timestamp()
+    latest_stop_time = max(
+        (r.stoptime for r in rows if r.stoptime <= end_stamp),
+        default=start_stamp,
+    )
+    latest_stop_time = max(latest_stop_time, start_stamp)
+
+    seen = get_seen_index(config, conn)
+    seen.load(datetime.fromtimestamp(latest_stop_time, tz=pytz.utc))
+    since_stamp = latest_stop_time - seen.retention
+
+    for r in rows:
+        if since_stamp < r.stoptime <= end_stamp:
+            seen.mark(r.recordid, r.stoptime)
+
+    seen.save(latest_stop_time)
+    update_time_db(conn, latest_stop_time, datetime.now())
+
+
+# The hand-over only needs the rows within the seen retention before the
+# latest stop time, so the rows of every partition can be released once it
+# was sent
+def get_hand_over_rows(partitions, retention):
+    latest_stop_time = max(
+        (max(r.stoptime for r in rows) for rows in partitions.values()),
+        default=None,
+    )
+    if latest_stop_time is None:
+        return []
+
+    since_stamp = latest_stop_time - retention
+
+    return [
+        r
+        for rows in partitions.values()
+        for r in rows
+        if r.stoptime > since_stamp
+    ]
+
+
+def run(config, args, client):
+    time_db_path = config["paths"].get("time_db_path")
+    publish_since = config["site"].get("publish_since")
+    client_cert = config["authentication"].get("client_cert")
+    client_key = config["authentication"].get("client_key")
+    page_size = config.getint("auditor", "page_size", fallback=10000)
+    signer = MessageSigner(client_cert, client_key)
+    session = create_session(config)
+    max_message_size, _ = get_message_limits(config)
+
+    if config.get("paths", "aggregate_db_path", fallback=None) is not None:
+        logging.critical(
+            "Backfill is not available with aggregate_db_path, the aggregate "
+            "store catches up in slices on its own"
+        )
+        raise ValueError("aggregate_db_path")
+
+    conn = get_time_db(publish_since, time_db_path)
+    end_time = get_backfill_end_time(conn, datetime.now(tz=pytz.utc))
+    begin = datetime.strptime(publish_since, "%Y-%m-%d %H:%M:%S%z")
+    sites = set(args.site) if args.site else None
+
+    # Extracting the pyauditor Records is most of the work and they cannot
+    # be pickled for other processes. The pages of Records are released
+    # while they are extracted, the rows are aggregated one partition after
+    # the other.
+    logging.info(f"Backfilling records from {begin} to {end_time}")
+    records = RecordStream(client, begin, 30, page_size)
+    partitions = partition_rows(
+        extract_records(config, records), end_time, sites
+    )
+
+    done = get_backfilled_partitions(conn)
+    todo = sorted(p for p in partitions if p not in done)
+    logging.info(
+        f"{len(todo)} of {len(partitions)} partition(s) left to backfill"
+    )
+
+    # Only a backfill of all sites covers everything up to the end time
+    hand_over_rows = []
+    if sites is None:
+        retention = get_seen_index(config, conn).retention
+        hand_over_rows = get_hand_over_rows(partitions, retention)
+    partitions = {p: partitions[p] for p in todo}
+
+    tokens = TokenManager(config, session)
+    publisher = create_publisher(config, signer, tokens)
+    outbox = create_outbox(config)
+    failed = []
+
+    for partition in todo:
+        grouped_summary_list = group_summary(config, partitions.pop(partition))
+        if send_messages(
+            publisher,
+            outbox,
+            create_summary_chunks(grouped_summary_list, max_message_size),
+        ):
+            mark_partition_backfilled(conn, partition)
+            logging.info(f"Backfilled {partition}")
+        else:
+            failed.append(partition)
+
+    publisher.close()
+    session.close()
+
+    if failed:
+        logging.error(
+            f"Backfill of {failed} failed, run it again to resume the "
+            "remaining partitions"
+        )
+        conn.close()
+        return False
+
+    if sites is None:
+        hand_over(config, conn, hand_over_rows, end_time)
+    clear_backfill(conn)
+    conn.close()
+    logging.info("Backfill finished")
+
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c", "--config", required=True, help="Path to the config file"
+    )
+    parser.add_argument(
+        "-s",
+        "--site",
+        action="append",
+        help="Only backfill this site (GOCDB), can be repeated",
+    )
+    parser.add_argument(
+        "--no-publish",
+        action="store_true",
+        help="Stop after the backfill instead of starting the publish loop",
+    )
+    args = parser.parse_args()
+
+    if args.site and not args.no_publish:
+        parser.error(
+            "--site requires --no-publish, the publish loop can only "
+            "continue after a backfill of all sites"
+        )
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+
+    log_level = config["logging"].get("log_level")
+    log_format = "[%(asctime)s] %(levelname)-8s %(message)s"
+    logging.basicConfig(
+        encoding="utf-8",
+        level=log_level,
+        format=log_format,
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    logging.getLogger("aiosqlite").setLevel("WARNING")
+    logging.getLogger("urllib3").setLevel("WARNING")
+
+    auditor_ip = config["auditor"].get("auditor_ip")
+    auditor_port = config["auditor"].getint("auditor_port")
+    auditor_timeout = config["auditor"].getint("auditor_timeout")
+
+    builder = AuditorClientBuilder()
+    builder = builder.address(auditor_ip, auditor_port).timeout(
+        auditor_timeout
+    )
+    client = builder.build_blocking()
+
+    try:
+        if run(config, args, client) and not args.no_publish:
+            logging.info("Handing over to the publish loop")
+            run_publish(config, client)
+    except KeyboardInterrupt:
+        logging.critical("User abort")
+    except AuditorTimeoutError as e:
+        logging.critical(e)
+        sys.exit(1)
+    finally:
+        logging.info("Backfill stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@
 # SPDX-License-Identifier: BSD-2-Clause-Patent
 
 import logging
+import os
 from pathlib import Path
 import sqlite3
 from sqlite3 import Error
@@ -11,12 +12,39 @@ from datetime import datetime, timedelta, time
 from time import sleep
 import pytz
 import json
+import hashlib
+import base64
+import gzip
+import fcntl
 import sys
+import asyncio
+import io
+from itertools import islice, count
+from operator import itemgetter
+from functools import lru_cache
+from array import array
+from collections import namedtuple, deque, defaultdict
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import threading
 import requests
 from cryptography import x509
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.serialization import pkcs7
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+EPOCH = datetime(1970, 1, 1)
+MESSAGE_COUNTER = count()
+
+
+# Only the command line entry points quit on it
+class AuditorTimeoutError(RuntimeError):
+    pass
+
 
 def get_records(client, start_time, delay_time):
     timeout_counter = 0
@@ -37,11 +65,156 @@ def get_records(client, start_time, delay_time):
                 logging.critical(e)
                 raise
 
-    logging.critical(
-        "Call to AUDITOR timed out 3/3, quitting! "
+    raise AuditorTimeoutError(
+        "Call to AUDITOR timed out 3/3! "
+        "Maybe increase auditor_timeout in the config"
+    )
+
+
+class RecordStream:
+    # python-auditor only offers get_stopped_since, so the pages are cut on
+    # the client side. Every page is released as soon as it was consumed,
+    # which keeps the pyauditor objects from piling up behind the consumer.
+    def __init__(
+        self,
+        client,
+        start_time,
+        delay_time,
+        page_size,
+        records=None,
+        end_time=None,
+    ):
+        self.client = client
+        self.start_time = start_time
+        self.delay_time = delay_time
+        self.page_size = page_size
+        self.records = records
+        self.end_time = end_time
+        self.latest_stop_time = None
+        self.record_count = 0
+
+    # Records that were already fetched are used only once
+    def fetch(self):
+        if self.records is not None:
+            records = self.records
+            self.records = None
+            return records
+
+        if self.end_time is not None:
+            return get_records_between(
+                self.client, self.start_time, self.end_time, self.delay_time
+            )
+
+        return get_records(self.client, self.start_time, self.delay_time)
+
+    def pages(self):
+        records = self.fetch()
+        records.reverse()
+
+        while records:
+            page_length = min(self.page_size, len(records))
+            page = [records.pop() for _ in range(page_length)]
+
+            page_stop_time = max(r.stop_time for r in page)
+            if (
+                self.latest_stop_time is None
+                or page_stop_time > self.latest_stop_time
+            ):
+                self.latest_stop_time = page_stop_time
+            self.record_count += page_length
+
+            yield page
+
+    def __iter__(self):
+        for page in self.pages():
+            yield from page
+
+
+async def get_records_async(client, start_time, delay_time):
+    timeout_counter = 0
+
+    while timeout_counter < 2:
+        try:
+            records = await client.get_stopped_since(start_time)
+            return records
+        except RuntimeError as e:
+            if "timed" in str(e):
+                timeout_counter += 1
+                logging.warning(
+                    f"Call to AUDITOR timed out {timeout_counter}/3! "
+                    f"Trying again in {timeout_counter * delay_time}s"
+                )
+                await asyncio.sleep(timeout_counter * delay_time)
+            else:
+                logging.critical(e)
+                raise
+
+    raise AuditorTimeoutError(
+        "Call to AUDITOR timed out 3/3! "
         "Maybe increase auditor_timeout in the config"
     )
-    sys.exit(1)
+
+
+# The records are fetched with the async client before the stream is handed
+# to the (synchronous) aggregation
+class AsyncRecordStream(RecordStream):
+    async def prefetch(self):
+        self.records = await get_records_async(
+            self.client, self.start_time, self.delay_time
+        )
+        if self.end_time is not None:
+            self.records = filter_records_until(self.records, self.end_time)
+
+        return self
+
+    def fetch(self):
+        if self.records is None:
+            raise RuntimeError("Records have not been prefetched")
+
+        return super().fetch()
+
+
+# Record times are naive UTC
+def to_record_time(time):
+    if time.tzinfo is not None:
+        return time.astimezone(pytz.utc).replace(tzinfo=None)
+
+    return time
+
+
+def filter_new_records(records, start_time):
+    start_time = to_record_time(start_time)
+
+    return [r for r in records if r.stop_time > start_time]
+
+
+def filter_records_until(records, end_time):
+    end_time = to_record_time(end_time)
+
+    return [r for r in records if r.stop_time < end_time]
+
+
+# python-auditor can not bound the query at the end, so records stopped at or
+# after end_time are dropped right after the fetch, before any of them is
+# converted
+def get_records_between(client, start_time, end_time, delay_time):
+    return filter_records_until(
+        get_records(client, start_time, delay_time), end_time
+    )
+
+
+# Narrow query for records stopped after the last report. An empty result
+# lets the caller skip the cycle before any wide fetch.
+def get_new_records(client, start_time, delay_time):
+    return filter_new_records(
+        get_records(client, start_time, delay_time), start_time
+    )
+
+
+async def get_new_records_async(client, start_time, delay_time):
+    return filter_new_records(
+        await get_records_async(client, start_time, delay_time), start_time
+    )
 
 
 def get_begin_previous_month(current_time):
@@ -153,6 +326,251 @@ def update_time_db(conn, stop_time, report_time):
         raise
 
 
+def hash_record_id(record_id):
+    digest = hashlib.blake2b(record_id.encode("utf-8"), digest_size=8)
+
+    return int.from_bytes(digest.digest(), "big", signed=True)
+
+
+# Record ids of published summary records, stored as 64 bit hashes next to
+# the time DB. Each cycle looks back retention seconds before the last end
+# time and skips records that were already published, which resolves ties
+# at the boundary stop time and catches late records.
+class SeenIndex:
+    def __init__(self, conn, retention):
+        self.conn = conn
+        self.retention = retention
+        self.hashes = set()
+        self.pending_hashes = array("q")
+        self.pending_stop_times = array("d")
+
+        try:
+            cur = self.conn.cursor()
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS seen_records(
+                    hash INTEGER PRIMARY KEY,
+                    stop_time REAL NOT NULL
+                )
+                """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS seen_records_stop_time
+                ON seen_records(stop_time)
+                """)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS seen_state(
+                    seen_since REAL NOT NULL
+                )
+                """)
+            self.conn.commit()
+            cur.close()
+        except Error as e:
+            logging.critical(e)
+            raise
+
+    # The index knows nothing about records before the start time it was
+    # first loaded with. Looking back further would publish them again on
+    # existing installations and new aggregate stores.
+    def load(self, start_time):
+        try:
+            cur = self.conn.cursor()
+            cur.execute("SELECT seen_since FROM seen_state")
+            row = cur.fetchone()
+            if row is None:
+                cur.execute(
+                    "INSERT INTO seen_state(seen_since) VALUES(?)",
+                    (start_time.timestamp(),),
+                )
+                self.conn.commit()
+                seen_since = start_time
+            else:
+                seen_since = datetime.fromtimestamp(row[0], tz=pytz.utc)
+
+            since = max(
+                start_time - timedelta(seconds=self.retention), seen_since
+            )
+            cur.execute(
+                "SELECT hash FROM seen_records WHERE stop_time >= ?",
+                (since.timestamp(),),
+            )
+            self.hashes = {row[0] for row in cur}
+            cur.close()
+        except Error as e:
+            logging.critical(e)
+            raise
+
+        self.pending_hashes = array("q")
+        self.pending_stop_times = array("d")
+
+        return since
+
+    def __contains__(self, record_id):
+        return hash_record_id(record_id) in self.hashes
+
+    # Returns False for records that were seen before, otherwise the record
+    # is marked as pending
+    def mark(self, record_id, stop_time):
+        record_hash = hash_record_id(record_id)
+        if record_hash in self.hashes:
+            return False
+
+        self.hashes.add(record_hash)
+        self.pending_hashes.append(record_hash)
+        self.pending_stop_times.append(stop_time)
+
+        return True
+
+    def has_pending(self):
+        return len(self.pending_hashes) > 0
+
+    def has_unseen(self, records):
+        for r in records:
+            record_id = r.recordid if type(r) is ApelRecord else r.record_id
+            if record_id not in self:
+                return True
+
+        return False
+
+    def filter(self, records):
+        for r in records:
+            if type(r) is ApelRecord:
+                record_id, stop_time = r.recordid, r.stoptime
+            else:
+                record_id = r.record_id
+                stop_time = (
+                    r.stop_time.replace(tzinfo=None) - EPOCH
+                ).total_seconds()
+            if self.mark(record_id, stop_time):
+                yield r
+
+    # Persist the pending records once their messages were delivered and
+    # drop everything that fell out of the retention window. Without commit
+    # the caller commits them together with its own changes.
+    def save(self, end_time, commit=True):
+        try:
+            cur = self.conn.cursor()
+            cur.executemany(
+                """
+                INSERT OR IGNORE INTO seen_records(hash, stop_time)
+                VALUES(?, ?)
+                """,
+                zip(self.pending_hashes, self.pending_stop_times),
+            )
+            cur.execute(
+                "DELETE FROM seen_records WHERE stop_time < ?",
+                (end_time - self.retention,),
+            )
+            if commit:
+                self.conn.commit()
+            cur.close()
+        except Error as e:
+            logging.critical(e)
+            raise
+
+        self.pending_hashes = array("q")
+        self.pending_stop_times = array("d")
+
+    def discard(self):
+        self.hashes.difference_update(self.pending_hashes)
+        self.pending_hashes = array("q")
+        self.pending_stop_times = array("d")
+
+
+def get_seen_index(config, conn):
+    retention = config.getint("intervals", "seen_retention", fallback=3600)
+
+    return SeenIndex(conn, retention)
+
+
+# Progress of a backfill lives in the time DB. The end time is fixed by the
+# first run, so a resumed backfill covers the same records.
+def init_backfill_tables(conn):
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS backfill(
+                end_time REAL NOT NULL
+            )
+            """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS backfill_partitions(
+                site TEXT NOT NULL,
+                year INTEGER NOT NULL,
+                month INTEGER NOT NULL,
+                PRIMARY KEY(site, year, month)
+            )
+            """)
+        conn.commit()
+        cur.close()
+    except Error as e:
+        logging.critical(e)
+        raise
+
+
+def get_backfill_end_time(conn, end_time):
+    init_backfill_tables(conn)
+
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT end_time FROM backfill")
+        row = cur.fetchone()
+        if row is None:
+            cur.execute(
+                "INSERT INTO backfill(end_time) VALUES(?)",
+                (end_time.timestamp(),),
+            )
+            conn.commit()
+        else:
+            end_time = datetime.fromtimestamp(row[0], tz=pytz.utc)
+        cur.close()
+    except Error as e:
+        logging.critical(e)
+        raise
+
+    return end_time
+
+
+def get_backfilled_partitions(conn):
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT site, year, month FROM backfill_partitions")
+        partitions = set(cur.fetchall())
+        cur.close()
+    except Error as e:
+        logging.critical(e)
+        raise
+
+    return partitions
+
+
+def mark_partition_backfilled(conn, partition):
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT OR IGNORE INTO backfill_partitions(site, year, month)
+            VALUES(?, ?, ?)
+            """,
+            partition,
+        )
+        conn.commit()
+        cur.close()
+    except Error as e:
+        logging.critical(e)
+        raise
+
+
+def clear_backfill(conn):
+    try:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM backfill")
+        cur.execute("DELETE FROM backfill_partitions")
+        conn.commit()
+        cur.close()
+    except Error as e:
+        logging.critical(e)
+        raise
+
+
 def replace_record_string(string):
     updated_string = string.replace("%2F", "/")
 
@@ -191,32 +609,36 @@ def get_submit_host(record, config):
     return submit_host
 
 
+def parse_voms(voms_meta):
+    voms_string = replace_record_string(voms_meta)
+    voms_list = voms_string.split("/")
+    vo = voms_list[1]
+
+    if "Role" not in voms_string:
+        vorole = None
+
+        if len(voms_list) == 2:
+            vogroup = "/" + voms_list[1]
+        else:
+            vogroup = "/" + voms_list[1] + "/" + voms_list[2]
+    elif len(voms_list) == 3:
+        vogroup = "/" + voms_list[1]
+        vorole = voms_list[2]
+    else:
+        vogroup = "/" + voms_list[1] + "/" + voms_list[2]
+        vorole = voms_list[3]
+
+    return voms_string, vo, vogroup, vorole
+
+
 def get_voms_info(record, config):
     meta_key_voms = config["auditor"].get("meta_key_voms")
     voms_dict = {}
 
     try:
-        voms_string = replace_record_string(record.meta.get(meta_key_voms)[0])
-        voms_list = voms_string.split("/")
-        voms_dict["vo"] = voms_list[1]
-
-        if "Role" not in voms_string:
-            logging.warning(
-                f"No Role found in VOMS of {record.record_id}: {voms_string}, "
-                "not sending VORole"
-            )
-            voms_dict["vorole"] = None
-
-            if len(voms_list) == 2:
-                voms_dict["vogroup"] = "/" + voms_list[1]
-            else:
-                voms_dict["vogroup"] = "/" + voms_list[1] + "/" + voms_list[2]
-        elif len(voms_list) == 3:
-            voms_dict["vogroup"] = "/" + voms_list[1]
-            voms_dict["vorole"] = voms_list[2]
-        else:
-            voms_dict["vogroup"] = "/" + voms_list[1] + "/" + voms_list[2]
-            voms_dict["vorole"] = voms_list[3]
+        voms_string, vo, vogroup, vorole = parse_voms(
+            record.meta.get(meta_key_voms)[0]
+        )
     except TypeError:
         logging.warning(
             f"No VOMS information found in {record.record_id}, "
@@ -226,10 +648,51 @@ def get_voms_info(record, config):
         voms_dict["vogroup"] = None
         voms_dict["vorole"] = None
 
+        return voms_dict
+
+    if vorole is None:
+        logging.warning(
+            f"No Role found in VOMS of {record.record_id}: {voms_string}, "
+            "not sending VORole"
+        )
+
+    voms_dict["vo"] = vo
+    voms_dict["vogroup"] = vogroup
+    voms_dict["vorole"] = vorole
+
     return voms_dict
 
 
-def create_summary_db(config, records):
+def insert_rows(conn, insert_sql, rows, chunk_size, recordid_index):
+    # The throwaway DBs run without a journal, so a failed chunk cannot be
+    # rolled back. It is not needed either, since the DB is abandoned on
+    # error. The number of rows the chunk inserted before the failure
+    # points at the offending record.
+    cur = conn.cursor()
+    rows = iter(rows)
+
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        changes_before = conn.total_changes
+        try:
+            cur.executemany(insert_sql, chunk)
+        except Error as e:
+            failed_row = chunk[conn.total_changes - changes_before]
+            logging.critical(f"{e} (record {failed_row[recordid_index]})")
+            raise
+
+    try:
+        conn.commit()
+        cur.close()
+    except Error as e:
+        logging.critical(e)
+        raise
+
+
+def init_summary_db():
     create_table_sql = """
                        CREATE TABLE IF NOT EXISTS records(
                            site TEXT NOT NULL,
@@ -255,6 +718,22 @@ def create_summary_db(config, records):
                        )
                        """
 
+    try:
+        conn = sqlite3.connect(":memory:")
+        cur = conn.cursor()
+        cur.execute("PRAGMA journal_mode = OFF")
+        cur.execute("PRAGMA synchronous = OFF")
+        cur.execute("PRAGMA temp_store = MEMORY")
+        cur.execute(create_table_sql)
+        cur.close()
+    except Error as e:
+        logging.critical(e)
+        raise
+
+    return conn
+
+
+def insert_summary_rows(conn, rows, chunk_size=10000):
     insert_record_sql = """
                         INSERT INTO records(
                             site,
@@ -287,204 +766,460 @@ def create_summary_db(config, records):
                         )
                         """
 
+    insert_rows(conn, insert_record_sql, rows, chunk_size, 10)
+
+
+def init_sync_db():
+    create_table_sql = """
+                       CREATE TABLE IF NOT EXISTS records(
+                           site TEXT NOT NULL,
+                           submithost TEXT NOT NULL,
+                           year INTEGER NOT NULL,
+                           month INTEGER NOT NULL,
+                           recordid TEXT UNIQUE NOT NULL
+                       )
+                       """
+
     try:
         conn = sqlite3.connect(":memory:")
         cur = conn.cursor()
+        cur.execute("PRAGMA journal_mode = OFF")
+        cur.execute("PRAGMA synchronous = OFF")
+        cur.execute("PRAGMA temp_store = MEMORY")
         cur.execute(create_table_sql)
+        cur.close()
     except Error as e:
         logging.critical(e)
         raise
 
-    site_name_mapping = json.loads(config["site"].get("site_name_mapping"))
-    sites_to_report = json.loads(config["site"].get("sites_to_report"))
-    infrastructure = config["site"].get("infrastructure_type")
-    benchmark_type = config["site"].get("benchmark_type")
-    benchmark_name = config["auditor"].get("benchmark_name")
-    cores_name = config["auditor"].get("cores_name")
-    cpu_time_name = config["auditor"].get("cpu_time_name")
-    nnodes_name = config["auditor"].get("nnodes_name")
-    meta_key_username = config["auditor"].get("meta_key_username")
+    return conn
+
+
+def insert_sync_rows(conn, rows, chunk_size=10000):
+    insert_record_sql = """
+                        INSERT INTO records(
+                            site,
+                            submithost,
+                            year,
+                            month,
+                            recordid
+                        )
+                        VALUES(
+                            ?, ?, ?, ?, ?
+                        )
+                        """
+
+    insert_rows(conn, insert_record_sql, rows, chunk_size, 4)
+
+
+# Compact stand-in for a pyauditor Record once it was extracted. Being a
+# namedtuple it has no per-instance __dict__ and can be passed to
+# executemany and pickled as is.
+ApelRecord = namedtuple(
+    "ApelRecord",
+    [
+        "site",
+        "submithost",
+        "vo",
+        "vogroup",
+        "vorole",
+        "infrastructure",
+        "year",
+        "month",
+        "cpucount",
+        "nodecount",
+        "recordid",
+        "runtime",
+        "normruntime",
+        "cputime",
+        "normcputime",
+        "starttime",
+        "stoptime",
+        "user",
+        "benchmarktype",
+        "benchmarkvalue",
+    ],
+)
+
+
+def parse_meta_string(meta_string):
+    return sys.intern(replace_record_string(meta_string))
+
+
+def parse_interned_voms(voms_meta):
+    return tuple(
+        None if v is None else sys.intern(v) for v in parse_voms(voms_meta)
+    )
+
+
+class RecordExtractor:
+    # All config lookups are resolved once here, so that extracting a record
+    # only touches the record itself. The meta strings repeat a lot across
+    # records (few sites, FQANs, headnodes and users), so their parsing is
+    # memoized in bounded LRU caches keyed on the raw meta value. All
+    # repeated strings are interned, so records of the same group share them.
+    def __init__(self, config):
+        self.site_name_mapping = {
+            k: sys.intern(v)
+            for k, v in json.loads(
+                config["site"].get("site_name_mapping")
+            ).items()
+        }
+        self.sites_to_report = set(
+            json.loads(config["site"].get("sites_to_report"))
+        )
+        self.default_submit_host = config["site"].get("default_submit_host")
+        self.infrastructure = config["site"].get("infrastructure_type")
+        self.benchmark_type = config["site"].get("benchmark_type")
+        self.benchmark_name = config["auditor"].get("benchmark_name")
+        self.cores_name = config["auditor"].get("cores_name")
+        self.cpu_time_name = config["auditor"].get("cpu_time_name")
+        self.nnodes_name = config["auditor"].get("nnodes_name")
+        self.meta_key_site = config["auditor"].get("meta_key_site")
+        self.meta_key_submithost = config["auditor"].get("meta_key_submithost")
+        self.meta_key_voms = config["auditor"].get("meta_key_voms")
+        self.meta_key_username = config["auditor"].get("meta_key_username")
+
+        meta_cache_size = config.getint(
+            "auditor", "meta_cache_size", fallback=1024
+        )
+        self.lookup_site = lru_cache(maxsize=meta_cache_size)(
+            self._lookup_site
+        )
+        self.parse_submit_host = lru_cache(maxsize=meta_cache_size)(
+            parse_meta_string
+        )
+        self.parse_voms = lru_cache(maxsize=meta_cache_size)(
+            parse_interned_voms
+        )
+        self.parse_user_name = lru_cache(maxsize=meta_cache_size)(
+            parse_meta_string
+        )
 
-    for r in records:
-        site_id = get_site_id(r, config)
+    def cache_info(self):
+        return {
+            "site": self.lookup_site.cache_info(),
+            "submithost": self.parse_submit_host.cache_info(),
+            "voms": self.parse_voms.cache_info(),
+            "user": self.parse_user_name.cache_info(),
+        }
 
-        if site_id not in sites_to_report:
-            continue
+    def _lookup_site(self, site_id):
+        if site_id not in self.sites_to_report:
+            return None
 
         try:
-            site_name = site_name_mapping[site_id]
+            site_name = self.site_name_mapping[site_id]
         except KeyError:
             logging.critical(
                 f"No site name mapping defined for site {site_id}"
             )
             raise
 
-        submit_host = get_submit_host(r, config)
-
-        voms_dict = get_voms_info(r, config)
+        return site_name
 
+    def get_site_name(self, record):
         try:
-            user_name = replace_record_string(r.meta.get(meta_key_username)[0])
+            site_id = record.meta.get(self.meta_key_site)[0]
+        except AttributeError:
+            logging.critical(
+                f"No meta data found in {record.record_id}, aborting"
+            )
+            raise
         except TypeError:
-            logging.warning(
-                f"No GlobalUserName found in {r.record_id}, "
-                "not sending GlobalUserName"
+            logging.critical(
+                f"No site name found in {record.record_id}, aborting"
             )
-            user_name = None
+            raise
 
-        year = r.stop_time.replace(tzinfo=pytz.utc).year
-        month = r.stop_time.replace(tzinfo=pytz.utc).month
+        return self.lookup_site(site_id)
 
-        component_dict = {}
-        score_dict = {}
+    def get_submit_host(self, record):
+        submit_host = record.meta.get(self.meta_key_submithost)
 
-        for c in r.components:
-            component_dict[c.name] = c
+        if submit_host is None:
+            logging.warning(
+                f"No {self.meta_key_submithost} found in record "
+                f"{record.record_id}, sending default SubmitHost "
+                f"{self.default_submit_host}"
+            )
+            return self.default_submit_host
 
-        try:
-            cputime = component_dict[cpu_time_name].amount
-        except KeyError:
-            logging.critical(f"no {cpu_time_name} in components")
-            raise
+        return self.parse_submit_host(submit_host[0])
 
-        try:
-            nodecount = component_dict[nnodes_name].amount
-        except KeyError:
-            logging.critical(f"no {nnodes_name} in components")
-            raise
+    def get_voms_info(self, record):
+        voms = record.meta.get(self.meta_key_voms)
 
-        try:
-            cpucount = component_dict[cores_name].amount
-            for s in component_dict[cores_name].scores:
-                score_dict[s.name] = s.value
-        except KeyError:
-            logging.critical(f"no {cores_name} in components")
-            raise
+        if voms is None:
+            logging.warning(
+                f"No VOMS information found in {record.record_id}, "
+                "not sending VO, VOGroup, and VORole"
+            )
+            return None, None, None
 
-        try:
-            benchmark_value = score_dict[benchmark_name]
-        except KeyError:
-            logging.critical(f"no {benchmark_name} in scores")
-            raise
+        voms_string, vo, vogroup, vorole = self.parse_voms(voms[0])
+
+        if vorole is None:
+            logging.warning(
+                f"No Role found in VOMS of {record.record_id}: {voms_string}, "
+                "not sending VORole"
+            )
+
+        return vo, vogroup, vorole
+
+    def get_user_name(self, record):
+        user_name = record.meta.get(self.meta_key_username)
+
+        if user_name is None:
+            logging.warning(
+                f"No GlobalUserName found in {record.record_id}, "
+                "not sending GlobalUserName"
+            )
+            return None
+
+        return self.parse_user_name(user_name[0])
+
+    # Rows of the mirror only hold reported sites
+    def is_reported(self, record):
+        if type(record) is ApelRecord:
+            return True
+
+        return self.get_site_name(record) is not None
+
+    def extract(self, record):
+        if type(record) is ApelRecord:
+            return record
+
+        site_name = self.get_site_name(record)
+
+        if site_name is None:
+            return None
+
+        return self.extract_summary_row(record, site_name)
+
+    def extract_summary_row(self, record, site_name):
+        if type(record) is ApelRecord:
+            return record
+
+        r = record
+
+        submit_host = self.get_submit_host(r)
+        vo, vogroup, vorole = self.get_voms_info(r)
+        user_name = self.get_user_name(r)
+
+        cputime = None
+        nodecount = None
+        cores = None
 
-        norm_runtime = r.runtime * benchmark_value
-        norm_cputime = cputime * benchmark_value
+        for c in r.components:
+            name = c.name
+            if name == self.cpu_time_name:
+                cputime = c.amount
+            if name == self.nnodes_name:
+                nodecount = c.amount
+            if name == self.cores_name:
+                cores = c
+
+        if cputime is None:
+            logging.critical(f"no {self.cpu_time_name} in components")
+            raise KeyError(self.cpu_time_name)
+
+        if nodecount is None:
+            logging.critical(f"no {self.nnodes_name} in components")
+            raise KeyError(self.nnodes_name)
+
+        if cores is None:
+            logging.critical(f"no {self.cores_name} in components")
+            raise KeyError(self.cores_name)
+
+        benchmark_value = None
+
+        for s in cores.scores:
+            if s.name == self.benchmark_name:
+                benchmark_value = s.value
+
+        if benchmark_value is None:
+            logging.critical(f"no {self.benchmark_name} in scores")
+            raise KeyError(self.benchmark_name)
+
+        start_time = r.start_time
+        stop_time = r.stop_time
+        if stop_time.tzinfo is not None:
+            start_time = start_time.replace(tzinfo=None)
+            stop_time = stop_time.replace(tzinfo=None)
 
-        data_tuple = (
+        runtime = r.runtime
+
+        return ApelRecord(
             site_name,
             submit_host,
-            voms_dict["vo"],
-            voms_dict["vogroup"],
-            voms_dict["vorole"],
-            infrastructure,
-            year,
-            month,
-            cpucount,
+            vo,
+            vogroup,
+            vorole,
+            self.infrastructure,
+            stop_time.year,
+            stop_time.month,
+            cores.amount,
             nodecount,
             r.record_id,
-            r.runtime,
-            norm_runtime,
+            runtime,
+            runtime * benchmark_value,
             cputime,
-            norm_cputime,
-            r.start_time.replace(tzinfo=pytz.utc).timestamp(),
-            r.stop_time.replace(tzinfo=pytz.utc).timestamp(),
+            cputime * benchmark_value,
+            (start_time - EPOCH).total_seconds(),
+            (stop_time - EPOCH).total_seconds(),
             user_name,
-            benchmark_type,
+            self.benchmark_type,
             benchmark_value,
         )
-        try:
-            cur.execute(insert_record_sql, data_tuple)
-        except Error as e:
-            logging.critical(e)
-            raise
 
-    try:
-        conn.commit()
-        cur.close()
-    except Error as e:
-        logging.critical(e)
-        raise
+    def extract_sync(self, record):
+        if type(record) is ApelRecord:
+            return sync_projection(record)
 
-    return conn
+        site_name = self.get_site_name(record)
 
+        if site_name is None:
+            return None
 
-def create_sync_db(config, records):
-    create_table_sql = """
-                       CREATE TABLE IF NOT EXISTS records(
-                           site TEXT NOT NULL,
-                           submithost TEXT NOT NULL,
-                           year INTEGER NOT NULL,
-                           month INTEGER NOT NULL,
-                           recordid TEXT UNIQUE NOT NULL
-                       )
-                       """
+        return self.extract_sync_row(record, site_name)
 
-    insert_record_sql = """
-                        INSERT INTO records(
-                            site,
-                            submithost,
-                            year,
-                            month,
-                            recordid
-                        )
-                        VALUES(
-                            ?, ?, ?, ?, ?
-                        )
-                        """
+    def extract_sync_row(self, record, site_name):
+        if type(record) is ApelRecord:
+            return sync_projection(record)
 
-    try:
-        conn = sqlite3.connect(":memory:")
-        cur = conn.cursor()
-        cur.execute(create_table_sql)
-    except Error as e:
-        logging.critical(e)
-        raise
+        stop_time = record.stop_time
 
-    site_name_mapping = json.loads(config["site"].get("site_name_mapping"))
-    sites_to_report = json.loads(config["site"].get("sites_to_report"))
+        return (
+            site_name,
+            self.get_submit_host(record),
+            stop_time.year,
+            stop_time.month,
+            record.record_id,
+        )
 
-    for r in records:
-        site_id = get_site_id(r, config)
+    def get_stop_timestamp(self, record):
+        stop_time = record.stop_time
+        if stop_time.tzinfo is not None:
+            stop_time = stop_time.replace(tzinfo=None)
+
+        return (stop_time - EPOCH).total_seconds()
+
+    def summary_rows(self, records):
+        for r in records:
+            row = self.extract(r)
+            if row is not None:
+                yield row
+
+    def sync_rows(self, records):
+        for r in records:
+            row = self.extract_sync(r)
+            if row is not None:
+                yield row
+
+    def split_rows(self, records, summary_since, sync_since, seen=None):
+        # Yields (summary row, sync row) pairs for a window covering both the
+        # summary and the sync message. Records only needed for the sync get
+        # the cheap extraction. With a seen index, records already published
+        # only go into the sync.
+        summary_since_stamp = summary_since.timestamp()
+        sync_since_stamp = sync_since.timestamp()
+
+        for r in records:
+            if type(r) is ApelRecord:
+                site_name = r.site
+                stop_time = r.stoptime
+            else:
+                site_name = self.get_site_name(r)
+                if site_name is None:
+                    continue
+                stop_time = self.get_stop_timestamp(r)
 
-        if site_id not in sites_to_report:
-            continue
+            if stop_time > summary_since_stamp:
+                row = self.extract_summary_row(r, site_name)
+                if seen is not None and not seen.mark(row.recordid, stop_time):
+                    if stop_time > sync_since_stamp:
+                        yield None, sync_projection(row)
+                elif stop_time > sync_since_stamp:
+                    yield row, sync_projection(row)
+                else:
+                    yield row, None
+            elif stop_time > sync_since_stamp:
+                yield None, self.extract_sync_row(r, site_name)
 
-        try:
-            site_name = site_name_mapping[site_id]
-        except KeyError:
-            logging.critical(
-                f"No site name mapping defined for site {site_id}"
-            )
-            raise
 
-        submit_host = get_submit_host(r, config)
+def sync_projection(row):
+    return (row.site, row.submithost, row.year, row.month, row.recordid)
 
-        year = r.stop_time.replace(tzinfo=pytz.utc).year
-        month = r.stop_time.replace(tzinfo=pytz.utc).month
 
-        data_tuple = (
-            site_name,
-            submit_host,
-            year,
-            month,
-            r.record_id,
-        )
-        try:
-            cur.execute(insert_record_sql, data_tuple)
-        except Error as e:
-            logging.critical(e)
-            raise
+def extract_records(config, records):
+    extractor = RecordExtractor(config)
+    yield from extractor.summary_rows(records)
+    logging.debug(f"Meta cache statistics: {extractor.cache_info()}")
 
-    try:
-        conn.commit()
-        cur.close()
-    except Error as e:
-        logging.critical(e)
-        raise
+
+def compact_records(config, records):
+    return list(extract_records(config, records))
+
+
+def filter_reported_records(config, records):
+    extractor = RecordExtractor(config)
+
+    return [r for r in records if extractor.is_reported(r)]
+
+
+def create_summary_db(config, records):
+    extractor = RecordExtractor(config)
+    chunk_size = config.getint(
+        "aggregation", "insert_chunk_size", fallback=10000
+    )
+    conn = init_summary_db()
+    insert_summary_rows(conn, extractor.summary_rows(records), chunk_size)
+    logging.debug(f"Meta cache statistics: {extractor.cache_info()}")
 
     return conn
 
 
+def create_sync_db(config, records):
+    extractor = RecordExtractor(config)
+    chunk_size = config.getint(
+        "aggregation", "insert_chunk_size", fallback=10000
+    )
+    conn = init_sync_db()
+    insert_sync_rows(conn, extractor.sync_rows(records), chunk_size)
+    logging.debug(f"Meta cache statistics: {extractor.cache_info()}")
+
+    return conn
+
+
+def create_combined_db(config, records, summary_since, sync_since, seen=None):
+    extractor = RecordExtractor(config)
+    chunk_size = config.getint(
+        "aggregation", "insert_chunk_size", fallback=10000
+    )
+
+    summary_db = init_summary_db()
+    sync_db = init_sync_db()
+
+    rows = extractor.split_rows(records, summary_since, sync_since, seen)
+
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        insert_summary_rows(
+            summary_db, (c[0] for c in chunk if c[0] is not None), chunk_size
+        )
+        insert_sync_rows(
+            sync_db, (c[1] for c in chunk if c[1] is not None), chunk_size
+        )
+
+    logging.debug(f"Meta cache statistics: {extractor.cache_info()}")
+
+    return summary_db, sync_db
+
+
 def group_summary_db(summary_db, filter_by: (int, int, str) = None):
     filter = ""
     if filter_by is not None:
@@ -566,113 +1301,1780 @@ def group_sync_db(sync_db):
     return grouped_sync_list
 
 
-def create_summary(grouped_summary_list):
-    summary = "APEL-summary-job-message: v0.3\n"
-
-    for entry in grouped_summary_list:
-        summary += f"Site: {entry['site']}\n"
-        summary += f"Month: {entry['month']}\n"
-        summary += f"Year: {entry['year']}\n"
-        if entry["user"] is not None:
-            summary += f"GlobalUserName: {entry['user']}\n"
-        if entry["vo"] is not None:
-            summary += f"VO: {entry['vo']}\n"
-        if entry["vogroup"] is not None:
-            summary += f"VOGroup: {entry['vogroup']}\n"
-        if entry["vorole"] is not None:
-            summary += f"VORole: {entry['vorole']}\n"
-        summary += f"SubmitHost: {entry['submithost']}\n"
-        summary += f"Infrastructure: {entry['infrastructure']}\n"
-        summary += f"Processors: {entry['cpucount']}\n"
-        summary += f"NodeCount: {entry['nodecount']}\n"
-        summary += f"EarliestEndTime: {entry['min_stoptime']}\n"
-        summary += f"LatestEndTime: {entry['max_stoptime']}\n"
-        summary += f"WallDuration : {int(entry['runtime'])}\n"
-        summary += f"CpuDuration: {int(entry['cputime'])}\n"
-        summary += f"NormalisedWallDuration: {int(entry['norm_runtime'])}\n"
-        summary += f"NormalisedCpuDuration: {int(entry['norm_cputime'])}\n"
-        summary += f"ServiceLevelType: {entry['benchmarktype']}\n"
-        summary += f"ServiceLevel: {entry['benchmarkvalue']}\n"
-        summary += f"NumberOfJobs: {entry['jobcount']}\n"
-        summary += "%%\n"
-
-    return summary
+def integer_affinity(value):
+    # Mimic the INTEGER column affinity of the records table, which stores
+    # integral floats as integers
+    if type(value) is float and value.is_integer():
+        return int(value)
 
+    return value
 
-def create_sync(sync_db):
-    sync = "APEL-sync-message: v0.1\n"
 
-    for entry in sync_db:
-        sync += f"Site: {entry['site']}\n"
-        sync += f"Month: {entry['month']}\n"
-        sync += f"Year: {entry['year']}\n"
-        sync += f"SubmitHost: {entry['submithost']}\n"
-        sync += f"NumberOfJobs: {entry['jobcount']}\n"
-        sync += "%%\n"
+def make_rows(columns, values_list):
+    conn = sqlite3.connect(":memory:")
+    cur = conn.execute("SELECT " + ", ".join(f"NULL AS {c}" for c in columns))
+    rows = [sqlite3.Row(cur, values) for values in values_list]
+    cur.close()
+    conn.close()
+
+    return rows
+
+
+def sort_key(group_key):
+    # Order groups like SQLite's GROUP BY does, with NULLs first
+    return tuple((0,) if v is None else (1, v) for v in group_key)
+
+
+class HashAggregator:
+    # Streaming alternative to the in-memory SQLite DBs: every extracted row
+    # only updates the accumulators of its group and is dropped afterwards.
+    summary_columns = [
+        "site",
+        "submithost",
+        "vo",
+        "vogroup",
+        "vorole",
+        "infrastructure",
+        "year",
+        "month",
+        "cpucount",
+        "nodecount",
+        "jobcount",
+        "runtime",
+        "norm_runtime",
+        "cputime",
+        "norm_cputime",
+        "min_stoptime",
+        "max_stoptime",
+        "user",
+        "benchmarktype",
+        "benchmarkvalue",
+    ]
+
+    sync_columns = ["site", "submithost", "year", "month", "jobcount"]
+
+    def __init__(self):
+        self.summary_groups = {}
+        self.sync_groups = {}
+        self.summary_ids = set()
+        self.sync_ids = set()
+
+    def check_record_id(self, record_ids, record_id, table):
+        if record_id in record_ids:
+            e = sqlite3.IntegrityError(
+                f"UNIQUE constraint failed: {table}.recordid"
+            )
+            logging.critical(f"{e} (record {record_id})")
+            raise e
+
+        record_ids.add(record_id)
+
+    def add_summary_row(self, row):
+        self.check_record_id(self.summary_ids, row[10], "records")
+
+        # site, submithost, vo, vogroup, vorole, infrastructure, year, month,
+        # cpucount, nodecount, user, benchmarktype, benchmarkvalue
+        key = row[:10] + row[17:]
+        stop_time = row[16]
+        acc = self.summary_groups.get(key)
+
+        if acc is None:
+            self.summary_groups[key] = [
+                1,
+                row[11],
+                row[12],
+                row[13],
+                row[14],
+                stop_time,
+                stop_time,
+            ]
+        else:
+            acc[0] += 1
+            acc[1] += row[11]
+            acc[2] += row[12]
+            acc[3] += row[13]
+            acc[4] += row[14]
+            if stop_time < acc[5]:
+                acc[5] = stop_time
+            if stop_time > acc[6]:
+                acc[6] = stop_time
+
+    def add_sync_row(self, row):
+        self.check_record_id(self.sync_ids, row[4], "records")
+
+        key = row[:4]
+        self.sync_groups[key] = self.sync_groups.get(key, 0) + 1
+
+    def grouped_summary_list(self, filter_by=None):
+        values_list = []
+
+        for key in sorted(self.summary_groups, key=sort_key):
+            if filter_by is not None and (key[7], key[6], key[0]) != filter_by:
+                continue
+
+            acc = self.summary_groups[key]
+            values_list.append(
+                key[:10]
+                + (acc[0],)
+                + tuple(integer_affinity(v) for v in acc[1:])
+                + key[10:12]
+                + (float(key[12]),)
+            )
 
-    return sync
+        return make_rows(self.summary_columns, values_list)
 
+    def grouped_sync_list(self):
+        values_list = [
+            key + (self.sync_groups[key],)
+            for key in sorted(self.sync_groups, key=sort_key)
+        ]
 
-def get_token(config):
-    auth_url = config["authentication"].get("auth_url")
-    client_cert = config["authentication"].get("client_cert")
-    client_key = config["authentication"].get("client_key")
-    verify_ca = config["authentication"].getboolean("verify_ca")
-    if verify_ca:
-        ca_path = config["authentication"].get("ca_path")
-    else:
-        ca_path = False
+        return make_rows(self.sync_columns, values_list)
 
-    response = requests.get(
-        auth_url, cert=(client_cert, client_key), verify=ca_path
-    )
-    token = response.json()["token"]
 
-    return token
+class ColumnarAggregator(HashAggregator):
+    # Packs the per-record numbers into flat columns and reduces them per
+    # group in vectorised numpy passes. Group keys are factorised to integer
+    # codes while the rows are collected.
+    def __init__(self):
+        if np is None:
+            logging.critical(
+                "The numpy aggregation backend requires numpy, "
+                "install auditor_apel_plugin[numpy]"
+            )
+            raise ImportError("numpy")
+
+        super().__init__()
+        self.group_codes = {}
+        self.codes = array("q")
+        self.runtime = array("d")
+        self.cputime = array("d")
+        self.stoptime = array("d")
+
+    def add_summary_row(self, row):
+        self.check_record_id(self.summary_ids, row[10], "records")
+
+        key = row[:10] + row[17:]
+        code = self.group_codes.get(key)
+        if code is None:
+            code = self.group_codes[key] = len(self.group_codes)
+
+        self.codes.append(code)
+        self.runtime.append(row[11])
+        self.cputime.append(row[13])
+        self.stoptime.append(row[16])
+
+    def reduce_groups(self):
+        n_groups = len(self.group_codes)
+        self.summary_groups = {}
+
+        if n_groups == 0:
+            return
+
+        codes = np.frombuffer(self.codes, dtype=np.int64)
+        runtime = np.frombuffer(self.runtime, dtype=np.float64)
+        cputime = np.frombuffer(self.cputime, dtype=np.float64)
+        stoptime = np.frombuffer(self.stoptime, dtype=np.float64)
+
+        benchmark_values = np.fromiter(
+            (key[12] for key in self.group_codes),
+            dtype=np.float64,
+            count=n_groups,
+        )[codes]
+
+        jobcount = np.bincount(codes, minlength=n_groups)
+        runtime_sum = np.bincount(codes, runtime, n_groups)
+        norm_runtime_sum = np.bincount(
+            codes, runtime * benchmark_values, n_groups
+        )
+        cputime_sum = np.bincount(codes, cputime, n_groups)
+        norm_cputime_sum = np.bincount(
+            codes, cputime * benchmark_values, n_groups
+        )
+        min_stoptime = np.full(n_groups, np.inf)
+        np.minimum.at(min_stoptime, codes, stoptime)
+        max_stoptime = np.full(n_groups, -np.inf)
+        np.maximum.at(max_stoptime, codes, stoptime)
 
+        for key, code in self.group_codes.items():
+            self.summary_groups[key] = [
+                int(jobcount[code]),
+                float(runtime_sum[code]),
+                float(norm_runtime_sum[code]),
+                float(cputime_sum[code]),
+                float(norm_cputime_sum[code]),
+                float(min_stoptime[code]),
+                float(max_stoptime[code]),
+            ]
 
-def sign_msg(client_cert, client_key, msg):
-    with open(client_cert, "rb") as cc:
-        cert = x509.load_pem_x509_certificate(cc.read())
+    def grouped_summary_list(self, filter_by=None):
+        self.reduce_groups()
 
-    with open(client_key, "rb") as ck:
-        key = serialization.load_pem_private_key(ck.read(), None)
+        return super().grouped_summary_list(filter_by)
 
-    options = [pkcs7.PKCS7Options.DetachedSignature, pkcs7.PKCS7Options.Text]
 
-    signed_msg = (
-        pkcs7.PKCS7SignatureBuilder()
-        .set_data(bytes(msg, "utf-8"))
-        .add_signer(cert, key, hashes.SHA256())
-        .sign(serialization.Encoding.SMIME, options)
-    )
+def create_aggregator(backend):
+    if backend == "numpy":
+        return ColumnarAggregator()
 
-    return signed_msg
+    return HashAggregator()
 
 
-def build_payload(msg):
-    current_time = datetime.utcnow().strftime("%Y%m%d%H%M%S")
-    empaid = f"{current_time[:8]}/{current_time}"
+def get_aggregation_backend(config):
+    backend = config.get("aggregation", "backend", fallback="sqlite")
 
-    payload = {"messages": [{"attributes": {"empaid": empaid}, "data": msg}]}
+    if backend not in ("sqlite", "dict", "numpy"):
+        logging.critical(f"Unknown aggregation backend {backend}")
+        raise ValueError(backend)
 
-    return payload
+    return backend
 
 
-def send_payload(config, token, payload):
-    ams_url = config["authentication"].get("ams_url")
-    verify_ca = config["authentication"].getboolean("verify_ca")
-    if verify_ca:
-        ca_path = config["authentication"].get("ca_path")
+def group_summary(config, records, filter_by: (int, int, str) = None):
+    backend = get_aggregation_backend(config)
+
+    if backend == "sqlite":
+        summary_db = create_summary_db(config, records)
+        return group_summary_db(summary_db, filter_by)
+
+    extractor = RecordExtractor(config)
+    aggregator = create_aggregator(backend)
+
+    for row in extractor.summary_rows(records):
+        aggregator.add_summary_row(row)
+
+    logging.debug(f"Meta cache statistics: {extractor.cache_info()}")
+
+    return aggregator.grouped_summary_list(filter_by)
+
+
+def group_combined(config, records, summary_since, sync_since, seen=None):
+    backend = get_aggregation_backend(config)
+
+    if backend == "sqlite":
+        summary_db, sync_db = create_combined_db(
+            config, records, summary_since, sync_since, seen
+        )
+        return group_summary_db(summary_db), group_sync_db(sync_db)
+
+    extractor = RecordExtractor(config)
+    aggregator = create_aggregator(backend)
+
+    for summary_row, sync_row in extractor.split_rows(
+        records, summary_since, sync_since, seen
+    ):
+        if summary_row is not None:
+            aggregator.add_summary_row(summary_row)
+        if sync_row is not None:
+            aggregator.add_sync_row(sync_row)
+
+    logging.debug(f"Meta cache statistics: {extractor.cache_info()}")
+
+    return aggregator.grouped_summary_list(), aggregator.grouped_sync_list()
+
+
+def get_slice_length(config):
+    return config.getint("intervals", "slice_length", fallback=86400)
+
+
+# Only a window longer than one slice is worth cutting up
+def is_backlog(since, slice_length, current_time=None):
+    if slice_length <= 0:
+        return False
+
+    if current_time is None:
+        current_time = datetime.now(tz=pytz.utc)
+
+    return (current_time - since).total_seconds() > slice_length
+
+
+# Spools the records stopped after since to a temporary DB and cuts them
+# into windows of slice_length seconds, so only one window is held in memory
+# at a time. Every window comes with the latest stop time in it, which is the
+# checkpoint once the window was published. Rows already in the seen index
+# are left out, so a backlog without new records has no windows.
+class SliceSpool:
+    def __init__(self, config, records, since, slice_length, seen=None):
+        since_stamp = since.timestamp()
+        extractor = RecordExtractor(config)
+        rows = (
+            (int((r.stoptime - since_stamp) // slice_length),) + r
+            for r in extractor.summary_rows(records)
+            if r.stoptime > since_stamp
+            and (seen is None or r.recordid not in seen)
+        )
+        insert_sql = (
+            "INSERT INTO rows "
+            f"VALUES({', '.join('?' * (len(ApelRecord._fields) + 1))})"
+        )
+
+        try:
+            # An empty path gives a private temporary DB, which SQLite keeps
+            # on disk once it outgrows the page cache
+            self.conn = sqlite3.connect("", check_same_thread=False)
+            cur = self.conn.cursor()
+            cur.execute(
+                "CREATE TABLE rows(slice INTEGER NOT NULL, "
+                f"{', '.join(ApelRecord._fields)})"
+            )
+            for page in iter(lambda: list(islice(rows, 10000)), []):
+                cur.executemany(insert_sql, page)
+            cur.execute("CREATE INDEX rows_slice ON rows(slice)")
+            cur.execute(
+                "SELECT slice, MAX(stoptime) FROM rows "
+                "GROUP BY slice ORDER BY slice"
+            )
+            self.slices = cur.fetchall()
+            self.conn.commit()
+            cur.close()
+        except Error as e:
+            logging.critical(e)
+            raise
+
+        logging.debug(f"Meta cache statistics: {extractor.cache_info()}")
+
+    def __len__(self):
+        return len(self.slices)
+
+    def __iter__(self):
+        for index, end_time in self.slices:
+            try:
+                cur = self.conn.cursor()
+                cur.execute(
+                    f"SELECT {', '.join(ApelRecord._fields)} FROM rows "
+                    "WHERE slice = ?",
+                    (index,),
+                )
+                rows = [ApelRecord(*row) for row in cur]
+                cur.close()
+            except Error as e:
+                logging.critical(e)
+                raise
+
+            yield end_time, rows
+
+    def close(self):
+        self.conn.close()
+
+
+def partition_rows(rows, end_time, sites=None):
+    end_stamp = end_time.timestamp()
+    partitions = defaultdict(list)
+
+    for row in rows:
+        if row.stoptime <= end_stamp and (sites is None or row.site in sites):
+            partitions[(row.site, row.year, row.month)].append(row)
+
+    return partitions
+
+
+# Keeps the rows of the requested (site, year, month) partitions, so that
+# several months and sites are aggregated in one pass
+def select_partitions(config, records, partitions):
+    extractor = RecordExtractor(config)
+
+    for row in extractor.summary_rows(records):
+        if (row.site, row.year, row.month) in partitions:
+            yield row
+
+    logging.debug(f"Meta cache statistics: {extractor.cache_info()}")
+
+
+def get_aggregate_db(start_time, aggregate_db_path):
+    if Path(aggregate_db_path).is_file():
+        conn = sqlite3.connect(aggregate_db_path)
     else:
-        ca_path = False
+        conn = create_aggregate_db(start_time, aggregate_db_path)
 
-    logging.debug(f"{ams_url}{token}")
-    post = requests.post(
-        f"{ams_url}{token}",
-        json=payload,
-        headers={"Content-Type": "application/json"},
-        verify=ca_path,
-    )
+    return conn
 
-    return post
+
+def create_aggregate_db(start_time, aggregate_db_path):
+    create_summaries_sql = """
+                           CREATE TABLE IF NOT EXISTS summaries(
+                               site TEXT NOT NULL,
+                               submithost TEXT NOT NULL,
+                               vo TEXT,
+                               vogroup TEXT,
+                               vorole TEXT,
+                               infrastructure TEXT NOT NULL,
+                               year INTEGER NOT NULL,
+                               month INTEGER NOT NULL,
+                               cpucount INTEGER NOT NULL,
+                               nodecount INTEGER NOT NULL,
+                               user TEXT,
+                               benchmarktype TEXT NOT NULL,
+                               benchmarkvalue FLOAT NOT NULL,
+                               jobcount INTEGER NOT NULL,
+                               runtime INTEGER NOT NULL,
+                               norm_runtime FLOAT NOT NULL,
+                               cputime INTEGER NOT NULL,
+                               norm_cputime FLOAT NOT NULL,
+                               min_stoptime FLOAT NOT NULL,
+                               max_stoptime FLOAT NOT NULL,
+                               cycle INTEGER NOT NULL
+                           )
+                           """
+
+    create_index_sql = """
+                       CREATE INDEX IF NOT EXISTS summaries_key
+                       ON summaries(site, year, month, submithost, user)
+                       """
+
+    create_sync_sql = """
+                      CREATE TABLE IF NOT EXISTS sync(
+                          site TEXT NOT NULL,
+                          submithost TEXT NOT NULL,
+                          year INTEGER NOT NULL,
+                          month INTEGER NOT NULL,
+                          jobcount INTEGER NOT NULL,
+                          frozen INTEGER NOT NULL,
+                          PRIMARY KEY(site, submithost, year, month)
+                      )
+                      """
+
+    create_checkpoint_sql = """
+                            CREATE TABLE IF NOT EXISTS checkpoint(
+                                last_end_time FLOAT NOT NULL,
+                                sync_since FLOAT NOT NULL,
+                                cycle INTEGER NOT NULL
+                            )
+                            """
+
+    insert_checkpoint_sql = """
+                            INSERT INTO checkpoint(
+                                last_end_time,
+                                sync_since,
+                                cycle
+                            )
+                            VALUES(
+                                ?, ?, ?
+                            )
+                            """
+
+    try:
+        conn = sqlite3.connect(aggregate_db_path)
+        cur = conn.cursor()
+        cur.execute(create_summaries_sql)
+        cur.execute(create_index_sql)
+        cur.execute(create_sync_sql)
+        cur.execute(create_checkpoint_sql)
+        cur.execute(
+            insert_checkpoint_sql,
+            (start_time.timestamp(), start_time.timestamp(), 0),
+        )
+        conn.commit()
+        cur.close()
+        return conn
+    except Error as e:
+        logging.critical(e)
+        raise
+
+
+def get_aggregate_start_time(conn):
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT last_end_time FROM checkpoint")
+        start_time = datetime.fromtimestamp(cur.fetchone()[0], tz=pytz.utc)
+        cur.close()
+        return start_time
+    except Error as e:
+        logging.critical(e)
+        raise
+
+
+# Without commit the merge stays in the open transaction until the caller
+# commits it once the summaries were delivered, or rolls it back
+def update_aggregate_db(conn, grouped_summary_list, stop_time, commit=True):
+    key_columns = [
+        "site",
+        "submithost",
+        "vo",
+        "vogroup",
+        "vorole",
+        "infrastructure",
+        "year",
+        "month",
+        "cpucount",
+        "nodecount",
+        "user",
+        "benchmarktype",
+        "benchmarkvalue",
+    ]
+    value_columns = [
+        "jobcount",
+        "runtime",
+        "norm_runtime",
+        "cputime",
+        "norm_cputime",
+        "min_stoptime",
+        "max_stoptime",
+    ]
+    key_filter = " AND ".join(f"{k} IS ?" for k in key_columns)
+
+    update_sql = f"""
+                  UPDATE summaries
+                  SET jobcount = jobcount + ?,
+                      runtime = runtime + ?,
+                      norm_runtime = norm_runtime + ?,
+                      cputime = cputime + ?,
+                      norm_cputime = norm_cputime + ?,
+                      min_stoptime = MIN(min_stoptime, ?),
+                      max_stoptime = MAX(max_stoptime, ?),
+                      cycle = ?
+                  WHERE {key_filter}
+                  """
+
+    insert_sql = f"""
+                  INSERT INTO summaries(
+                      {", ".join(key_columns + value_columns)},
+                      cycle
+                  )
+                  VALUES(
+                      {", ".join("?" * (len(key_columns + value_columns) + 1))}
+                  )
+                  """
+
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT cycle FROM checkpoint")
+        cycle = cur.fetchone()[0] + 1
+
+        sync_counts = {}
+
+        for entry in grouped_summary_list:
+            keys = tuple(entry[k] for k in key_columns)
+            values = tuple(entry[v] for v in value_columns)
+
+            cur.execute(update_sql, values + (cycle,) + keys)
+            if cur.rowcount == 0:
+                cur.execute(insert_sql, keys + values + (cycle,))
+
+            sync_key = (
+                entry["site"],
+                entry["submithost"],
+                entry["year"],
+                entry["month"],
+            )
+            sync_counts[sync_key] = (
+                sync_counts.get(sync_key, 0) + entry["jobcount"]
+            )
+
+        add_sync_counts(cur, sync_counts)
+
+        cur.execute(
+            "UPDATE checkpoint SET last_end_time = ?, cycle = ?",
+            (stop_time, cycle),
+        )
+        if commit:
+            conn.commit()
+        cur.close()
+    except Error as e:
+        conn.rollback()
+        logging.critical(e)
+        raise
+
+
+def add_sync_counts(cur, sync_counts):
+    select_sql = """
+                 SELECT frozen
+                 FROM sync
+                 WHERE site = ?
+                 AND submithost = ?
+                 AND year = ?
+                 AND month = ?
+                 """
+
+    update_sql = """
+                 UPDATE sync
+                 SET jobcount = jobcount + ?
+                 WHERE site = ?
+                 AND submithost = ?
+                 AND year = ?
+                 AND month = ?
+                 """
+
+    insert_sql = """
+                 INSERT INTO sync(
+                     site,
+                     submithost,
+                     year,
+                     month,
+                     jobcount,
+                     frozen
+                 )
+                 VALUES(
+                     ?, ?, ?, ?, ?, 0
+                 )
+                 """
+
+    for sync_key, jobcount in sync_counts.items():
+        cur.execute(select_sql, sync_key)
+        row = cur.fetchone()
+
+        if row is None:
+            cur.execute(insert_sql, sync_key + (jobcount,))
+        elif row[0]:
+            logging.warning(
+                f"Sync count of {sync_key} is frozen, "
+                f"not adding {jobcount} late jobs"
+            )
+        else:
+            cur.execute(update_sql, (jobcount,) + sync_key)
+
+
+def get_sync_start_time(conn):
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT sync_since FROM checkpoint")
+        sync_since = datetime.fromtimestamp(cur.fetchone()[0], tz=pytz.utc)
+        cur.close()
+        return sync_since
+    except Error as e:
+        logging.critical(e)
+        raise
+
+
+def seed_sync_db(conn, grouped_sync_list, sync_since, commit=True):
+    sync_counts = {
+        (e["site"], e["submithost"], e["year"], e["month"]): e["jobcount"]
+        for e in grouped_sync_list
+    }
+
+    try:
+        cur = conn.cursor()
+        add_sync_counts(cur, sync_counts)
+        cur.execute(
+            "UPDATE checkpoint SET sync_since = ?", (sync_since.timestamp(),)
+        )
+        if commit:
+            conn.commit()
+        cur.close()
+    except Error as e:
+        conn.rollback()
+        logging.critical(e)
+        raise
+
+
+def freeze_sync_db(conn, begin_previous_month, commit=True):
+    freeze_sql = """
+                 UPDATE sync
+                 SET frozen = 1
+                 WHERE frozen = 0
+                 AND year * 12 + month < ?
+                 """
+
+    first_open_month = (
+        begin_previous_month.year * 12 + begin_previous_month.month
+    )
+
+    try:
+        cur = conn.cursor()
+        cur.execute(freeze_sql, (first_open_month,))
+        if commit:
+            conn.commit()
+        cur.close()
+    except Error as e:
+        logging.critical(e)
+        raise
+
+
+def group_sync_store(conn):
+    group_sql = """
+                SELECT site,
+                       submithost,
+                       year,
+                       month,
+                       jobcount
+                FROM sync
+                WHERE frozen = 0
+                """
+
+    cur = conn.cursor()
+    cur.row_factory = sqlite3.Row
+    cur.execute(group_sql)
+    grouped_sync_list = cur.fetchall()
+    cur.close()
+
+    return grouped_sync_list
+
+
+def group_aggregate_db(conn):
+    group_sql = """
+                SELECT site,
+                       submithost,
+                       vo,
+                       vogroup,
+                       vorole,
+                       infrastructure,
+                       year,
+                       month,
+                       cpucount,
+                       nodecount,
+                       jobcount,
+                       runtime,
+                       norm_runtime,
+                       cputime,
+                       norm_cputime,
+                       min_stoptime,
+                       max_stoptime,
+                       user,
+                       benchmarktype,
+                       benchmarkvalue
+                FROM summaries
+                WHERE cycle IS (SELECT cycle FROM checkpoint)
+                """
+
+    cur = conn.cursor()
+    cur.row_factory = sqlite3.Row
+    cur.execute(group_sql)
+    grouped_summary_list = cur.fetchall()
+    cur.close()
+
+    return grouped_summary_list
+
+
+def tuple_getter(columns):
+    if len(columns) == 1:
+        column = columns[0]
+        return lambda entry: (entry[column],)
+
+    return itemgetter(*columns)
+
+
+class MessageWriter:
+    # Each field is (column, prefix, optional, conversion). Optional fields
+    # are left out when NULL, conversion is the %-format character, where
+    # "d" truncates floats like int().
+    def __init__(self, header, fields):
+        self.header = f"{header}\n"
+        self.fields = tuple(fields)
+        self.optional = tuple(
+            column for column, _, optional, _ in self.fields if optional
+        )
+        self.get_optional = (
+            tuple_getter(self.optional) if self.optional else None
+        )
+        self.all_present = (True,) * len(self.optional)
+        self.templates = {}
+
+    # One %-template and column getter per combination of present optional
+    # fields, so an entry is formatted by a single C-level % operation
+    def get_template(self, present):
+        template = self.templates.get(present)
+
+        if template is None:
+            missing = {
+                column
+                for column, is_present in zip(self.optional, present)
+                if not is_present
+            }
+            fields = [f for f in self.fields if f[0] not in missing]
+            template = (
+                "".join(
+                    f"{prefix}: %{conversion}\n"
+                    for _, prefix, _, conversion in fields
+                )
+                + "%%%%\n",
+                tuple_getter([f[0] for f in fields]),
+            )
+            self.templates[present] = template
+
+        return template
+
+    def format_entry(self, entry):
+        present = self.all_present
+        if self.get_optional is not None:
+            optional = self.get_optional(entry)
+            if None in optional:
+                present = tuple([v is not None for v in optional])
+
+        template, getter = self.get_template(present)
+
+        return template % getter(entry)
+
+    def entries(self, grouped_list):
+        format_entry = self.format_entry
+
+        for entry in grouped_list:
+            yield format_entry(entry)
+
+    def write(self, grouped_list, sink):
+        write = sink.write
+        format_entry = self.format_entry
+        write(self.header)
+
+        for entry in grouped_list:
+            write(format_entry(entry))
+
+        return sink
+
+    def to_string(self, grouped_list):
+        return self.write(grouped_list, io.StringIO()).getvalue()
+
+    # Split the message at %% record boundaries into messages of at most
+    # max_size bytes. A single entry above the limit is sent on its own.
+    def chunks(self, grouped_list, max_size):
+        header_size = len(self.header.encode("utf-8"))
+        chunk = [self.header]
+        chunk_size = header_size
+
+        for entry in self.entries(grouped_list):
+            entry_size = len(entry.encode("utf-8"))
+
+            if chunk_size + entry_size > max_size and len(chunk) > 1:
+                yield "".join(chunk)
+                chunk = [self.header]
+                chunk_size = header_size
+
+            if header_size + entry_size > max_size:
+                logging.warning(
+                    f"Message entry of {entry_size} bytes exceeds the "
+                    f"message size limit of {max_size} bytes"
+                )
+
+            chunk.append(entry)
+            chunk_size += entry_size
+
+        yield "".join(chunk)
+
+
+SUMMARY_WRITER = MessageWriter(
+    "APEL-summary-job-message: v0.3",
+    (
+        ("site", "Site", False, "s"),
+        ("month", "Month", False, "s"),
+        ("year", "Year", False, "s"),
+        ("user", "GlobalUserName", True, "s"),
+        ("vo", "VO", True, "s"),
+        ("vogroup", "VOGroup", True, "s"),
+        ("vorole", "VORole", True, "s"),
+        ("submithost", "SubmitHost", False, "s"),
+        ("infrastructure", "Infrastructure", False, "s"),
+        ("cpucount", "Processors", False, "s"),
+        ("nodecount", "NodeCount", False, "s"),
+        ("min_stoptime", "EarliestEndTime", False, "s"),
+        ("max_stoptime", "LatestEndTime", False, "s"),
+        ("runtime", "WallDuration ", False, "d"),
+        ("cputime", "CpuDuration", False, "d"),
+        ("norm_runtime", "NormalisedWallDuration", False, "d"),
+        ("norm_cputime", "NormalisedCpuDuration", False, "d"),
+        ("benchmarktype", "ServiceLevelType", False, "s"),
+        ("benchmarkvalue", "ServiceLevel", False, "s"),
+        ("jobcount", "NumberOfJobs", False, "s"),
+    ),
+)
+
+SYNC_WRITER = MessageWriter(
+    "APEL-sync-message: v0.1",
+    (
+        ("site", "Site", False, "s"),
+        ("month", "Month", False, "s"),
+        ("year", "Year", False, "s"),
+        ("submithost", "SubmitHost", False, "s"),
+        ("jobcount", "NumberOfJobs", False, "s"),
+    ),
+)
+
+
+def write_summary(grouped_summary_list, sink):
+    return SUMMARY_WRITER.write(grouped_summary_list, sink)
+
+
+def write_sync(grouped_sync_list, sink):
+    return SYNC_WRITER.write(grouped_sync_list, sink)
+
+
+def create_summary(grouped_summary_list):
+    return SUMMARY_WRITER.to_string(grouped_summary_list)
+
+
+def create_sync(sync_db):
+    return SYNC_WRITER.to_string(sync_db)
+
+
+def create_summary_chunks(grouped_summary_list, max_size):
+    return SUMMARY_WRITER.chunks(grouped_summary_list, max_size)
+
+
+def create_sync_chunks(grouped_sync_list, max_size):
+    return SYNC_WRITER.chunks(grouped_sync_list, max_size)
+
+
+class AmsSession(requests.Session):
+    def __init__(self, timeout=None):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+
+        return super().request(method, url, **kwargs)
+
+
+def create_session(config):
+    client_cert = config["authentication"].get("client_cert")
+    client_key = config["authentication"].get("client_key")
+    verify_ca = config["authentication"].getboolean("verify_ca")
+    if verify_ca:
+        ca_path = config["authentication"].get("ca_path")
+    else:
+        ca_path = False
+    pool_size = config.getint("authentication", "pool_size", fallback=4)
+    connect_timeout = config.getfloat(
+        "authentication", "connect_timeout", fallback=10
+    )
+    read_timeout = config.getfloat(
+        "authentication", "read_timeout", fallback=60
+    )
+
+    session = AmsSession(timeout=(connect_timeout, read_timeout))
+    session.cert = (client_cert, client_key)
+    session.verify = ca_path
+
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
+
+
+# Without a shared session a short-lived one is used for the single call
+def use_session(config, session):
+    if session is None:
+        return create_session(config)
+
+    return nullcontext(session)
+
+
+def get_token(config, session=None):
+    auth_url = config["authentication"].get("auth_url")
+
+    with use_session(config, session) as session:
+        response = session.get(auth_url)
+
+    token = response.json()["token"]
+
+    return token
+
+
+class TokenManager:
+    def __init__(self, config, session=None):
+        self.config = config
+        self.session = session
+        self.lifetime = config.getint(
+            "authentication", "token_lifetime", fallback=3600
+        )
+        self.refresh_margin = config.getint(
+            "authentication", "token_refresh_margin", fallback=300
+        )
+        self.cache_path = config.get(
+            "paths", "token_cache_path", fallback=None
+        )
+        self.token = None
+        self.expires = 0
+        self.lock = threading.Lock()
+
+    def is_valid(self):
+        now = datetime.now(pytz.utc).timestamp()
+
+        return (
+            self.token is not None and now < self.expires - self.refresh_margin
+        )
+
+    def load_cache(self):
+        if self.cache_path is None or not Path(self.cache_path).is_file():
+            return
+
+        try:
+            with open(self.cache_path, "r") as cache_file:
+                cache = json.load(cache_file)
+            self.token = cache["token"]
+            self.expires = cache["expires"]
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Ignoring token cache {self.cache_path}: {e}")
+            self.token = None
+            self.expires = 0
+
+    # The token is a credential, so the cache file is only readable by us
+    def save_cache(self):
+        if self.cache_path is None:
+            return
+
+        tmp_path = f"{self.cache_path}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as cache_file:
+            json.dump(
+                {"token": self.token, "expires": self.expires}, cache_file
+            )
+        os.replace(tmp_path, self.cache_path)
+
+    def refresh(self):
+        self.token = get_token(self.config, self.session)
+        self.expires = datetime.now(pytz.utc).timestamp() + self.lifetime
+        logging.info("Fetched new token")
+        self.save_cache()
+
+        return self.token
+
+    def invalidate(self):
+        self.token = None
+        self.expires = 0
+        if self.cache_path is not None and Path(self.cache_path).is_file():
+            Path(self.cache_path).unlink()
+
+    def get(self):
+        with self.lock:
+            if not self.is_valid():
+                self.load_cache()
+            if not self.is_valid():
+                self.refresh()
+
+            return self.token
+
+    # Concurrent senders rejected with the same token trigger only one
+    # refresh
+    def renew(self, rejected_token):
+        with self.lock:
+            if self.token == rejected_token:
+                self.invalidate()
+                self.refresh()
+
+            return self.token
+
+    # A rejected token is dropped and the payload is sent once more with a
+    # fresh one
+    def send_payload(self, payload):
+        token = self.get()
+        post = send_payload(self.config, token, payload, self.session)
+
+        if post.status_code in (401, 403):
+            logging.warning(
+                f"Token rejected with status {post.status_code}, refreshing"
+            )
+            token = self.renew(token)
+            post = send_payload(self.config, token, payload, self.session)
+
+        return post
+
+
+class MessageSigner:
+    def __init__(self, client_cert, client_key):
+        self.client_cert = client_cert
+        self.client_key = client_key
+        self.mtimes = None
+        self.cert = None
+        self.key = None
+        self.builder = None
+        self.options = [
+            pkcs7.PKCS7Options.DetachedSignature,
+            pkcs7.PKCS7Options.Text,
+        ]
+
+    # Reload cert and key only if one of the files changed on disk, so a
+    # rotated certificate is picked up by the next signature
+    def load(self):
+        mtimes = (
+            Path(self.client_cert).stat().st_mtime_ns,
+            Path(self.client_key).stat().st_mtime_ns,
+        )
+
+        if mtimes != self.mtimes:
+            logging.debug(f"Loading {self.client_cert} and {self.client_key}")
+
+            with open(self.client_cert, "rb") as cc:
+                cert = x509.load_pem_x509_certificate(cc.read())
+
+            with open(self.client_key, "rb") as ck:
+                key = serialization.load_pem_private_key(ck.read(), None)
+
+            self.cert = cert
+            self.key = key
+            self.builder = pkcs7.PKCS7SignatureBuilder().add_signer(
+                cert, key, hashes.SHA256()
+            )
+            self.mtimes = mtimes
+
+        return self.builder
+
+    def sign(self, msg):
+        builder = self.load()
+
+        return builder.set_data(bytes(msg, "utf-8")).sign(
+            serialization.Encoding.SMIME, self.options
+        )
+
+
+def sign_msg(client_cert, client_key, msg):
+    return MessageSigner(client_cert, client_key).sign(msg)
+
+
+def build_payload(msg):
+    current_time = datetime.utcnow().strftime("%Y%m%d%H%M%S")
+    empaid = f"{current_time[:8]}/{current_time}"
+
+    payload = {"messages": [{"attributes": {"empaid": empaid}, "data": msg}]}
+
+    return payload
+
+
+# Message ids stay unique for all messages sent by this process, also for
+# several messages created within the same second
+def get_empaid():
+    current_time = datetime.utcnow().strftime("%Y%m%d%H%M%S")
+
+    return f"{current_time[:8]}/{current_time}-{next(MESSAGE_COUNTER):06d}"
+
+
+def build_payloads(msgs, max_payload_size):
+    messages = []
+    payload_size = 0
+
+    for msg in msgs:
+        message = {"attributes": {"empaid": get_empaid()}, "data": msg}
+        message_size = len(json.dumps(message))
+
+        if payload_size + message_size > max_payload_size and messages:
+            yield {"messages": messages}
+            messages = []
+            payload_size = 0
+
+        messages.append(message)
+        payload_size += message_size
+
+    if messages:
+        yield {"messages": messages}
+
+
+def encode_msg(signer, msg):
+    return base64.b64encode(signer.sign(msg)).decode("utf-8")
+
+
+def get_message_limits(config):
+    max_message_size = config.getint(
+        "messages", "max_message_size", fallback=1000000
+    )
+    max_payload_size = config.getint(
+        "messages", "max_payload_size", fallback=10000000
+    )
+
+    return max_message_size, max_payload_size
+
+
+DeliveryStatus = namedtuple("DeliveryStatus", ["empaids", "status_code"])
+
+
+# Other client errors reject the payload itself and sending it again does not
+# help. A rejected token was already refreshed once by the TokenManager.
+def is_retryable(status_code):
+    return status_code >= 500 or status_code in (401, 403, 408, 429)
+
+
+def is_delivered(statuses):
+    return all(
+        s.status_code is not None and 200 <= s.status_code < 300
+        for s in statuses
+    )
+
+
+# Like Executor.map, but keeps at most limit tasks in flight and yields the
+# results in input order
+def bounded_map(executor, func, iterable, limit):
+    pending = deque()
+
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= limit:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+# Each signing process loads cert and key once via its own signer
+worker_signer = None
+
+
+def init_sign_worker(client_cert, client_key):
+    global worker_signer
+    worker_signer = MessageSigner(client_cert, client_key)
+
+
+def sign_in_worker(msg):
+    return encode_msg(worker_signer, msg)
+
+
+class MessagePublisher:
+    def __init__(
+        self, signer, tokens, max_payload_size, sign_workers=1, send_workers=1
+    ):
+        self.signer = signer
+        self.tokens = tokens
+        self.max_payload_size = max_payload_size
+        self.sign_workers = sign_workers
+        self.send_workers = send_workers
+        self.sign_pool = None
+        self.send_pool = None
+
+        if sign_workers > 1:
+            self.sign_pool = ProcessPoolExecutor(
+                sign_workers,
+                initializer=init_sign_worker,
+                initargs=(signer.client_cert, signer.client_key),
+            )
+        if send_workers > 1:
+            self.send_pool = ThreadPoolExecutor(send_workers)
+
+    def logged(self, msgs):
+        for msg in msgs:
+            logging.debug(msg)
+            yield msg
+
+    def encode(self, msgs):
+        if self.sign_pool is None:
+            for msg in self.logged(msgs):
+                yield encode_msg(self.signer, msg)
+        else:
+            yield from bounded_map(
+                self.sign_pool,
+                sign_in_worker,
+                self.logged(msgs),
+                2 * self.sign_workers,
+            )
+
+    def send(self, payload):
+        empaids = [m["attributes"]["empaid"] for m in payload["messages"]]
+        logging.debug(f"Sending {len(empaids)} message(s): {empaids}")
+
+        # A failed token refresh (no token in the response, cache not
+        # writable) only fails this chunk
+        try:
+            status_code = self.tokens.send_payload(payload).status_code
+        except (requests.RequestException, KeyError, OSError) as e:
+            logging.error(f"Sending {empaids} failed: {e!r}")
+            status_code = None
+
+        logging.debug(status_code)
+
+        return DeliveryStatus(empaids, status_code)
+
+    def publish(self, msgs):
+        payloads = build_payloads(self.encode(msgs), self.max_payload_size)
+
+        if self.send_pool is None:
+            return [self.send(payload) for payload in payloads]
+
+        return list(
+            bounded_map(
+                self.send_pool, self.send, payloads, 2 * self.send_workers
+            )
+        )
+
+    # Store the signed payloads in the outbox instead of sending them
+    def spool(self, msgs, outbox):
+        payloads = build_payloads(self.encode(msgs), self.max_payload_size)
+
+        return [outbox.add(payload) for payload in payloads]
+
+    def close(self):
+        if self.sign_pool is not None:
+            self.sign_pool.shutdown()
+        if self.send_pool is not None:
+            self.send_pool.shutdown()
+
+
+def create_publisher(config, signer, tokens):
+    _, max_payload_size = get_message_limits(config)
+    sign_workers = config.getint("messages", "sign_workers", fallback=1)
+    send_workers = config.getint("messages", "send_workers", fallback=1)
+
+    return MessagePublisher(
+        signer, tokens, max_payload_size, sign_workers, send_workers
+    )
+
+
+# Directory queue of payloads waiting for delivery. Elements are written to
+# tmp and renamed into outgoing, so the drain never sees partial files. The
+# names sort in creation order.
+class Outbox:
+    def __init__(self, path, compress=False):
+        self.path = Path(path)
+        self.compress = compress
+        self.tmp_path = self.path / "tmp"
+        self.outgoing_path = self.path / "outgoing"
+        self.failed_path = self.path / "failed"
+
+        for directory in [
+            self.tmp_path,
+            self.outgoing_path,
+            self.failed_path,
+        ]:
+            directory.mkdir(parents=True, exist_ok=True)
+
+    def add(self, payload):
+        suffix = ".json.gz" if self.compress else ".json"
+        name = (
+            f"{datetime.utcnow().strftime('%Y%m%d%H%M%S%f')}-"
+            f"{next(MESSAGE_COUNTER):06d}-{os.getpid()}{suffix}"
+        )
+        data = json.dumps(payload).encode("utf-8")
+        if self.compress:
+            data = gzip.compress(data)
+
+        tmp_file = self.tmp_path / name
+        with open(tmp_file, "wb") as element:
+            element.write(data)
+            element.flush()
+            os.fsync(element.fileno())
+        os.replace(tmp_file, self.outgoing_path / name)
+        logging.debug(f"Spooled {name}")
+
+        return name
+
+    def elements(self):
+        return sorted(p.name for p in self.outgoing_path.iterdir())
+
+    def __len__(self):
+        return len(self.elements())
+
+    def read(self, name):
+        with open(self.outgoing_path / name, "rb") as element:
+            data = element.read()
+        if name.endswith(".gz"):
+            data = gzip.decompress(data)
+
+        return json.loads(data)
+
+    def remove(self, name):
+        (self.outgoing_path / name).unlink()
+
+    def quarantine(self, name):
+        os.replace(self.outgoing_path / name, self.failed_path / name)
+
+    # Elements are sent strictly in order and the drain stops at the first
+    # failure, as a resent older summary would replace a newer one. The lock
+    # keeps the drainer of the publish daemon and a republish or backfill
+    # run from sending the same element twice.
+    def drain(self, tokens):
+        with open(self.path / "lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            for name in self.elements():
+                try:
+                    payload = self.read(name)
+                except (OSError, ValueError) as e:
+                    logging.error(f"Moving unreadable {name} to failed: {e}")
+                    self.quarantine(name)
+                    continue
+
+                try:
+                    post = tokens.send_payload(payload)
+                except requests.RequestException as e:
+                    logging.warning(f"Sending {name} failed: {e}")
+                    return False
+
+                if is_retryable(post.status_code):
+                    logging.warning(
+                        f"Sending {name} failed with status {post.status_code}"
+                    )
+                    return False
+
+                if not 200 <= post.status_code < 300:
+                    logging.error(
+                        f"Moving {name} to failed, it was rejected with "
+                        f"status {post.status_code}"
+                    )
+                    self.quarantine(name)
+                    continue
+
+                self.remove(name)
+                logging.debug(f"Delivered {name}")
+
+        return True
+
+
+class OutboxDrainer(threading.Thread):
+    def __init__(
+        self, outbox, tokens, poll_interval=10, min_backoff=10, max_backoff=600
+    ):
+        super().__init__(daemon=True)
+        self.outbox = outbox
+        self.tokens = tokens
+        self.poll_interval = poll_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.failures = 0
+
+    def get_backoff(self):
+        return min(
+            self.max_backoff, self.min_backoff * 2 ** (self.failures - 1)
+        )
+
+    def drain(self):
+        try:
+            delivered = self.outbox.drain(self.tokens)
+        except Exception as e:
+            logging.error(f"Draining the outbox failed: {e}")
+            delivered = False
+
+        if delivered:
+            self.failures = 0
+        else:
+            self.failures += 1
+
+        return delivered
+
+    def run(self):
+        while not self.stopped.is_set():
+            if self.drain():
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+            else:
+                backoff = self.get_backoff()
+                logging.info(f"Retrying outbox delivery in {backoff} s")
+                self.stopped.wait(backoff)
+
+    def notify(self):
+        self.wakeup.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        self.join()
+
+
+def create_outbox(config):
+    outbox_path = config.get("paths", "outbox_path", fallback=None)
+    if outbox_path is None:
+        return None
+
+    compress = config.getboolean("messages", "outbox_compress", fallback=False)
+
+    return Outbox(outbox_path, compress)
+
+
+def create_drainer(config, outbox, tokens):
+    poll_interval = config.getfloat(
+        "messages", "outbox_poll_interval", fallback=10
+    )
+    min_backoff = config.getfloat(
+        "messages", "outbox_min_backoff", fallback=10
+    )
+    max_backoff = config.getfloat(
+        "messages", "outbox_max_backoff", fallback=600
+    )
+
+    return OutboxDrainer(
+        outbox, tokens, poll_interval, min_backoff, max_backoff
+    )
+
+
+def send_payload(config, token, payload, session=None):
+    ams_url = config["authentication"].get("ams_url")
+
+    logging.debug(f"{ams_url}{token}")
+    with use_session(config, session) as session:
+        post = session.post(
+            f"{ams_url}{token}",
+            json=payload,
+            headers={"Content-Type": "application/json"},
+        )
+
+    return post
+
+
+# Local copy of the extracted rows of the last retention seconds. It is kept
+# up to date by incremental fetches, so cycles and republishing can read from
+# it instead of fetching the records from AUDITOR again.
+class RecordMirror:
+    def __init__(self, path, retention, overlap=3600):
+        self.retention = retention
+        self.overlap = overlap
+
+        try:
+            # The async publish loop reads from executor threads, one at a
+            # time
+            self.conn = sqlite3.connect(
+                path, timeout=30, check_same_thread=False
+            )
+            cur = self.conn.cursor()
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS records(
+                    site TEXT NOT NULL,
+                    submithost TEXT NOT NULL,
+                    vo TEXT,
+                    vogroup TEXT,
+                    vorole TEXT,
+                    infrastructure TEXT NOT NULL,
+                    year INTEGER NOT NULL,
+                    month INTEGER NOT NULL,
+                    cpucount INTEGER NOT NULL,
+                    nodecount INTEGER NOT NULL,
+                    recordid TEXT PRIMARY KEY,
+                    runtime INTEGER NOT NULL,
+                    normruntime REAL NOT NULL,
+                    cputime INTEGER NOT NULL,
+                    normcputime REAL NOT NULL,
+                    starttime REAL NOT NULL,
+                    stoptime REAL NOT NULL,
+                    user TEXT,
+                    benchmarktype TEXT NOT NULL,
+                    benchmarkvalue REAL NOT NULL
+                )
+                """)
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS records_stoptime "
+                "ON records(stoptime)"
+            )
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS records_partition "
+                "ON records(site, year, month)"
+            )
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS mirror(
+                    kept_since REAL NOT NULL,
+                    synced_until REAL
+                )
+                """)
+            cur.execute("SELECT COUNT(*) FROM mirror")
+            if cur.fetchone()[0] == 0:
+                kept_since = datetime.now(tz=pytz.utc) - timedelta(
+                    seconds=retention
+                )
+                cur.execute(
+                    "INSERT INTO mirror(kept_since) VALUES(?)",
+                    (kept_since.timestamp(),),
+                )
+            self.conn.commit()
+            cur.close()
+        except Error as e:
+            logging.critical(e)
+            raise
+
+    def get_state(self):
+        try:
+            cur = self.conn.cursor()
+            cur.execute("SELECT kept_since, synced_until FROM mirror")
+            state = cur.fetchone()
+            cur.close()
+        except Error as e:
+            logging.critical(e)
+            raise
+
+        return state
+
+    # Records stopped shortly before the last sync may only show up in
+    # AUDITOR later, so the next fetch overlaps the previous one
+    def get_sync_start(self):
+        kept_since, synced_until = self.get_state()
+        if synced_until is None:
+            return datetime.fromtimestamp(kept_since, tz=pytz.utc)
+
+        return datetime.fromtimestamp(
+            max(kept_since, synced_until - self.overlap), tz=pytz.utc
+        )
+
+    def covers(self, start_time):
+        kept_since, synced_until = self.get_state()
+
+        return synced_until is not None and start_time.timestamp() >= (
+            kept_since
+        )
+
+    def add(self, config, records):
+        insert_sql = (
+            "INSERT OR REPLACE INTO records "
+            f"VALUES({', '.join('?' * len(ApelRecord._fields))})"
+        )
+        extractor = RecordExtractor(config)
+        rows = extractor.summary_rows(records)
+        latest_stop_time = 0.0
+        count = 0
+
+        try:
+            cur = self.conn.cursor()
+            for page in iter(lambda: list(islice(rows, 10000)), []):
+                cur.executemany(insert_sql, page)
+                latest_stop_time = max(
+                    latest_stop_time, max(r.stoptime for r in page)
+                )
+                count += len(page)
+            cur.execute(
+                "UPDATE mirror SET synced_until = "
+                "MAX(IFNULL(synced_until, kept_since), ?)",
+                (latest_stop_time,),
+            )
+            self.conn.commit()
+            cur.close()
+        except Error as e:
+            logging.critical(e)
+            raise
+
+        logging.debug(f"Meta cache statistics: {extractor.cache_info()}")
+
+        return count
+
+    def prune(self, current_time=None):
+        if current_time is None:
+            current_time = datetime.now(tz=pytz.utc)
+        cutoff = current_time.timestamp() - self.retention
+
+        try:
+            cur = self.conn.cursor()
+            cur.execute("DELETE FROM records WHERE stoptime < ?", (cutoff,))
+            pruned = cur.rowcount
+            cur.execute(
+                "UPDATE mirror SET kept_since = MAX(kept_since, ?)", (cutoff,)
+            )
+            self.conn.commit()
+            cur.close()
+        except Error as e:
+            logging.critical(e)
+            raise
+
+        return pruned
+
+    def query(self, sql, parameters=()):
+        try:
+            cur = self.conn.cursor()
+            cur.row_factory = lambda cursor, row: ApelRecord(*row)
+            cur.execute(sql, parameters)
+            while True:
+                page = cur.fetchmany(10000)
+                if not page:
+                    break
+                yield from page
+            cur.close()
+        except Error as e:
+            logging.critical(e)
+            raise
+
+    def stream(self, start_time, end_time=None):
+        return MirrorStream(self, start_time, end_time)
+
+    def select(self, partitions):
+        for partition in sorted(partitions):
+            yield from self.query(
+                "SELECT * FROM records "
+                "WHERE site = ? AND year = ? AND month = ?",
+                partition,
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+# Rows stopped after start_time (and before end_time), with the latest stop
+# time known up front like for a RecordStream
+class MirrorStream:
+    def __init__(self, mirror, start_time, end_time=None):
+        self.mirror = mirror
+        self.filter = "stoptime > ?"
+        self.parameters = (start_time.timestamp(),)
+        if end_time is not None:
+            self.filter += " AND stoptime < ?"
+            self.parameters += (end_time.timestamp(),)
+
+        try:
+            cur = mirror.conn.cursor()
+            cur.execute(
+                f"SELECT MAX(stoptime) FROM records WHERE {self.filter}",
+                self.parameters,
+            )
+            latest_stop_time = cur.fetchone()[0]
+            cur.close()
+        except Error as e:
+            logging.critical(e)
+            raise
+
+        self.latest_stop_time = None
+        if latest_stop_time is not None:
+            self.latest_stop_time = EPOCH + timedelta(seconds=latest_stop_time)
+
+    def __iter__(self):
+        return self.mirror.query(
+            f"SELECT * FROM records WHERE {self.filter} ORDER BY stoptime",
+            self.parameters,
+        )
+
+
+# A timed out sync keeps the mirrored records, the next poll catches up
+def sync_mirror(config, client, mirror):
+    try:
+        records = get_records(client, mirror.get_sync_start(), 30)
+    except AuditorTimeoutError as e:
+        logging.warning(f"Syncing the record mirror timed out: {e}")
+        return
+    count = mirror.add(config, records)
+    pruned = mirror.prune()
+    logging.debug(f"Mirrored {count} record(s), pruned {pruned}")
+
+
+# Converting and inserting the records would block the event loop
+async def sync_mirror_async(config, client, mirror):
+    try:
+        records = await get_records_async(client, mirror.get_sync_start(), 30)
+    except AuditorTimeoutError as e:
+        logging.warning(f"Syncing the record mirror timed out: {e}")
+        return
+    loop = asyncio.get_running_loop()
+    count = await loop.run_in_executor(None, mirror.add, config, records)
+    pruned = await loop.run_in_executor(None, mirror.prune)
+    logging.debug(f"Mirrored {count} record(s), pruned {pruned}")
+
+
+def create_mirror(config):
+    mirror_db_path = config.get("paths", "mirror_db_path", fallback=None)
+    if mirror_db_path is None:
+        return None
+
+    retention = config.getint(
+        "intervals", "mirror_retention", fallback=8640000
+    )
+    overlap = config.getint("intervals", "seen_retention", fallback=3600)
+
+    return RecordMirror(mirror_db_path, retention, overlap)
+
+
+def get_mirror_poll_interval(config):
+    return config.getfloat("intervals", "mirror_poll_interval", fallback=60)
+
+
+# Keeps the mirror up to date between the reports. The thread has its own
+# connection to the mirror.
+class MirrorPoller(threading.Thread):
+    def __init__(self, config, client, poll_interval=60):
+        super().__init__(daemon=True)
+        self.config = config
+        self.client = client
+        self.poll_interval = poll_interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        mirror = create_mirror(self.config)
+
+        while not self.stopped.is_set():
+            try:
+                sync_mirror(self.config, self.client, mirror)
+            except Exception as e:
+                logging.error(f"Syncing the record mirror failed: {e}")
+            self.stopped.wait(self.poll_interval)
+
+        mirror.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+async def poll_mirror_async(config, client, mirror, poll_interval):
+    while True:
+        try:
+            await sync_mirror_async(config, client, mirror)
+        except Exception as e:
+            logging.error(f"Syncing the record mirror failed: {e}")
+        await asyncio.sleep(poll_interval)
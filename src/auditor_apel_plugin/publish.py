@@ -4,107 +4,660 @@
 # SPDX-License-Identifier: BSD-2-Clause-Patent
 
 import logging
+import sys
 from pyauditor import AuditorClientBuilder
 from datetime import datetime, timedelta
 import pytz
 import configparser
 import argparse
-import base64
+import asyncio
 from time import sleep
 from auditor_apel_plugin.core import (
-    get_token,
+    TokenManager,
+    create_session,
     get_time_db,
     get_report_time,
     get_start_time,
-    create_summary_db,
-    group_summary_db,
-    create_summary,
-    sign_msg,
-    build_payload,
-    send_payload,
+    group_summary,
+    group_combined,
+    get_slice_length,
+    is_backlog,
+    SliceSpool,
+    create_summary_chunks,
+    create_publisher,
+    is_delivered,
+    create_outbox,
+    create_drainer,
+    get_message_limits,
+    MessageSigner,
     update_time_db,
     get_begin_previous_month,
     create_sync_db,
     group_sync_db,
-    create_sync,
-    get_records,
+    create_sync_chunks,
+    RecordStream,
+    AsyncRecordStream,
+    get_new_records,
+    get_new_records_async,
+    filter_reported_records,
+    create_mirror,
+    sync_mirror,
+    sync_mirror_async,
+    AuditorTimeoutError,
+    get_mirror_poll_interval,
+    MirrorPoller,
+    poll_mirror_async,
+    get_seen_index,
+    get_aggregate_db,
+    get_aggregate_start_time,
+    update_aggregate_db,
+    group_aggregate_db,
+    get_sync_start_time,
+    seed_sync_db,
+    freeze_sync_db,
+    group_sync_store,
+    ApelRecord,
 )
 
 
+# Records of the mirror are already extracted
+def get_stop_timestamp(record):
+    if type(record) is ApelRecord:
+        return record.stoptime
+
+    return record.stop_time.replace(tzinfo=pytz.utc).timestamp()
+
+
+def group_seed_sync(config, records, sync_since):
+    sync_since_stamp = sync_since.timestamp()
+    sync_db = create_sync_db(
+        config,
+        (r for r in records if get_stop_timestamp(r) < sync_since_stamp),
+    )
+
+    return group_sync_db(sync_db)
+
+
+# With a mirror that holds the window, the records are read from the local
+# copy instead of being fetched from AUDITOR
+def get_record_stream(client, mirror, start_time, page_size, records=None):
+    if mirror is not None and mirror.covers(start_time):
+        return mirror.stream(start_time)
+
+    return RecordStream(client, start_time, 30, page_size, records)
+
+
+async def get_record_stream_async(
+    client, mirror, start_time, page_size, records=None
+):
+    if mirror is not None and mirror.covers(start_time):
+        return mirror.stream(start_time)
+
+    stream = AsyncRecordStream(client, start_time, 30, page_size, records)
+    if records is None:
+        await stream.prefetch()
+
+    return stream
+
+
+def get_new_rows(client, mirror, start_time):
+    if mirror is not None and mirror.covers(start_time):
+        return list(mirror.stream(start_time))
+
+    return get_new_records(client, start_time, 30)
+
+
+async def get_new_rows_async(client, mirror, start_time):
+    if mirror is not None and mirror.covers(start_time):
+        return list(mirror.stream(start_time))
+
+    return await get_new_records_async(client, start_time, 30)
+
+
+# The poller may be a poll interval behind. If AUDITOR cannot be reached,
+# the cycle goes on with what the mirror holds.
+def update_mirror(client, mirror, config):
+    if mirror is None:
+        return
+
+    try:
+        sync_mirror(config, client, mirror)
+    except RuntimeError as e:
+        logging.warning(f"Syncing the record mirror failed: {e}")
+
+
+async def update_mirror_async(client, mirror, config):
+    if mirror is None:
+        return
+
+    try:
+        await sync_mirror_async(config, client, mirror)
+    except RuntimeError as e:
+        logging.warning(f"Syncing the record mirror failed: {e}")
+
+
+# Late records may stop before the last end time, which must never move
+# backwards
+def get_end_time(records, start_time):
+    if records.latest_stop_time is None:
+        return start_time
+
+    return max(start_time, records.latest_stop_time.replace(tzinfo=pytz.utc))
+
+
+# With an outbox the messages only need to be spooled, the drainer delivers
+# them in the background
+def send_messages(publisher, outbox, msgs):
+    if outbox is None:
+        statuses = publisher.publish(msgs)
+        if not is_delivered(statuses):
+            logging.error(f"Not all messages were delivered: {statuses}")
+            return False
+    else:
+        names = publisher.spool(msgs, outbox)
+        logging.info(f"Spooled {len(names)} payload(s) to the outbox")
+
+    return True
+
+
+# The report cycle below is a generator that yields the steps which touch
+# AUDITOR, the AMS or take long, and receives their results. The blocking
+# and the asyncio loop only differ in how they perform these steps:
+#   ("mirror", config)                          -> None
+#   ("probe", start_time)                       -> new records
+#   ("fetch", start_time, page_size, records)   -> record stream
+#   ("send", msgs)                              -> delivered
+#   ("post", msgs)                              -> pending delivery
+#   ("wait", pending)                           -> delivered
+#   ("run", func, *args)                        -> func(*args)
+# A posted send overlaps the steps up to its wait in the asyncio loop, the
+# blocking loop sends it right away.
+FETCH_STEPS = {
+    "mirror": (update_mirror, update_mirror_async),
+    "probe": (get_new_rows, get_new_rows_async),
+    "fetch": (get_record_stream, get_record_stream_async),
+}
+
+
+class CycleRunner:
+    def __init__(
+        self, client, mirror, publisher, outbox, drainer=None, session=None
+    ):
+        self.client = client
+        self.mirror = mirror
+        self.publisher = publisher
+        self.outbox = outbox
+        self.drainer = drainer
+        self.session = session
+
+    def run(self, cycle):
+        result = None
+
+        while True:
+            try:
+                kind, *args = cycle.send(result)
+            except StopIteration as stop:
+                return stop.value
+
+            if kind in ("send", "post"):
+                result = send_messages(self.publisher, self.outbox, *args)
+            elif kind == "wait":
+                result = args[0]
+            elif kind == "run":
+                func, *args = args
+                result = func(*args)
+            else:
+                result = FETCH_STEPS[kind][0](self.client, self.mirror, *args)
+
+    async def run_async(self, cycle):
+        loop = asyncio.get_running_loop()
+        result = None
+
+        while True:
+            try:
+                kind, *args = cycle.send(result)
+            except StopIteration as stop:
+                return stop.value
+
+            if kind == "send":
+                result = await loop.run_in_executor(
+                    None, send_messages, self.publisher, self.outbox, *args
+                )
+            elif kind == "post":
+                result = loop.run_in_executor(
+                    None, send_messages, self.publisher, self.outbox, *args
+                )
+            elif kind == "wait":
+                result = await args[0]
+            elif kind == "run":
+                result = await loop.run_in_executor(None, *args)
+            else:
+                result = await FETCH_STEPS[kind][1](
+                    self.client, self.mirror, *args
+                )
+
+    # Wake up the drainer for the payloads spooled by the last cycle
+    def notify(self):
+        if self.drainer is not None:
+            self.drainer.notify()
+
+    def close(self):
+        if self.drainer is not None:
+            self.drainer.stop()
+        self.publisher.close()
+        if self.session is not None:
+            self.session.close()
+        if self.mirror is not None:
+            self.mirror.close()
+
+
+def get_stored_sync_list(
+    config, conn, begin_previous_month, page_size, commit=True
+):
+    sync_since = get_sync_start_time(conn)
+
+    if sync_since > begin_previous_month:
+        logging.info(
+            f"Sync counts start at {sync_since}, "
+            f"seeding them from {begin_previous_month}"
+        )
+        records_sync = yield ("fetch", begin_previous_month, page_size, None)
+        grouped_sync_list = yield (
+            "run",
+            group_seed_sync,
+            config,
+            records_sync,
+            sync_since,
+        )
+        seed_sync_db(conn, grouped_sync_list, begin_previous_month, commit)
+
+    freeze_sync_db(conn, begin_previous_month, commit)
+
+    return group_sync_store(conn)
+
+
+# A backlog in the aggregate store is published one stop time window after
+# the other. Every window carries the running totals, so it does not replace
+# the summaries of an earlier one. The checkpoint is committed after every
+# window, so an interrupted catch-up resumes after the last completed one.
+def publish_slices(
+    config, slices, start_time, seen, time_db_conn, aggregate_db_conn
+):
+    max_message_size, _ = get_message_limits(config)
+    end_time = start_time.timestamp()
+
+    for n, (slice_end, rows) in enumerate(slices, 1):
+        grouped_summary_list = yield (
+            "run",
+            group_summary,
+            config,
+            seen.filter(rows),
+        )
+        if not seen.has_pending():
+            continue
+
+        end_time = max(end_time, slice_end)
+        logging.info(
+            f"Publishing slice {n}/{len(slices)} up to "
+            f"{datetime.fromtimestamp(end_time, tz=pytz.utc)}"
+        )
+
+        update_aggregate_db(
+            aggregate_db_conn, grouped_summary_list, end_time, commit=False
+        )
+        grouped_summary_list = group_aggregate_db(aggregate_db_conn)
+
+        if not (
+            yield (
+                "send",
+                create_summary_chunks(grouped_summary_list, max_message_size),
+            )
+        ):
+            aggregate_db_conn.rollback()
+            seen.discard()
+            return False
+
+        # Commits the merged slice as well
+        seen.save(end_time)
+        update_time_db(time_db_conn, end_time, datetime.now())
+
+    return True
+
+
+# Returns True for an idle cycle without new records
+def report_cycle(config, time_db_conn, current_time, idle=False):
+    aggregate_db_path = config.get("paths", "aggregate_db_path", fallback=None)
+    page_size = config.getint("auditor", "page_size", fallback=10000)
+    max_message_size, _ = get_message_limits(config)
+
+    yield ("mirror", config)
+
+    start_time = get_start_time(time_db_conn)
+    begin_previous_month = get_begin_previous_month(current_time)
+
+    if aggregate_db_path is not None:
+        aggregate_db_conn = get_aggregate_db(start_time, aggregate_db_path)
+        try:
+            return (
+                yield from store_cycle(
+                    config,
+                    time_db_conn,
+                    aggregate_db_conn,
+                    begin_previous_month,
+                    page_size,
+                    max_message_size,
+                )
+            )
+        finally:
+            aggregate_db_conn.close()
+
+    seen = get_seen_index(config, time_db_conn)
+    summary_since = seen.load(start_time)
+    fetch_since = min(summary_since, begin_previous_month)
+    new_records = None
+
+    # While no records arrive, a probe of the summary window saves the fetch
+    # of the whole sync window. After a busy cycle the probe would only
+    # double the fetches. It already holds all records if the sync window
+    # does not reach further back. Records of sites that are not reported
+    # are never seen, so they must not end the idle phase.
+    if idle or fetch_since == summary_since:
+        new_records = yield ("probe", summary_since)
+        reported_records = yield (
+            "run",
+            filter_reported_records,
+            config,
+            new_records,
+        )
+        if not seen.has_unseen(reported_records):
+            logging.info("No new records, do nothing for now")
+            return True
+        if fetch_since < summary_since:
+            new_records = None
+
+    logging.info(f"Getting records since {fetch_since}")
+    records = yield ("fetch", fetch_since, page_size, new_records)
+
+    grouped_summary_list, grouped_sync_list = yield (
+        "run",
+        group_combined,
+        config,
+        records,
+        summary_since,
+        begin_previous_month,
+        seen,
+    )
+
+    if not seen.has_pending():
+        logging.info("No new records, do nothing for now")
+        return True
+
+    latest_stop_time = get_end_time(records, start_time)
+    logging.debug(f"Latest stop time is {latest_stop_time}")
+
+    pending = yield (
+        "post",
+        create_summary_chunks(grouped_summary_list, max_message_size),
+    )
+    delivered = yield (
+        "send",
+        create_sync_chunks(grouped_sync_list, max_message_size),
+    )
+    delivered &= yield ("wait", pending)
+
+    if delivered:
+        seen.save(latest_stop_time.timestamp())
+        update_time_db(
+            time_db_conn, latest_stop_time.timestamp(), datetime.now()
+        )
+    else:
+        seen.discard()
+        logging.error(
+            "Not all messages were delivered, keeping the start time at "
+            f"{start_time}"
+        )
+
+    return False
+
+
+def store_cycle(
+    config,
+    time_db_conn,
+    aggregate_db_conn,
+    begin_previous_month,
+    page_size,
+    max_message_size,
+):
+    slice_length = get_slice_length(config)
+    start_time = get_aggregate_start_time(aggregate_db_conn)
+    seen = get_seen_index(config, aggregate_db_conn)
+    summary_since = seen.load(start_time)
+    logging.info(f"Getting records since {summary_since}")
+    records = yield ("fetch", summary_since, page_size, None)
+
+    if is_backlog(summary_since, slice_length):
+        slices = yield (
+            "run",
+            SliceSpool,
+            config,
+            records,
+            summary_since,
+            slice_length,
+            seen,
+        )
+        try:
+            if not slices:
+                logging.info("No new records, do nothing for now")
+                return True
+
+            logging.info(f"Catching up on a backlog of {len(slices)} slice(s)")
+            delivered = yield from publish_slices(
+                config,
+                slices,
+                start_time,
+                seen,
+                time_db_conn,
+                aggregate_db_conn,
+            )
+        finally:
+            slices.close()
+
+        grouped_sync_list = yield from get_stored_sync_list(
+            config, aggregate_db_conn, begin_previous_month, page_size
+        )
+        delivered &= yield (
+            "send",
+            create_sync_chunks(grouped_sync_list, max_message_size),
+        )
+        if not delivered:
+            logging.error(
+                "Not all messages were delivered, resuming after the last "
+                "completed slice"
+            )
+        return False
+
+    grouped_summary_list = yield (
+        "run",
+        group_summary,
+        config,
+        seen.filter(records),
+    )
+
+    if not seen.has_pending():
+        logging.info("No new records, do nothing for now")
+        return True
+
+    latest_stop_time = get_end_time(records, start_time)
+    logging.debug(f"Latest stop time is {latest_stop_time}")
+
+    update_aggregate_db(
+        aggregate_db_conn,
+        grouped_summary_list,
+        latest_stop_time.timestamp(),
+        commit=False,
+    )
+    grouped_summary_list = group_aggregate_db(aggregate_db_conn)
+
+    # The sync counts are built and sent while the summaries are posted.
+    # Nothing is committed before the summaries were delivered, otherwise
+    # the records are merged and sent again in the next cycle.
+    pending = yield (
+        "post",
+        create_summary_chunks(grouped_summary_list, max_message_size),
+    )
+    grouped_sync_list = yield from get_stored_sync_list(
+        config, aggregate_db_conn, begin_previous_month, page_size, False
+    )
+    sync_delivered = yield (
+        "send",
+        create_sync_chunks(grouped_sync_list, max_message_size),
+    )
+
+    if (yield ("wait", pending)):
+        seen.save(latest_stop_time.timestamp())
+        update_time_db(
+            time_db_conn, latest_stop_time.timestamp(), datetime.now()
+        )
+    else:
+        aggregate_db_conn.rollback()
+        seen.discard()
+        logging.error(
+            "Not all messages were delivered, keeping the start time at "
+            f"{start_time}"
+        )
+
+    if not sync_delivered:
+        logging.error(
+            "Not all sync messages were delivered, they are sent again with "
+            "the next report"
+        )
+
+    return False
+
+
+def create_runner(config, client):
+    client_cert = config["authentication"].get("client_cert")
+    client_key = config["authentication"].get("client_key")
+    signer = MessageSigner(client_cert, client_key)
+    session = create_session(config)
+    tokens = TokenManager(config, session)
+    publisher = create_publisher(config, signer, tokens)
+    logging.debug(tokens.get())
+
+    outbox = create_outbox(config)
+    drainer = None
+    if outbox is not None:
+        drainer = create_drainer(config, outbox, tokens)
+        drainer.start()
+
+    mirror = create_mirror(config)
+
+    return CycleRunner(client, mirror, publisher, outbox, drainer, session)
+
+
+# Returns the seconds until the next report is due
+def get_report_wait(time_db_conn, report_interval, current_time):
+    last_report_time = get_report_time(time_db_conn)
+    time_since_report = (current_time - last_report_time).total_seconds()
+
+    if time_since_report < report_interval:
+        logging.info("Not enough time since last report")
+        return report_interval - time_since_report
+
+    logging.info("Enough time since last report, create new report")
+
+    return 0
+
+
 def run(config, client):
     report_interval = config["intervals"].getint("report_interval")
     time_db_path = config["paths"].get("time_db_path")
     publish_since = config["site"].get("publish_since")
-    client_cert = config["authentication"].get("client_cert")
-    client_key = config["authentication"].get("client_key")
-    token = get_token(config)
-    logging.debug(token)
+    runner = create_runner(config, client)
 
-    while True:
-        time_db_conn = get_time_db(publish_since, time_db_path)
-        last_report_time = get_report_time(time_db_conn)
-        current_time = datetime.now()
-        time_since_report = (current_time - last_report_time).total_seconds()
+    idle = False
+    poller = None
+    if runner.mirror is not None:
+        poller = MirrorPoller(config, client, get_mirror_poll_interval(config))
+        poller.start()
+
+    try:
+        while True:
+            time_db_conn = get_time_db(publish_since, time_db_path)
+            current_time = datetime.now()
+            wait = get_report_wait(time_db_conn, report_interval, current_time)
+
+            if wait == 0:
+                idle = runner.run(
+                    report_cycle(config, time_db_conn, current_time, idle)
+                )
+                runner.notify()
+                wait = report_interval
+                logging.info(
+                    "Next report scheduled for "
+                    f"{datetime.now() + timedelta(seconds=wait)}"
+                )
 
-        if time_since_report < report_interval:
-            logging.info("Not enough time since last report")
             time_db_conn.close()
-            sleep(report_interval - time_since_report)
-            continue
-        else:
-            logging.info("Enough time since last report, create new report")
+            sleep(wait)
+    finally:
+        if poller is not None:
+            poller.stop()
+        runner.close()
 
-        try:
-            start_time = get_start_time(time_db_conn)
-            logging.info(f"Getting records since {start_time}")
 
-            records_summary = get_records(client, start_time, 30)
+# Same cycle as run, but AUDITOR is queried with the async client and the
+# aggregation, signing and sending run in executor threads
+async def run_async(config, client):
+    report_interval = config["intervals"].getint("report_interval")
+    time_db_path = config["paths"].get("time_db_path")
+    publish_since = config["site"].get("publish_since")
+    runner = create_runner(config, client)
 
-            latest_stop_time = records_summary[-1].stop_time.replace(
-                tzinfo=pytz.utc
+    # The polling task uses its own connection, the one of the cycle is
+    # also used from executor threads
+    idle = False
+    poller = None
+    if runner.mirror is not None:
+        poller = asyncio.create_task(
+            poll_mirror_async(
+                config,
+                client,
+                create_mirror(config),
+                get_mirror_poll_interval(config),
             )
-            logging.debug(f"Latest stop time is {latest_stop_time}")
-            summary_db = create_summary_db(config, records_summary)
-            grouped_summary_list = group_summary_db(summary_db)
-            summary = create_summary(grouped_summary_list)
-            logging.debug(summary)
-            signed_summary = sign_msg(client_cert, client_key, summary)
-            logging.debug(signed_summary)
-            encoded_summary = base64.b64encode(signed_summary).decode("utf-8")
-            logging.debug(encoded_summary)
-            payload_summary = build_payload(encoded_summary)
-            logging.debug(payload_summary)
-            post_summary = send_payload(config, token, payload_summary)
-            logging.debug(post_summary.status_code)
-
-            begin_previous_month = get_begin_previous_month(current_time)
-            records_sync = get_records(client, begin_previous_month, 30)
-            sync_db = create_sync_db(config, records_sync)
-            grouped_sync_list = group_sync_db(sync_db)
-            sync = create_sync(grouped_sync_list)
-            logging.debug(sync)
-            signed_sync = sign_msg(client_cert, client_key, sync)
-            logging.debug(signed_sync)
-            encoded_sync = base64.b64encode(signed_sync).decode("utf-8")
-            logging.debug(encoded_sync)
-            payload_sync = build_payload(encoded_sync)
-            logging.debug(payload_sync)
-            post_sync = send_payload(config, token, payload_sync)
-            logging.debug(post_sync.status_code)
-
-            latest_report_time = datetime.now()
-            update_time_db(
-                time_db_conn, latest_stop_time.timestamp(), latest_report_time
-            )
-        except IndexError:
-            logging.info("No new records, do nothing for now")
-
-        time_db_conn.close()
-        logging.info(
-            "Next report scheduled for "
-            f"{datetime.now() + timedelta(seconds=report_interval)}"
         )
-        sleep(report_interval)
+        poller.add_done_callback(
+            lambda task: logging.error("Record mirror polling stopped")
+        )
+
+    try:
+        while True:
+            time_db_conn = get_time_db(publish_since, time_db_path)
+            current_time = datetime.now()
+            wait = get_report_wait(time_db_conn, report_interval, current_time)
+
+            if wait == 0:
+                idle = await runner.run_async(
+                    report_cycle(config, time_db_conn, current_time, idle)
+                )
+                runner.notify()
+                wait = report_interval
+                logging.info(
+                    "Next report scheduled for "
+                    f"{datetime.now() + timedelta(seconds=wait)}"
+                )
+
+            time_db_conn.close()
+            await asyncio.sleep(wait)
+    finally:
+        if poller is not None:
+            poller.cancel()
+        runner.close()
+
+
+async def main_async(config, builder):
+    await run_async(config, builder.build())
 
 
 def main():
@@ -140,12 +693,18 @@ def main():
     builder = builder.address(auditor_ip, auditor_port).timeout(
         auditor_timeout
     )
-    client = builder.build_blocking()
+    async_mode = config.getboolean("auditor", "async_mode", fallback=False)
 
     try:
-        run(config, client)
+        if async_mode:
+            asyncio.run(main_async(config, builder))
+        else:
+            run(config, builder.build_blocking())
     except KeyboardInterrupt:
         logging.critical("User abort")
+    except AuditorTimeoutError as e:
+        logging.critical(e)
+        sys.exit(1)
     finally:
         logging.critical("APEL plugin stopped")
 
@@ -4,70 +4,182 @@
 # SPDX-License-Identifier: BSD-2-Clause-Patent
 
 import logging
+import sys
 from pyauditor import AuditorClientBuilder
 import configparser
 import argparse
 from datetime import datetime
 import pytz
-import base64
 from auditor_apel_plugin.core import (
-    get_token,
-    create_summary_db,
-    group_summary_db,
-    create_summary,
-    sign_msg,
-    build_payload,
-    send_payload,
-    get_records,
+    TokenManager,
+    create_session,
+    group_summary,
+    create_summary_chunks,
+    create_publisher,
+    is_delivered,
+    create_outbox,
+    get_message_limits,
+    MessageSigner,
+    RecordStream,
+    select_partitions,
+    create_mirror,
+    sync_mirror,
+    AuditorTimeoutError,
 )
 
 
-def run(config, args, client):
-    client_cert = config["authentication"].get("client_cert")
-    client_key = config["authentication"].get("client_key")
+# Returns None for empty and comment lines
+def parse_partition(line):
+    fields = line.split("#", 1)[0].replace(",", " ").split()
+    if not fields:
+        return None
+
+    try:
+        site, year, month = fields
+        year, month = int(year), int(month)
+    except ValueError:
+        raise ValueError(f"expected SITE YEAR MONTH, got {line.strip()!r}")
+
+    if not 1 <= month <= 12:
+        raise ValueError(f"invalid month {month}")
+
+    return site, year, month
+
+
+# Partitions are read from a file with one "SITE YEAR MONTH" per line or
+# built from the sites and the month range of the command line
+def get_partitions(args):
+    partitions = set()
+
+    if args.partitions is not None:
+        with open(args.partitions) as f:
+            for number, line in enumerate(f, 1):
+                try:
+                    partition = parse_partition(line)
+                except ValueError as e:
+                    raise ValueError(f"{args.partitions}:{number}: {e}")
+                if partition is not None:
+                    partitions.add(partition)
+    else:
+        for site in args.site:
+            for month in args.month:
+                partitions.add((site, args.year, month))
+
+    if not partitions:
+        raise ValueError("no partitions to republish")
 
-    month = args.month
-    year = args.year
-    site = args.site
+    return partitions
 
-    begin_month = datetime(year, month, 1).replace(tzinfo=pytz.utc)
 
-    records = get_records(client, begin_month, 30)
-    token = get_token(config)
-    logging.debug(token)
+def get_end_of_month(year, month):
+    if month == 12:
+        return datetime(year + 1, 1, 1).replace(tzinfo=pytz.utc)
 
-    summary_db = create_summary_db(config, records)
-    grouped_summary_list = group_summary_db(
-        summary_db, filter_by=(month, year, site)
+    return datetime(year, month + 1, 1).replace(tzinfo=pytz.utc)
+
+
+def run(config, partitions, client):
+    client_cert = config["authentication"].get("client_cert")
+    client_key = config["authentication"].get("client_key")
+    signer = MessageSigner(client_cert, client_key)
+    session = create_session(config)
+    max_message_size, _ = get_message_limits(config)
+    page_size = config.getint("auditor", "page_size", fallback=10000)
+
+    logging.info(f"Republishing {sorted(partitions)}")
+
+    # One fetch covers all partitions, from the first day of the earliest
+    # month up to the end of the latest month
+    begin = min(
+        datetime(year, month, 1).replace(tzinfo=pytz.utc)
+        for _, year, month in partitions
     )
-    summary = create_summary(grouped_summary_list)
-    logging.debug(summary)
-    signed_summary = sign_msg(client_cert, client_key, summary)
-    logging.debug(signed_summary)
-    encoded_summary = base64.b64encode(signed_summary).decode("utf-8")
-    logging.debug(encoded_summary)
-    payload_summary = build_payload(encoded_summary)
-    logging.debug(payload_summary)
-    post_summary = send_payload(config, token, payload_summary)
-    logging.debug(post_summary.status_code)
+    end = max(get_end_of_month(year, month) for _, year, month in partitions)
+
+    # The partitions are read from the mirror if it reaches back far enough
+    mirror = create_mirror(config)
+    if mirror is not None and mirror.covers(begin):
+        logging.info("Reading the records from the mirror")
+        sync_mirror(config, client, mirror)
+        rows = mirror.select(partitions)
+    else:
+        logging.info(f"Getting records stopped between {begin} and {end}")
+        records = RecordStream(client, begin, 30, page_size, end_time=end)
+        rows = select_partitions(config, records, partitions)
+
+    tokens = TokenManager(config, session)
+    logging.debug(tokens.get())
+
+    grouped_summary_list = group_summary(config, rows)
+    if mirror is not None:
+        mirror.close()
+    publisher = create_publisher(config, signer, tokens)
+    outbox = create_outbox(config)
+    msgs = create_summary_chunks(grouped_summary_list, max_message_size)
+
+    if outbox is None:
+        statuses = publisher.publish(msgs)
+        if not is_delivered(statuses):
+            logging.error(f"Not all messages were delivered: {statuses}")
+    else:
+        publisher.spool(msgs, outbox)
+        if not outbox.drain(tokens):
+            logging.error(
+                f"{len(outbox)} payload(s) remain in the outbox for the "
+                "publish daemon"
+            )
+
+    publisher.close()
+    session.close()
+
+
+def month_range(value):
+    try:
+        first, dash, last = value.partition("-")
+        first = int(first)
+        last = int(last) if dash else first
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid month range: {value}")
+
+    if not 1 <= first <= last <= 12:
+        raise argparse.ArgumentTypeError(f"invalid month range: {value}")
+
+    return list(range(first, last + 1))
 
 
 def main():
     parser = argparse.ArgumentParser()
+    parser.add_argument("-y", "--year", type=int, help="Year: 2020, 2021, ...")
     parser.add_argument(
-        "-y", "--year", type=int, required=True, help="Year: 2020, 2021, ..."
+        "-m",
+        "--month",
+        type=month_range,
+        help="Month or range of months: 4, 8, 1-3, ...",
     )
     parser.add_argument(
-        "-m", "--month", type=int, required=True, help="Month: 4, 8, 12, ..."
+        "-s",
+        "--site",
+        nargs="+",
+        help="Site(s) (GOCDB): UNI-FREIBURG, ...",
     )
     parser.add_argument(
-        "-s", "--site", required=True, help="Site (GOCDB): UNI-FREIBURG, ..."
+        "-p",
+        "--partitions",
+        help="File with one SITE YEAR MONTH per line, replaces -y, -m, -s",
     )
     parser.add_argument(
         "-c", "--config", required=True, help="Path to the config file"
     )
     args = parser.parse_args()
 
+    if args.partitions is None and None in (args.year, args.month, args.site):
+        parser.error("-y, -m and -s are required without -p")
+
+    try:
+        partitions = get_partitions(args)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
     config = configparser.ConfigParser()
     config.read(args.config)
 
@@ -93,9 +205,12 @@ def main():
     client = builder.build_blocking()
 
     try:
-        run(config, args, client)
+        run(config, partitions, client)
     except KeyboardInterrupt:
         logging.critical("User abort")
+    except AuditorTimeoutError as e:
+        logging.critical(e)
+        sys.exit(1)
     finally:
         logging.info("Republishing finished")
 
@@ -13,31 +13,156 @@ from auditor_apel_plugin.core import (
     replace_record_string,
     get_records,
     get_site_id,
+    RecordStream,
+    group_summary_db,
+    get_aggregate_db,
+    get_aggregate_start_time,
+    update_aggregate_db,
+    group_aggregate_db,
+    create_sync_db,
+    group_sync_db,
+    get_sync_start_time,
+    seed_sync_db,
+    freeze_sync_db,
+    group_sync_store,
+    create_combined_db,
+    RecordExtractor,
+    group_summary,
+    group_combined,
+    create_summary,
+    create_sync,
+    compact_records,
+    ApelRecord,
+    write_summary,
+    write_sync,
+    MessageSigner,
+    create_session,
+    get_token,
+    send_payload,
+    TokenManager,
+    create_summary_chunks,
+    create_sync_chunks,
+    build_payloads,
+    MessagePublisher,
+    is_delivered,
+    Outbox,
+    OutboxDrainer,
+    get_records_async,
+    AsyncRecordStream,
+    get_new_records,
+    get_new_records_async,
+    filter_new_records,
+    filter_reported_records,
+    SeenIndex,
+    hash_record_id,
+    is_backlog,
+    SliceSpool,
+    partition_rows,
+    get_backfill_end_time,
+    get_backfilled_partitions,
+    mark_partition_backfilled,
+    clear_backfill,
+    select_partitions,
+    get_records_between,
+    filter_records_until,
+    RecordMirror,
+    sync_mirror,
+    sync_mirror_async,
+    AuditorTimeoutError,
 )
-from datetime import datetime
+from auditor_apel_plugin.backfill import (
+    run as run_backfill,
+    main as backfill_main,
+    hand_over,
+    get_hand_over_rows,
+)
+from auditor_apel_plugin.publish import CycleRunner, report_cycle
+from auditor_apel_plugin.republish import (
+    get_partitions,
+    month_range,
+    main as republish_main,
+)
+from datetime import datetime, timedelta
 import pytz
 import sqlite3
 import os
 import subprocess
 import configparser
 import pyauditor
-from unittest.mock import patch, PropertyMock
+from unittest.mock import patch, PropertyMock, MagicMock
 import ast
+import io
+import shutil
+import base64
+import requests
+from time import sleep
+import asyncio
+import argparse
+import fcntl
+import threading
+import re
+from types import SimpleNamespace
 
 
 class FakeAuditorClient:
-    def __init__(self, test_case=""):
+    def __init__(self, test_case="", records=None):
         self.test_case = test_case
+        self.records = records
 
     def get_stopped_since(self, start_time):
         if self.test_case == "pass":
             return "good"
+        if self.test_case == "records":
+            if start_time.tzinfo is not None:
+                start_time = start_time.astimezone(pytz.utc).replace(
+                    tzinfo=None
+                )
+            return [r for r in self.records if r.stop_time >= start_time]
         if self.test_case == "fail_timeout":
             raise RuntimeError("Request timed out")
         if self.test_case == "fail_else":
             raise RuntimeError("Other RuntimeError")
 
 
+class FakeAsyncAuditorClient(FakeAuditorClient):
+    async def get_stopped_since(self, start_time):
+        return super().get_stopped_since(start_time)
+
+
+# Records the sent messages. With an event, the delivery waits until it is
+# set and fails if that takes too long. With a limit, only the first limit
+# sends are delivered.
+class FakePublisher:
+    def __init__(self, status_code=200, released=None, limit=None):
+        self.status_code = status_code
+        self.released = released
+        self.limit = limit
+        self.sent = []
+
+    def publish(self, msgs):
+        msgs = list(msgs)
+        delivered = self.released is None or self.released.wait(5)
+        if self.limit is not None and len(self.sent) >= self.limit:
+            delivered = False
+        self.sent.append(msgs)
+        status_code = self.status_code if delivered else None
+        return [SimpleNamespace(status_code=status_code) for _ in msgs]
+
+    def close(self):
+        pass
+
+
+# Sums the jobs in the summary or sync messages of a fake publisher
+def count_jobs(sent, kind="summary"):
+    return sum(
+        int(n)
+        for msgs in sent
+        for m in msgs
+        if m.startswith(f"APEL-{kind}")
+        for n in re.findall(r"NumberOfJobs: (\d+)", m)
+    )
+
+
 def create_rec_metaless(rec_values, conf):
     rec = pyauditor.Record(rec_values["rec_id"], rec_values["start_time"])
     rec.with_stop_time(rec_values["stop_time"])
@@ -89,6 +214,53 @@ def create_rec(rec_values, conf):
     return rec
 
 
+def create_conf():
+    conf = configparser.ConfigParser()
+    conf["site"] = {
+        "site_name_mapping": (
+            '{"test-site-1": "TEST_SITE_1", "test-site-2": "TEST_SITE_2"}'
+        ),
+        "sites_to_report": '["test-site-1", "test-site-2"]',
+        "default_submit_host": "https://default.submit_host.de:1234/xxx",
+        "infrastructure_type": "grid",
+        "benchmark_type": "hepscore23",
+    }
+    conf["auditor"] = {
+        "benchmark_name": "hepscore",
+        "cores_name": "Cores",
+        "cpu_time_name": "TotalCPU",
+        "nnodes_name": "NNodes",
+        "meta_key_site": "site_id",
+        "meta_key_submithost": "headnode",
+        "meta_key_voms": "voms",
+        "meta_key_username": "subject",
+    }
+
+    return conf
+
+
+def create_rec_list(n_records, conf, start_day=1):
+    records = []
+
+    for idx in range(n_records):
+        rec_values = {
+            "rec_id": f"test_record_{start_day}_{idx}",
+            "start_time": datetime(2023, 1, start_day, 0, 0, 0),
+            "stop_time": datetime(2023, 1, start_day, 1, idx % 60, 0),
+            "n_cores": 1 + idx % 2,
+            "hepscore": 10.0,
+            "tot_cpu": 100 + idx,
+            "n_nodes": 1,
+            "site": f"test-site-{1 + idx % 2}",
+            "submit_host": "https:%2F%2Ftest1.submit_host.de:1234%2Fxxx",
+            "user_name": f"%2FDC=ch%2FDC=cern%2FCN=test{idx % 3}: test",
+            "voms": "%2Fatlas%2Fde%2FRole=production",
+        }
+        records.append(create_rec(rec_values, conf["auditor"]))
+
+    return records
+
+
 class TestAuditorApelPlugin:
     def test_get_begin_previous_month(self):
         time_a = datetime(2022, 10, 23, 12, 23, 55)
@@ -184,6 +356,161 @@ class TestAuditorApelPlugin:
 
         assert process.returncode == 0
 
+    def test_message_signer(self):
+        cert = "/tmp/test_signer.cert"
+        key = "/tmp/test_signer.key"
+        shutil.copy("tests/test_cert.cert", cert)
+        shutil.copy("tests/test_key.key", key)
+
+        signer = MessageSigner(cert, key)
+        bashCommand = "openssl smime -verify -in /tmp/signed_msg.txt -noverify"
+
+        for msg in ["test", "another test"]:
+            result = signer.sign(msg)
+
+            with open("/tmp/signed_msg.txt", "wb") as msg_file:
+                msg_file.write(result)
+
+            process = subprocess.Popen(
+                bashCommand.split(),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            stdout, _ = process.communicate()
+
+            assert process.returncode == 0
+            assert msg in stdout.decode()
+
+        loaded_cert = signer.cert
+        signer.sign("test")
+        assert signer.cert is loaded_cert
+
+        stat = os.stat(cert)
+        os.utime(cert, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        signer.sign("test")
+        assert signer.cert is not loaded_cert
+        assert signer.cert == loaded_cert
+
+        os.remove(key)
+        with pytest.raises(FileNotFoundError):
+            signer.sign("test")
+        os.remove(cert)
+
+    def test_create_session(self):
+        conf = create_conf()
+        conf["authentication"] = {
+            "auth_url": "https://auth.test/token",
+            "ams_url": "https://ams.test/publish?key=",
+            "client_cert": "tests/test_cert.cert",
+            "client_key": "tests/test_key.key",
+            "ca_path": "/etc/grid-security/certificates",
+            "verify_ca": "True",
+            "pool_size": "8",
+            "read_timeout": "30",
+        }
+
+        session = create_session(conf)
+        assert session.cert == ("tests/test_cert.cert", "tests/test_key.key")
+        assert session.verify == "/etc/grid-security/certificates"
+        assert session.timeout == (10, 30)
+        adapter = session.get_adapter("https://ams.test")
+        assert adapter._pool_connections == 8
+        assert adapter._pool_maxsize == 8
+
+        with patch("requests.Session.request") as request:
+            session.get("https://auth.test/token")
+            session.get("https://auth.test/token", timeout=5)
+        assert request.call_args_list[0][1]["timeout"] == (10, 30)
+        assert request.call_args_list[1][1]["timeout"] == 5
+        session.close()
+
+        conf["authentication"]["verify_ca"] = "False"
+        assert create_session(conf).verify is False
+
+        session = MagicMock()
+        session.get.return_value.json.return_value = {"token": "abc"}
+        assert get_token(conf, session) == "abc"
+        session.get.assert_called_once_with("https://auth.test/token")
+
+        send_payload(conf, "abc", {"messages": []}, session)
+        session.post.assert_called_once_with(
+            "https://ams.test/publish?key=abc",
+            json={"messages": []},
+            headers={"Content-Type": "application/json"},
+        )
+
+        with patch("requests.Session.request") as request:
+            request.return_value.json.return_value = {"token": "def"}
+            assert get_token(conf) == "def"
+        assert request.call_args[0] == ("GET", "https://auth.test/token")
+        assert request.call_args[1]["timeout"] == (10, 30)
+
+    def test_token_manager(self):
+        conf = create_conf()
+        cache_path = "/tmp/test_token.json"
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        conf["authentication"] = {
+            "auth_url": "https://auth.test/token",
+            "ams_url": "https://ams.test/publish?key=",
+            "token_lifetime": "3600",
+        }
+        conf["paths"] = {"token_cache_path": cache_path}
+
+        tokens = iter(["token-1", "token-2", "token-3"])
+        session = MagicMock()
+        session.get.side_effect = lambda url: MagicMock(
+            **{"json.return_value": {"token": next(tokens)}}
+        )
+        session.post.return_value.status_code = 200
+
+        manager = TokenManager(conf, session)
+        assert manager.get() == "token-1"
+        assert manager.get() == "token-1"
+        assert session.get.call_count == 1
+        assert oct(os.stat(cache_path).st_mode & 0o777) == "0o600"
+
+        other = TokenManager(conf, session)
+        assert other.get() == "token-1"
+        assert session.get.call_count == 1
+
+        manager.expires -= 3400
+        manager.save_cache()
+        assert manager.get() == "token-2"
+        assert session.get.call_count == 2
+
+        rejected = MagicMock(status_code=401)
+        accepted = MagicMock(status_code=200)
+        session.post.side_effect = [rejected, accepted]
+        assert manager.send_payload({"messages": []}) is accepted
+        assert session.get.call_count == 3
+        assert manager.token == "token-3"
+        assert session.post.call_args_list[0][0] == (
+            "https://ams.test/publish?key=token-2",
+        )
+        assert session.post.call_args_list[1][0] == (
+            "https://ams.test/publish?key=token-3",
+        )
+
+        with open(cache_path, "w") as cache_file:
+            cache_file.write("broken")
+        broken = TokenManager(conf, session)
+        broken.load_cache()
+        assert broken.token is None
+        os.remove(cache_path)
+
+        # A failed refresh leaves the chunk undelivered instead of raising
+        session.get.side_effect = lambda url: MagicMock(
+            **{"json.return_value": {}}
+        )
+        session.post.side_effect = None
+        session.post.return_value = rejected
+        signer = MessageSigner("tests/test_cert.cert", "tests/test_key.key")
+        publisher = MessagePublisher(signer, broken, 10**6)
+        statuses = publisher.publish(["a"])
+        assert [s.status_code for s in statuses] == [None]
+        assert not is_delivered(statuses)
+
     def test_sign_msg_fail(self):
         with pytest.raises(Exception) as pytest_error:
             sign_msg(
@@ -884,9 +1211,9 @@ class TestAuditorApelPlugin:
     def test_get_records_fail(self):
         client = FakeAuditorClient("fail_timeout")
 
-        with pytest.raises(SystemExit) as pytest_error:
+        with pytest.raises(AuditorTimeoutError) as pytest_error:
             get_records(client, 42, 1)
-        assert pytest_error.type == SystemExit
+        assert pytest_error.type == AuditorTimeoutError
 
         client = FakeAuditorClient("fail_else")
 
@@ -894,6 +1221,1210 @@ class TestAuditorApelPlugin:
             get_records(client, 42, 1)
         assert pytest_error.type == RuntimeError
 
+    def test_record_stream(self):
+        records = []
+        for idx in range(7):
+            rec = pyauditor.Record(
+                f"test_record_{idx}", datetime(2023, 1, 1, 0, 0, 0)
+            )
+            rec.with_stop_time(datetime(2023, 1, 2, idx, 0, 0))
+            records.append(rec)
+
+        client = FakeAuditorClient("records", records)
+        stream = RecordStream(client, datetime(2023, 1, 2, 2, 0, 0), 1, 2)
+
+        assert stream.latest_stop_time is None
+
+        pages = [[r.record_id for r in page] for page in stream.pages()]
+        assert pages == [
+            ["test_record_2", "test_record_3"],
+            ["test_record_4", "test_record_5"],
+            ["test_record_6"],
+        ]
+        assert stream.latest_stop_time == datetime(2023, 1, 2, 6, 0, 0)
+        assert stream.record_count == 5
+
+        stream = RecordStream(client, datetime(2023, 1, 2, 5, 0, 0), 1, 10)
+        result = [r.record_id for r in stream]
+        assert result == ["test_record_5", "test_record_6"]
+
+        stream = RecordStream(client, datetime(2023, 1, 3, 0, 0, 0), 1, 10)
+        assert list(stream) == []
+        assert stream.latest_stop_time is None
+        assert stream.record_count == 0
+
+    def test_record_stream_async(self):
+        records = []
+        for idx in range(7):
+            rec = pyauditor.Record(
+                f"test_record_{idx}", datetime(2023, 1, 1, 0, 0, 0)
+            )
+            rec.with_stop_time(datetime(2023, 1, 2, idx, 0, 0))
+            records.append(rec)
+
+        client = FakeAsyncAuditorClient("records", records)
+        result = asyncio.run(
+            get_records_async(client, datetime(2023, 1, 2, 4, 0, 0), 1)
+        )
+        assert [r.record_id for r in result] == [
+            "test_record_4",
+            "test_record_5",
+            "test_record_6",
+        ]
+
+        stream = AsyncRecordStream(client, datetime(2023, 1, 2, 2, 0, 0), 1, 2)
+        with pytest.raises(RuntimeError):
+            list(stream)
+
+        assert asyncio.run(stream.prefetch()) is stream
+        pages = [[r.record_id for r in page] for page in stream.pages()]
+        assert pages == [
+            ["test_record_2", "test_record_3"],
+            ["test_record_4", "test_record_5"],
+            ["test_record_6"],
+        ]
+        assert stream.latest_stop_time == datetime(2023, 1, 2, 6, 0, 0)
+        assert stream.record_count == 5
+
+        client = FakeAsyncAuditorClient("fail_else")
+        with pytest.raises(RuntimeError, match="Other RuntimeError"):
+            asyncio.run(get_records_async(client, datetime(2023, 1, 1), 1))
+
+        sleeps = []
+
+        async def fake_sleep(delay):
+            sleeps.append(delay)
+
+        client = FakeAsyncAuditorClient("fail_timeout")
+        with patch("asyncio.sleep", fake_sleep):
+            with pytest.raises(AuditorTimeoutError):
+                asyncio.run(get_records_async(client, datetime(2023, 1, 1), 1))
+        assert sleeps == [1, 2]
+
+    def test_get_new_records(self):
+        records = []
+        for idx in range(5):
+            rec = pyauditor.Record(
+                f"test_record_{idx}", datetime(2023, 1, 1, 0, 0, 0)
+            )
+            rec.with_stop_time(datetime(2023, 1, 2, idx, 0, 0))
+            records.append(rec)
+
+        client = FakeAuditorClient("records", records)
+        start_time = datetime(2023, 1, 2, 3, 0, 0)
+
+        result = get_new_records(client, start_time, 1)
+        assert [r.record_id for r in result] == ["test_record_4"]
+
+        async_client = FakeAsyncAuditorClient("records", records)
+        result = asyncio.run(
+            get_new_records_async(async_client, start_time, 1)
+        )
+        assert [r.record_id for r in result] == ["test_record_4"]
+
+        start_time = datetime(2023, 1, 2, 4, 0, 0)
+        assert get_new_records(client, start_time, 1) == []
+        assert filter_new_records(
+            records, datetime(2023, 1, 2, 3, 0, 0, tzinfo=pytz.utc)
+        ) == [records[4]]
+
+        new_records = records[3:]
+        stream = RecordStream(None, start_time, 1, 10, new_records)
+        assert [r.record_id for r in stream] == [
+            "test_record_3",
+            "test_record_4",
+        ]
+        assert stream.latest_stop_time == datetime(2023, 1, 2, 4, 0, 0)
+        assert stream.records is None
+        assert len(new_records) == 0
+
+    def test_get_records_between(self):
+        records = []
+        for idx in range(6):
+            rec = pyauditor.Record(
+                f"test_record_{idx}", datetime(2023, 1, 1, 0, 0, 0)
+            )
+            rec.with_stop_time(datetime(2023, 1, 2, idx, 0, 0))
+            records.append(rec)
+
+        client = FakeAuditorClient("records", records)
+        start_time = datetime(2023, 1, 2, 1, 0, 0)
+        end_time = datetime(2023, 1, 2, 4, 0, 0, tzinfo=pytz.utc)
+
+        result = get_records_between(client, start_time, end_time, 1)
+        assert [r.record_id for r in result] == [
+            "test_record_1",
+            "test_record_2",
+            "test_record_3",
+        ]
+        assert filter_records_until(records, datetime(2023, 1, 2, 1)) == [
+            records[0]
+        ]
+
+        stream = RecordStream(client, start_time, 1, 1, end_time=end_time)
+        assert [len(page) for page in stream.pages()] == [1, 1, 1]
+        assert stream.latest_stop_time == datetime(2023, 1, 2, 3, 0, 0)
+
+        async_client = FakeAsyncAuditorClient("records", records)
+        stream = asyncio.run(
+            AsyncRecordStream(
+                async_client, start_time, 1, 10, end_time=end_time
+            ).prefetch()
+        )
+        assert [r.record_id for r in stream] == [
+            "test_record_1",
+            "test_record_2",
+            "test_record_3",
+        ]
+
+        # Records handed in are used as they are
+        stream = RecordStream(None, start_time, 1, 10, records, end_time)
+        assert len(list(stream)) == 6
+
+    def test_seen_index(self):
+        conf = create_conf()
+        conn = create_time_db("2023-01-01 00:00:00+00:00", ":memory:")
+        end_time = datetime(2023, 1, 1, 1, 3, 0, tzinfo=pytz.utc)
+
+        # A new index does not look back before its first start time
+        seen = SeenIndex(conn, 3600)
+        begin = datetime(2023, 1, 1, 0, 0, 0, tzinfo=pytz.utc)
+        assert seen.load(begin) == begin
+        assert seen.load(end_time) == datetime(
+            2023, 1, 1, 0, 3, 0, tzinfo=pytz.utc
+        )
+        assert SeenIndex(conn, 7200).load(end_time) == begin
+        assert seen.mark("record_1", 100.0)
+        assert not seen.mark("record_1", 100.0)
+        assert "record_1" in seen
+        seen.discard()
+        assert "record_1" not in seen
+        assert not seen.has_pending()
+
+        # First cycle publishes four records up to the end time
+        records = create_rec_list(4, conf)
+        summary, _ = group_combined(
+            conf, records, seen.load(end_time), end_time, seen
+        )
+        assert sum(s["jobcount"] for s in summary) == 4
+        seen.save(end_time.timestamp())
+
+        # A late record with the same stop time as the boundary and a new one
+        late = create_rec(
+            {
+                "rec_id": "late_record",
+                "start_time": datetime(2023, 1, 1, 0, 0, 0),
+                "stop_time": datetime(2023, 1, 1, 1, 3, 0),
+                "n_cores": 1,
+                "hepscore": 10.0,
+                "tot_cpu": 100,
+                "n_nodes": 1,
+                "site": "test-site-1",
+                "submit_host": "https:%2F%2Ftest1.submit_host.de:1234%2Fxxx",
+                "user_name": "%2FDC=ch%2FDC=cern%2FCN=test0: test",
+                "voms": "%2Fatlas%2Fde%2FRole=production",
+            },
+            conf["auditor"],
+        )
+        records = create_rec_list(5, conf) + [late]
+
+        seen = SeenIndex(conn, 3600)
+        summary_since = seen.load(end_time)
+        assert len(seen.hashes) == 4
+        assert seen.has_unseen(records)
+        assert not seen.has_unseen(records[:4])
+
+        summary, sync = group_combined(
+            conf, records, summary_since, summary_since, seen
+        )
+        assert sum(s["jobcount"] for s in summary) == 2
+        assert sum(s["jobcount"] for s in sync) == 6
+
+        stop_time = datetime(2023, 1, 1, 1, 4, 0, tzinfo=pytz.utc)
+        seen.save(stop_time.timestamp())
+        cur = conn.cursor()
+        cur.execute("SELECT hash FROM seen_records ORDER BY stop_time")
+        hashes = [row[0] for row in cur.fetchall()]
+        assert len(hashes) == 6
+        assert hash_record_id("late_record") in hashes
+
+        compact = compact_records(conf, records)
+        seen = SeenIndex(conn, 3600)
+        seen.load(stop_time)
+        assert list(seen.filter(compact)) == []
+        assert list(seen.filter(create_rec_list(6, conf)))[0].record_id == (
+            "test_record_1_5"
+        )
+
+        seen.save(stop_time.timestamp() + 3600 - 30)
+        cur.execute("SELECT COUNT(*) FROM seen_records")
+        assert cur.fetchall() == [(2,)]
+        cur.execute("SELECT * FROM times")
+        assert len(cur.fetchall()[0]) == 2
+        cur.close()
+        conn.close()
+
+    def test_slice_spool(self):
+        conf = create_conf()
+        since = datetime(2023, 1, 1, 0, 0, 0, tzinfo=pytz.utc)
+        records = (
+            create_rec_list(3, conf, 3)
+            + create_rec_list(4, conf, 1)
+            + create_rec_list(2, conf, 2)
+        )
+
+        assert not is_backlog(
+            since, 86400, datetime(2023, 1, 1, 12, 0, 0, tzinfo=pytz.utc)
+        )
+        assert is_backlog(
+            since, 86400, datetime(2023, 1, 3, 12, 0, 0, tzinfo=pytz.utc)
+        )
+        assert not is_backlog(
+            since, 0, datetime(2023, 1, 3, 12, 0, 0, tzinfo=pytz.utc)
+        )
+
+        spool = SliceSpool(conf, records, since, 86400)
+        slices = list(spool)
+        assert len(spool) == 3
+        assert [len(s[1]) for s in slices] == [4, 2, 3]
+        assert (
+            slices[0][0]
+            == datetime(2023, 1, 1, 1, 3, 0, tzinfo=pytz.utc).timestamp()
+        )
+        assert (
+            slices[2][0]
+            == datetime(2023, 1, 3, 1, 2, 0, tzinfo=pytz.utc).timestamp()
+        )
+        assert all(
+            r.stoptime <= end for end, slice_list in slices for r in slice_list
+        )
+        assert sorted(r for _, slice_list in slices for r in slice_list) == (
+            sorted(compact_records(conf, records))
+        )
+
+        # Summed over the slices the summary matches the whole window
+        jobcount = sum(
+            s["jobcount"]
+            for _, slice_list in spool
+            for s in group_summary(conf, slice_list)
+        )
+        assert jobcount == sum(
+            s["jobcount"] for s in group_summary(conf, records)
+        )
+        spool.close()
+
+        # Rows at or before since are left out, an empty window is skipped
+        spool = SliceSpool(
+            conf, records, datetime(2023, 1, 1, 1, 1, 0, tzinfo=pytz.utc), 3600
+        )
+        assert [len(s[1]) for s in spool] == [2, 1, 1, 1, 2]
+        spool.close()
+
+        # Records in the seen index are not spooled
+        seen = SeenIndex(
+            create_time_db("2023-01-01 00:00:00+00:00", ":memory:"), 3600
+        )
+        seen.load(since)
+        for r in compact_records(conf, records[:5]):
+            seen.mark(r.recordid, r.stoptime)
+        spool = SliceSpool(conf, records, since, 86400, seen)
+        assert [len(s[1]) for s in spool] == [2, 2]
+        spool.close()
+
+        spool = SliceSpool(conf, records[3:5], since, 86400, seen)
+        assert len(spool) == 0
+        assert not spool
+        spool.close()
+
+    def test_backfill(self):
+        conf = create_conf()
+        conn = create_time_db("2023-01-01 00:00:00+00:00", ":memory:")
+        end_time = datetime(2023, 1, 2, 1, 2, 0, tzinfo=pytz.utc)
+        records = create_rec_list(4, conf, 1) + create_rec_list(4, conf, 2)
+        rows = compact_records(conf, records)
+
+        # Records stopped after the end time are left to the publish loop
+        partitions = partition_rows(rows, end_time)
+        assert sorted(partitions) == [
+            ("TEST_SITE_1", 2023, 1),
+            ("TEST_SITE_2", 2023, 1),
+        ]
+        assert sum(len(p) for p in partitions.values()) == 7
+
+        # Only the rows next to the latest stop time are kept for the
+        # hand-over
+        assert sorted(
+            r.recordid for r in get_hand_over_rows(partitions, 120)
+        ) == ["test_record_2_1", "test_record_2_2"]
+        assert get_hand_over_rows({}, 60) == []
+
+        partitions = partition_rows(rows, end_time, {"TEST_SITE_2"})
+        assert list(partitions) == [("TEST_SITE_2", 2023, 1)]
+        assert len(partitions[("TEST_SITE_2", 2023, 1)]) == 3
+
+        # The end time of the first run is kept until the backfill is done
+        assert get_backfill_end_time(conn, end_time) == end_time
+        assert get_backfill_end_time(conn, datetime.now(tz=pytz.utc)) == (
+            end_time
+        )
+        assert get_backfilled_partitions(conn) == set()
+        mark_partition_backfilled(conn, ("TEST_SITE_2", 2023, 1))
+        mark_partition_backfilled(conn, ("TEST_SITE_2", 2023, 1))
+        assert get_backfilled_partitions(conn) == {("TEST_SITE_2", 2023, 1)}
+        clear_backfill(conn)
+        assert get_backfilled_partitions(conn) == set()
+        later = datetime(2023, 2, 1, 0, 0, 0, tzinfo=pytz.utc)
+        assert get_backfill_end_time(conn, later) == later
+        conn.close()
+
+    def test_backfill_run(self):
+        conf = create_conf()
+        path = "/tmp/nonexistent_55_abc_backfill.db"
+        if os.path.exists(path):
+            os.remove(path)
+        conf["paths"] = {"time_db_path": path}
+        conf["site"]["publish_since"] = "2023-01-01 00:00:00+00:00"
+        conf["authentication"] = {
+            "client_cert": "tests/test_cert.cert",
+            "client_key": "tests/test_key.key",
+            "verify_ca": "False",
+        }
+        start_time = datetime(2023, 1, 1, 0, 0, 0, tzinfo=pytz.utc)
+        records = create_rec_list(4, conf, 1) + create_rec_list(4, conf, 2)
+        client = FakeAuditorClient("records", records)
+        args = argparse.Namespace(site=None)
+
+        # The second partition fails, a rerun only sends the remaining one
+        with patch(
+            "auditor_apel_plugin.core.TokenManager.send_payload"
+        ) as send_payload:
+            send_payload.side_effect = [
+                MagicMock(status_code=200),
+                MagicMock(status_code=500),
+            ]
+            assert not run_backfill(conf, args, client)
+
+            conn = get_time_db("2023-01-01 00:00:00+00:00", path)
+            assert get_backfilled_partitions(conn) == {
+                ("TEST_SITE_1", 2023, 1)
+            }
+            assert get_start_time(conn) == start_time
+            conn.close()
+
+            send_payload.reset_mock()
+            send_payload.side_effect = None
+            send_payload.return_value = MagicMock(status_code=200)
+            assert run_backfill(conf, args, client)
+            assert send_payload.call_count == 1
+            data = send_payload.call_args[0][0]["messages"][0]["data"]
+            assert b"TEST_SITE_2" in base64.b64decode(data)
+
+        # The publish loop continues after the latest backfilled record
+        conn = get_time_db("2023-01-01 00:00:00+00:00", path)
+        latest_stop_time = datetime(2023, 1, 2, 1, 3, 0, tzinfo=pytz.utc)
+        assert get_start_time(conn) == latest_stop_time
+        assert get_backfilled_partitions(conn) == set()
+        seen = SeenIndex(conn, 3600)
+        assert seen.load(latest_stop_time) == latest_stop_time
+        assert "test_record_2_3" in seen
+
+        # A hand-over never moves the start time backwards
+        hand_over(conf, conn, compact_records(conf, records[:4]), start_time)
+        assert get_start_time(conn) == latest_stop_time
+        conn.close()
+        os.remove(path)
+
+        # A single site leaves the start time alone
+        args = argparse.Namespace(site=["TEST_SITE_2"])
+        with patch(
+            "auditor_apel_plugin.core.TokenManager.send_payload"
+        ) as send_payload:
+            send_payload.return_value = MagicMock(status_code=200)
+            assert run_backfill(conf, args, client)
+            assert send_payload.call_count == 1
+
+        conn = get_time_db("2023-01-01 00:00:00+00:00", path)
+        assert get_start_time(conn) == start_time
+        conn.close()
+        os.remove(path)
+
+        conf["paths"]["aggregate_db_path"] = "/tmp/aggregate.db"
+        with pytest.raises(ValueError):
+            run_backfill(conf, args, client)
+
+        # The publish loop can not continue after a single site
+        argv = ["backfill", "-c", "config.cfg", "-s", "TEST_SITE_2"]
+        with patch("sys.argv", argv):
+            with pytest.raises(SystemExit):
+                backfill_main()
+
+    def test_select_partitions(self):
+        conf = create_conf()
+        records = create_rec_list(6, conf, 1) + create_rec_list(6, conf, 2)
+        partitions = {("TEST_SITE_1", 2023, 1), ("TEST_SITE_2", 2022, 12)}
+
+        rows = list(select_partitions(conf, records, partitions))
+        assert len(rows) == 6
+        assert {r.site for r in rows} == {"TEST_SITE_1"}
+
+        # One pass gives the same groups as one filtered pass per partition
+        grouped_summary_list = group_summary(conf, rows)
+        for site, year, month in partitions:
+            expected = [
+                dict(g)
+                for g in group_summary(
+                    conf, records, filter_by=(month, year, site)
+                )
+            ]
+            assert [
+                dict(g)
+                for g in grouped_summary_list
+                if (g["site"], g["year"], g["month"]) == (site, year, month)
+            ] == expected
+
+        assert list(select_partitions(conf, records, set())) == []
+
+    def test_record_mirror(self):
+        conf = create_conf()
+        begin = datetime(2022, 12, 1, 0, 0, 0, tzinfo=pytz.utc)
+        retention = int((datetime.now(tz=pytz.utc) - begin).total_seconds())
+        records = create_rec_list(6, conf, 1) + create_rec_list(6, conf, 2)
+        client = FakeAuditorClient("records", records)
+
+        mirror = RecordMirror(":memory:", retention, 3600)
+        since = datetime(2023, 1, 1, 0, 0, 0, tzinfo=pytz.utc)
+        assert not mirror.covers(since)
+        assert mirror.get_sync_start() - begin < timedelta(minutes=1)
+
+        sync_mirror(conf, client, mirror)
+        assert mirror.covers(since)
+        assert mirror.get_sync_start() == datetime(
+            2023, 1, 2, 0, 5, 0, tzinfo=pytz.utc
+        )
+
+        # The overlapping fetch replaces the rows it already holds
+        sync_mirror(conf, client, mirror)
+        assert len(list(mirror.stream(since))) == 12
+
+        # Timeouts keep the mirror instead of quitting the process
+        with patch("auditor_apel_plugin.core.sleep"):
+            sync_mirror(conf, FakeAuditorClient("fail_timeout"), mirror)
+        assert mirror.get_sync_start() == datetime(
+            2023, 1, 2, 0, 5, 0, tzinfo=pytz.utc
+        )
+
+        stream = mirror.stream(datetime(2023, 1, 2, 1, 2, 0, tzinfo=pytz.utc))
+        assert stream.latest_stop_time == datetime(2023, 1, 2, 1, 5, 0)
+        assert [r.recordid for r in stream] == [
+            "test_record_2_3",
+            "test_record_2_4",
+            "test_record_2_5",
+        ]
+        stream = mirror.stream(
+            since, datetime(2023, 1, 1, 1, 2, 0, tzinfo=pytz.utc)
+        )
+        assert len(list(stream)) == 2
+        assert list(mirror.stream(datetime(2023, 1, 3, tzinfo=pytz.utc))) == []
+        assert (
+            mirror.stream(
+                datetime(2023, 1, 3, tzinfo=pytz.utc)
+            ).latest_stop_time
+            is None
+        )
+
+        # Rows read back from the mirror aggregate like the records
+        assert [
+            dict(g) for g in group_summary(conf, mirror.stream(since))
+        ] == [dict(g) for g in group_summary(conf, records)]
+        partitions = {("TEST_SITE_1", 2023, 1)}
+        assert sorted(mirror.select(partitions)) == sorted(
+            select_partitions(conf, records, partitions)
+        )
+
+        cutoff = datetime(2023, 1, 2, 1, 0, 0, tzinfo=pytz.utc)
+        assert mirror.prune(cutoff + timedelta(seconds=retention)) == 6
+        assert not mirror.covers(since)
+        assert mirror.covers(cutoff)
+        assert len(list(mirror.stream(since))) == 6
+        mirror.close()
+
+        # The async sync inserts from an executor thread
+        mirror = RecordMirror(":memory:", retention, 3600)
+        client = FakeAsyncAuditorClient("records", records)
+        asyncio.run(sync_mirror_async(conf, client, mirror))
+        assert len(list(mirror.stream(since))) == 12
+        mirror.close()
+
+    def test_aggregate_db(self):
+        conf = create_conf()
+        path = "/tmp/nonexistent_55_abc_aggregate.db"
+        start_time = datetime(2023, 1, 1, 0, 0, 0, tzinfo=pytz.utc)
+
+        aggregate_db = get_aggregate_db(start_time, path)
+        assert get_aggregate_start_time(aggregate_db) == start_time
+
+        records = create_rec_list(12, conf)
+        grouped = group_summary_db(create_summary_db(conf, records))
+        update_aggregate_db(aggregate_db, grouped, 1672534800.0)
+        aggregate_db.close()
+
+        aggregate_db = get_aggregate_db(start_time, path)
+        assert get_aggregate_start_time(aggregate_db) == datetime(
+            2023, 1, 1, 1, 0, 0, tzinfo=pytz.utc
+        )
+        result = group_aggregate_db(aggregate_db)
+        assert len(result) == len(grouped)
+        assert sum(r["jobcount"] for r in result) == 12
+
+        records = create_rec_list(6, conf, start_day=2)
+        grouped_new = group_summary_db(create_summary_db(conf, records))
+        update_aggregate_db(aggregate_db, grouped_new, 1672621200.0)
+
+        result = group_aggregate_db(aggregate_db)
+        aggregate_db.close()
+        os.remove(path)
+
+        records = create_rec_list(12, conf) + create_rec_list(6, conf, 2)
+        expected = group_summary_db(create_summary_db(conf, records))
+
+        assert len(result) == len(grouped_new)
+        for entry in result:
+            match = [
+                e
+                for e in expected
+                if (e["site"], e["cpucount"], e["user"])
+                == (entry["site"], entry["cpucount"], entry["user"])
+            ]
+            assert len(match) == 1
+            assert dict(entry) == dict(match[0])
+
+    def test_aggregate_db_rollback(self):
+        conf = create_conf()
+        start_time = datetime(2023, 1, 1, 0, 0, 0, tzinfo=pytz.utc)
+
+        aggregate_db = get_aggregate_db(start_time, ":memory:")
+        records = create_rec_list(12, conf)
+        grouped = group_summary_db(create_summary_db(conf, records))
+        update_aggregate_db(aggregate_db, grouped, 1672534800.0)
+
+        records = create_rec_list(6, conf, start_day=2)
+        grouped_new = group_summary_db(create_summary_db(conf, records))
+        update_aggregate_db(
+            aggregate_db, grouped_new, 1672621200.0, commit=False
+        )
+        result = group_aggregate_db(aggregate_db)
+        assert sum(r["jobcount"] for r in result) == 18
+
+        aggregate_db.rollback()
+        assert get_aggregate_start_time(aggregate_db) == datetime(
+            2023, 1, 1, 1, 0, 0, tzinfo=pytz.utc
+        )
+        result = group_aggregate_db(aggregate_db)
+        assert len(result) == len(grouped)
+        assert sum(r["jobcount"] for r in result) == 12
+        aggregate_db.close()
+
+    def test_sync_store(self):
+        conf = create_conf()
+        path = ":memory:"
+        start_time = datetime(2023, 1, 2, 0, 0, 0, tzinfo=pytz.utc)
+
+        aggregate_db = get_aggregate_db(start_time, path)
+        assert get_sync_start_time(aggregate_db) == start_time
+
+        records = create_rec_list(12, conf, start_day=2)
+        grouped = group_summary_db(create_summary_db(conf, records))
+        update_aggregate_db(aggregate_db, grouped, 1672621200.0)
+
+        result = [tuple(r) for r in group_sync_store(aggregate_db)]
+        submit_host = "https://test1.submit_host.de:1234/xxx"
+        assert sorted(result) == [
+            ("TEST_SITE_1", submit_host, 2023, 1, 6),
+            ("TEST_SITE_2", submit_host, 2023, 1, 6),
+        ]
+
+        records = create_rec_list(4, conf, start_day=1)
+        grouped_sync = group_sync_db(create_sync_db(conf, records))
+        begin_month = datetime(2023, 1, 1, 0, 0, 0, tzinfo=pytz.utc)
+        seed_sync_db(aggregate_db, grouped_sync, begin_month)
+        assert get_sync_start_time(aggregate_db) == begin_month
+
+        result = [tuple(r) for r in group_sync_store(aggregate_db)]
+        assert sorted(result) == [
+            ("TEST_SITE_1", submit_host, 2023, 1, 8),
+            ("TEST_SITE_2", submit_host, 2023, 1, 8),
+        ]
+
+        freeze_sync_db(aggregate_db, begin_month)
+        assert len(group_sync_store(aggregate_db)) == 2
+
+        freeze_sync_db(
+            aggregate_db, datetime(2023, 2, 1, 0, 0, 0, tzinfo=pytz.utc)
+        )
+        assert group_sync_store(aggregate_db) == []
+
+        records = create_rec_list(2, conf, start_day=3)
+        grouped = group_summary_db(create_summary_db(conf, records))
+        update_aggregate_db(aggregate_db, grouped, 1672707600.0)
+
+        cur = aggregate_db.cursor()
+        cur.execute("SELECT jobcount FROM sync")
+        assert cur.fetchall() == [(8,), (8,)]
+        cur.close()
+        aggregate_db.close()
+
+    def test_create_combined_db(self):
+        conf = create_conf()
+        conf["auditor"]["page_size"] = "3"
+        conf["aggregation"] = {"insert_chunk_size": "4"}
+        records_day_1 = create_rec_list(8, conf, start_day=1)
+        records_day_2 = create_rec_list(5, conf, start_day=2)
+
+        summary_since = datetime(2023, 1, 2, 0, 0, 0, tzinfo=pytz.utc)
+        sync_since = datetime(2023, 1, 1, 1, 3, 0, tzinfo=pytz.utc)
+
+        summary_db, sync_db = create_combined_db(
+            conf, records_day_1 + records_day_2, summary_since, sync_since
+        )
+
+        cur = summary_db.cursor()
+        cur.execute("SELECT * FROM records")
+        summary_content = cur.fetchall()
+        cur.close()
+        summary_db.close()
+
+        cur = sync_db.cursor()
+        cur.execute("SELECT * FROM records")
+        sync_content = cur.fetchall()
+        cur.close()
+        sync_db.close()
+
+        expected_db = create_summary_db(conf, records_day_2)
+        cur = expected_db.cursor()
+        cur.execute("SELECT * FROM records")
+        assert summary_content == cur.fetchall()
+        cur.close()
+        expected_db.close()
+
+        expected_db = create_sync_db(conf, records_day_1[4:] + records_day_2)
+        cur = expected_db.cursor()
+        cur.execute("SELECT * FROM records")
+        assert sync_content == cur.fetchall()
+        cur.close()
+        expected_db.close()
+
+        with patch("auditor_apel_plugin.core.insert_summary_rows") as insert:
+            create_combined_db(conf, records_day_2, summary_since, sync_since)
+        assert [c[0][2] for c in insert.call_args_list] == [4, 4]
+
+    def test_record_extractor(self):
+        conf = create_conf()
+        records = create_rec_list(6, conf)
+        extractor = RecordExtractor(conf)
+
+        summary_db = create_summary_db(conf, records)
+        cur = summary_db.cursor()
+        cur.execute("SELECT * FROM records")
+        expected = cur.fetchall()
+        cur.close()
+        summary_db.close()
+
+        result = [extractor.extract(r) for r in records]
+        assert result == expected
+
+        result = [extractor.extract_sync(r) for r in records]
+        assert result == [(e[0], e[1], e[6], e[7], e[10]) for e in expected]
+
+        conf["site"]["sites_to_report"] = '["test-site-1"]'
+        extractor = RecordExtractor(conf)
+
+        assert extractor.extract(records[0]) == expected[0]
+        assert extractor.extract(records[1]) is None
+        assert extractor.extract_sync(records[1]) is None
+        assert len(list(extractor.summary_rows(records))) == 3
+        assert len(list(extractor.sync_rows(records))) == 3
+
+    def test_record_extractor_cache(self):
+        conf = create_conf()
+        records = create_rec_list(6, conf)
+        extractor = RecordExtractor(conf)
+
+        rows = list(extractor.summary_rows(records))
+        result = extractor.cache_info()
+
+        assert (result["site"].hits, result["site"].misses) == (4, 2)
+        assert (result["voms"].hits, result["voms"].misses) == (5, 1)
+        assert (result["user"].hits, result["user"].misses) == (3, 3)
+        assert result["submithost"].currsize == 1
+        assert rows[0][1] is rows[1][1]
+
+        conf["auditor"]["meta_cache_size"] = "1"
+        extractor = RecordExtractor(conf)
+
+        assert list(extractor.summary_rows(records)) == rows
+        result = extractor.cache_info()
+        assert (result["user"].hits, result["user"].misses) == (0, 6)
+        assert result["user"].maxsize == 1
+
+    def test_create_summary_db_duplicate(self, caplog):
+        conf = create_conf()
+        conf["aggregation"] = {"insert_chunk_size": "4"}
+        records = create_rec_list(6, conf)
+        records.insert(5, records[1])
+
+        with pytest.raises(Exception) as pytest_error:
+            create_summary_db(conf, records)
+        assert pytest_error.type == sqlite3.IntegrityError
+        assert "(record test_record_1_1)" in caplog.text
+
+        with pytest.raises(Exception) as pytest_error:
+            create_sync_db(conf, records)
+        assert pytest_error.type == sqlite3.IntegrityError
+
+        conf["aggregation"]["insert_chunk_size"] = "1"
+        summary_db = create_summary_db(conf, records[:5])
+        cur = summary_db.cursor()
+        cur.execute("SELECT COUNT(*) FROM records")
+        assert cur.fetchall() == [(5,)]
+        cur.close()
+        summary_db.close()
+
+    def test_group_summary_backends(self):
+        conf = create_conf()
+        records = create_rec_list(20, conf) + create_rec_list(9, conf, 2)
+
+        for idx, (voms, user_name) in enumerate(
+            [(None, None), ("%2Fbelle", None), (None, "%2FCN=test0: test")]
+        ):
+            rec_values = {
+                "rec_id": f"test_record_null_{idx}",
+                "start_time": datetime(2023, 1, 1, 0, 0, 0),
+                "stop_time": datetime(2023, 1, 3, 2, idx, 0),
+                "n_cores": 1,
+                "hepscore": 10.0,
+                "tot_cpu": 55,
+                "n_nodes": 1,
+                "site": "test-site-1",
+                "submit_host": None,
+                "user_name": user_name,
+                "voms": voms,
+            }
+            records.append(create_rec(rec_values, conf["auditor"]))
+
+        result_sqlite = group_summary(conf, records)
+        conf["aggregation"] = {"backend": "dict"}
+        result_dict = group_summary(conf, records)
+
+        assert [dict(r) for r in result_dict] == [
+            dict(r) for r in result_sqlite
+        ]
+        assert create_summary(result_dict) == create_summary(result_sqlite)
+
+        result = group_summary(
+            conf, records, filter_by=(1, 2023, "TEST_SITE_2")
+        )
+        assert len(result) > 0
+        assert all(r["site"] == "TEST_SITE_2" for r in result)
+
+        summary_since = datetime(2023, 1, 2, 0, 0, 0, tzinfo=pytz.utc)
+        sync_since = datetime(2023, 1, 1, 1, 3, 0, tzinfo=pytz.utc)
+
+        summary_dict, sync_dict = group_combined(
+            conf, records, summary_since, sync_since
+        )
+        conf["aggregation"]["backend"] = "sqlite"
+        summary_sqlite, sync_sqlite = group_combined(
+            conf, records, summary_since, sync_since
+        )
+
+        assert create_summary(summary_dict) == create_summary(summary_sqlite)
+        assert create_sync(sync_dict) == create_sync(sync_sqlite)
+
+        conf["aggregation"]["backend"] = "dict"
+        with pytest.raises(Exception) as pytest_error:
+            group_summary(conf, records + records[:1])
+        assert pytest_error.type == sqlite3.IntegrityError
+
+        conf["aggregation"]["backend"] = "fail"
+        with pytest.raises(Exception) as pytest_error:
+            group_summary(conf, records)
+        assert pytest_error.type == ValueError
+
+    def test_group_summary_numpy(self):
+        pytest.importorskip("numpy")
+
+        conf = create_conf()
+        records = create_rec_list(40, conf) + create_rec_list(9, conf, 2)
+
+        result_sqlite = group_summary(conf, records)
+        conf["aggregation"] = {"backend": "numpy"}
+        result_numpy = group_summary(conf, records)
+
+        assert [dict(r) for r in result_numpy] == [
+            dict(r) for r in result_sqlite
+        ]
+        assert create_summary(result_numpy) == create_summary(result_sqlite)
+
+        result = group_summary(
+            conf, records, filter_by=(1, 2023, "TEST_SITE_1")
+        )
+        assert all(r["site"] == "TEST_SITE_1" for r in result)
+        assert group_summary(conf, []) == []
+
+        summary_since = datetime(2023, 1, 2, 0, 0, 0, tzinfo=pytz.utc)
+        sync_since = datetime(2023, 1, 1, 1, 3, 0, tzinfo=pytz.utc)
+
+        summary_numpy, sync_numpy = group_combined(
+            conf, records, summary_since, sync_since
+        )
+        conf["aggregation"]["backend"] = "sqlite"
+        summary_sqlite, sync_sqlite = group_combined(
+            conf, records, summary_since, sync_since
+        )
+
+        assert create_summary(summary_numpy) == create_summary(summary_sqlite)
+        assert create_sync(sync_numpy) == create_sync(sync_sqlite)
+
+    def test_compact_records(self):
+        conf = create_conf()
+        records = create_rec_list(12, conf) + create_rec_list(5, conf, 2)
+        conf["site"]["sites_to_report"] = '["test-site-1"]'
+
+        result = compact_records(conf, records)
+        assert len(result) == 9
+        assert all(type(r) is ApelRecord for r in result)
+        assert result[0].recordid == "test_record_1_0"
+        assert result[0].site == "TEST_SITE_1"
+        assert result[0].vogroup == "/atlas/de"
+
+        other = compact_records(conf, records[:1])
+        assert other[0].submithost is result[0].submithost
+        assert other[0].vogroup is result[0].vogroup
+        assert other[0].user is result[0].user
+
+        assert compact_records(conf, result) == result
+
+        for backend in ["sqlite", "dict"]:
+            conf["aggregation"] = {"backend": backend}
+            assert create_summary(group_summary(conf, result)) == (
+                create_summary(group_summary(conf, records))
+            )
+
+        summary_since = datetime(2023, 1, 2, 0, 0, 0, tzinfo=pytz.utc)
+        sync_since = datetime(2023, 1, 1, 1, 3, 0, tzinfo=pytz.utc)
+        summary_compact, sync_compact = group_combined(
+            conf, result, summary_since, sync_since
+        )
+        summary_raw, sync_raw = group_combined(
+            conf, records, summary_since, sync_since
+        )
+        assert create_summary(summary_compact) == create_summary(summary_raw)
+        assert create_sync(sync_compact) == create_sync(sync_raw)
+
+        sync_db = create_sync_db(conf, result)
+        assert create_sync(group_sync_db(sync_db)) == create_sync(
+            group_sync_db(create_sync_db(conf, records))
+        )
+
+    def test_create_summary(self):
+        entry = {
+            "site": "TEST_SITE",
+            "month": 1,
+            "year": 2023,
+            "user": None,
+            "vo": "atlas",
+            "vogroup": "/atlas/de",
+            "vorole": None,
+            "submithost": "https://host.de:1234/xxx",
+            "infrastructure": "grid",
+            "cpucount": 8,
+            "nodecount": 1,
+            "min_stoptime": 1672531200,
+            "max_stoptime": 1672534800,
+            "runtime": 3600.0,
+            "cputime": 7200.5,
+            "norm_runtime": 36000.0,
+            "norm_cputime": 72005.9,
+            "benchmarktype": "si2k",
+            "benchmarkvalue": 10.0,
+            "jobcount": 2,
+        }
+        expected_entry = (
+            "Site: TEST_SITE\n"
+            "Month: 1\n"
+            "Year: 2023\n"
+            "VO: atlas\n"
+            "VOGroup: /atlas/de\n"
+            "SubmitHost: https://host.de:1234/xxx\n"
+            "Infrastructure: grid\n"
+            "Processors: 8\n"
+            "NodeCount: 1\n"
+            "EarliestEndTime: 1672531200\n"
+            "LatestEndTime: 1672534800\n"
+            "WallDuration : 3600\n"
+            "CpuDuration: 7200\n"
+            "NormalisedWallDuration: 36000\n"
+            "NormalisedCpuDuration: 72005\n"
+            "ServiceLevelType: si2k\n"
+            "ServiceLevel: 10.0\n"
+            "NumberOfJobs: 2\n"
+            "%%\n"
+        )
+
+        assert create_summary([]) == "APEL-summary-job-message: v0.3\n"
+        assert create_summary([entry, entry]) == (
+            "APEL-summary-job-message: v0.3\n" + 2 * expected_entry
+        )
+
+        entry = dict(entry, user="/DC=de/CN=user", vorole="Role=production")
+        result = create_summary([entry])
+        assert "GlobalUserName: /DC=de/CN=user\nVO: atlas\n" in result
+        assert "VOGroup: /atlas/de\nVORole: Role=production\n" in result
+
+        sink = io.StringIO()
+        assert write_summary([entry], sink) is sink
+        assert sink.getvalue() == result
+
+    def test_create_sync(self):
+        entry = {
+            "site": "TEST_SITE",
+            "month": 1,
+            "year": 2023,
+            "submithost": "https://host.de:1234/xxx",
+            "jobcount": 5,
+        }
+        expected = (
+            "APEL-sync-message: v0.1\n"
+            "Site: TEST_SITE\n"
+            "Month: 1\n"
+            "Year: 2023\n"
+            "SubmitHost: https://host.de:1234/xxx\n"
+            "NumberOfJobs: 5\n"
+            "%%\n"
+        )
+
+        assert create_sync([]) == "APEL-sync-message: v0.1\n"
+        assert create_sync([entry]) == expected
+
+        sink = io.StringIO()
+        write_sync([entry], sink)
+        assert sink.getvalue() == expected
+
+    def test_create_summary_chunks(self):
+        conf = create_conf()
+        records = create_rec_list(40, conf) + create_rec_list(20, conf, 2)
+        summary_list, sync_list = group_combined(
+            conf,
+            records,
+            datetime(2023, 1, 1, 0, 0, 0, tzinfo=pytz.utc),
+            datetime(2023, 1, 1, 0, 0, 0, tzinfo=pytz.utc),
+        )
+        summary = create_summary(summary_list)
+        header = "APEL-summary-job-message: v0.3\n"
+
+        assert list(create_summary_chunks(summary_list, 10**6)) == [summary]
+        assert list(create_summary_chunks([], 100)) == [header]
+
+        chunks = list(create_summary_chunks(summary_list, 1000))
+        assert len(chunks) > 1
+        assert all(len(c.encode("utf-8")) <= 1000 for c in chunks)
+        assert all(c.startswith(header) and c.endswith("%%\n") for c in chunks)
+        entries = "".join(c.replace(header, "", 1) for c in chunks)
+        assert header + entries == summary
+
+        chunks = list(create_summary_chunks(summary_list, 10))
+        assert len(chunks) == len(summary_list)
+
+        sync = create_sync(sync_list)
+        chunks = list(create_sync_chunks(sync_list, 200))
+        assert len(chunks) > 1
+        header = "APEL-sync-message: v0.1\n"
+        entries = "".join(c.replace(header, "", 1) for c in chunks)
+        assert header + entries == sync
+
+    def test_build_payloads(self):
+        msgs = [f"message {idx}" for idx in range(10)]
+
+        payloads = list(build_payloads(msgs, 10**6))
+        assert len(payloads) == 1
+        assert [m["data"] for m in payloads[0]["messages"]] == msgs
+
+        payloads = list(build_payloads(msgs, 200))
+        assert len(payloads) > 1
+        messages = [m for p in payloads for m in p["messages"]]
+        assert [m["data"] for m in messages] == msgs
+        empaids = [m["attributes"]["empaid"] for m in messages]
+        assert len(set(empaids)) == len(empaids)
+
+        payloads = list(build_payloads(msgs[:1], 10))
+        assert payloads[0]["messages"][0]["data"] == "message 0"
+        assert list(build_payloads([], 10)) == []
+
+    def test_publish(self):
+        signer = MessageSigner("tests/test_cert.cert", "tests/test_key.key")
+        tokens = MagicMock()
+        tokens.send_payload.return_value.status_code = 200
+
+        publisher = MessagePublisher(signer, tokens, 10**6)
+        statuses = publisher.publish(["a", "b", "c"])
+        assert len(statuses) == 1
+        assert statuses[0].status_code == 200
+        assert len(statuses[0].empaids) == 3
+        assert is_delivered(statuses)
+        payload = tokens.send_payload.call_args[0][0]
+        assert len(payload["messages"]) == 3
+
+        for message, msg in zip(payload["messages"], ["a", "b", "c"]):
+            with open("/tmp/signed_msg.txt", "wb") as msg_file:
+                msg_file.write(base64.b64decode(message["data"]))
+            process = subprocess.Popen(
+                "openssl smime -verify -in /tmp/signed_msg.txt "
+                "-noverify".split(),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            stdout, _ = process.communicate()
+            assert process.returncode == 0
+            assert stdout.decode().endswith(f"\r\n\r\n{msg}")
+
+        tokens.reset_mock()
+        publisher = MessagePublisher(signer, tokens, 1)
+        statuses = publisher.publish(["a", "b", "c"])
+        assert len(statuses) == 3
+        assert tokens.send_payload.call_count == 3
+
+    def test_message_publisher(self):
+        signer = MessageSigner("tests/test_cert.cert", "tests/test_key.key")
+        msgs = [f"message {idx}" for idx in range(12)]
+
+        def send_payload(payload):
+            sleep(0.01 * (len(payload["messages"][0]["data"]) % 3))
+            data = base64.b64decode(payload["messages"][0]["data"])
+            if b"message 7" in data:
+                raise requests.ConnectionError("connection reset")
+            return MagicMock(status_code=500 if b"message 5" in data else 200)
+
+        tokens = MagicMock()
+        tokens.send_payload.side_effect = send_payload
+
+        publisher = MessagePublisher(signer, tokens, 1, 2, 3)
+        statuses = publisher.publish(msgs)
+        publisher.close()
+
+        assert len(statuses) == 12
+        empaids = [s.empaids[0] for s in statuses]
+        assert empaids == sorted(empaids)
+        codes = [s.status_code for s in statuses]
+        assert codes == [200] * 5 + [500, 200, None] + [200] * 4
+        assert not is_delivered(statuses)
+        assert is_delivered(statuses[:5])
+
+        sent = {
+            c[0][0]["messages"][0]["attributes"]["empaid"]: (
+                base64.b64decode(c[0][0]["messages"][0]["data"])
+            )
+            for c in tokens.send_payload.call_args_list
+        }
+        for status, msg in zip(statuses, msgs):
+            assert f"\r\n\r\n{msg}\r\n".encode() in sent[status.empaids[0]]
+
+    def test_outbox(self):
+        path = "/tmp/test_outbox"
+        shutil.rmtree(path, ignore_errors=True)
+
+        for compress in [False, True]:
+            outbox = Outbox(path, compress)
+            payloads = [{"messages": [{"data": f"msg {i}"}]} for i in range(5)]
+            names = [outbox.add(payload) for payload in payloads]
+
+            assert outbox.elements() == names
+            assert len(outbox) == 5
+            assert os.listdir(f"{path}/tmp") == []
+            assert [outbox.read(name) for name in names] == payloads
+            assert all(n.endswith(".gz") == compress for n in names)
+
+            tokens = MagicMock()
+            tokens.send_payload.side_effect = [
+                MagicMock(status_code=200),
+                MagicMock(status_code=500),
+            ]
+            assert not outbox.drain(tokens)
+            assert outbox.elements() == names[1:]
+
+            tokens.send_payload.side_effect = requests.ConnectionError()
+            assert not outbox.drain(tokens)
+            assert outbox.elements() == names[1:]
+
+            tokens.send_payload.side_effect = None
+            tokens.send_payload.return_value = MagicMock(status_code=200)
+            tokens.send_payload.reset_mock()
+            assert outbox.drain(tokens)
+            assert outbox.elements() == []
+            assert [
+                c[0][0] for c in tokens.send_payload.call_args_list
+            ] == payloads[1:]
+
+        with open(f"{path}/outgoing/0-broken.json", "w") as element:
+            element.write("{")
+        assert outbox.drain(tokens)
+        assert os.listdir(f"{path}/failed") == ["0-broken.json"]
+
+        names = [outbox.add(payload) for payload in payloads[:3]]
+        tokens.send_payload.side_effect = [
+            MagicMock(status_code=400),
+            MagicMock(status_code=401),
+        ]
+        assert not outbox.drain(tokens)
+        assert outbox.elements() == names[1:]
+        assert sorted(os.listdir(f"{path}/failed")) == [
+            "0-broken.json",
+            names[0],
+        ]
+
+        tokens.send_payload.side_effect = None
+        assert outbox.drain(tokens)
+        assert outbox.elements() == []
+
+        lock = open(f"{path}/lock", "a")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        outbox.add(payloads[0])
+        tokens.send_payload.reset_mock()
+        thread = threading.Thread(target=outbox.drain, args=(tokens,))
+        thread.start()
+        sleep(0.1)
+        assert tokens.send_payload.call_count == 0
+        lock.close()
+        thread.join()
+        assert tokens.send_payload.call_count == 1
+        assert outbox.elements() == []
+
+        signer = MessageSigner("tests/test_cert.cert", "tests/test_key.key")
+        publisher = MessagePublisher(signer, tokens, 1)
+        names = publisher.spool(["a", "b"], outbox)
+        assert outbox.elements() == names
+        assert len(outbox.read(names[0])["messages"]) == 1
+
+        drainer = OutboxDrainer(outbox, tokens, 0.01, 1, 8)
+        tokens.send_payload.side_effect = requests.ConnectionError()
+        assert not drainer.drain()
+        assert not drainer.drain()
+        assert drainer.get_backoff() == 2
+        drainer.failures = 10
+        assert drainer.get_backoff() == 8
+
+        tokens.send_payload.side_effect = None
+        drainer.failures = 0
+        drainer.start()
+        drainer.notify()
+        for _ in range(100):
+            if len(outbox) == 0:
+                break
+            sleep(0.01)
+        drainer.stop()
+        assert len(outbox) == 0
+        assert not drainer.is_alive()
+        shutil.rmtree(path)
+
     def test_get_site_id(self):
         site_name_mapping = (
             '{"test-site-1": "TEST_SITE_1", "test-site-2": "TEST_SITE_2"}'
@@ -1037,3 +2568,236 @@ class TestAuditorApelPlugin:
         with pytest.raises(Exception) as pytest_error:
             get_site_id(rec_2, conf)
         assert pytest_error.type == AttributeError
+
+    def test_cycle_runner_post(self):
+        released = threading.Event()
+
+        def cycle():
+            pending = yield ("post", ["summary"])
+            yield ("run", released.set)
+            return (yield ("wait", pending))
+
+        # The posted summaries are still in flight during the next step
+        publisher = FakePublisher(released=released)
+        runner = CycleRunner(None, None, publisher, None)
+        assert asyncio.run(runner.run_async(cycle()))
+        assert publisher.sent == [["summary"]]
+
+        publisher = FakePublisher(status_code=500)
+        runner = CycleRunner(None, None, publisher, None)
+        assert not runner.run(cycle())
+        assert not asyncio.run(runner.run_async(cycle()))
+        assert publisher.sent == [["summary"], ["summary"]]
+
+    def test_report_cycle_probe_sites(self):
+        conf = create_conf()
+        conf["site"]["sites_to_report"] = '["test-site-1"]'
+        time_db = get_time_db("2023-01-01 00:00:00+00:00", ":memory:")
+        current_time = datetime(2023, 1, 3)
+
+        # Records of test-site-2 are not reported
+        records = create_rec_list(4, conf, 2)[1::2]
+        assert filter_reported_records(conf, records) == []
+
+        # They do not end the idle phase, so no wide fetch follows the probe
+        client = MagicMock(wraps=FakeAuditorClient("records", records))
+        publisher = FakePublisher()
+        runner = CycleRunner(client, None, publisher, None)
+        assert runner.run(report_cycle(conf, time_db, current_time, True))
+        assert runner.run(report_cycle(conf, time_db, current_time, True))
+        assert client.get_stopped_since.call_count == 2
+        assert publisher.sent == []
+
+        records.append(create_rec_list(1, conf, 2)[0])
+        assert not runner.run(report_cycle(conf, time_db, current_time, True))
+        assert client.get_stopped_since.call_count == 4
+        assert len(publisher.sent) == 2
+        assert get_start_time(time_db) == datetime(
+            2023, 1, 2, 1, 3, 0, tzinfo=pytz.utc
+        )
+
+    def test_report_cycle(self):
+        conf = create_conf()
+        time_db = get_time_db("2023-01-01 00:00:00+00:00", ":memory:")
+        current_time = datetime(2023, 1, 3)
+        start_time = datetime(2023, 1, 1, 0, 0, 0, tzinfo=pytz.utc)
+        records = create_rec_list(6, conf, 2)
+        client = FakeAuditorClient("records", records)
+        publisher = FakePublisher(status_code=500)
+        runner = CycleRunner(client, None, publisher, None)
+
+        # A failed delivery keeps the checkpoint, so the records are sent
+        # again by the next cycle
+        assert not runner.run(report_cycle(conf, time_db, current_time))
+        assert get_start_time(time_db) == start_time
+        assert count_jobs(publisher.sent) == 6
+
+        publisher.status_code = 200
+        publisher.sent = []
+        assert not runner.run(report_cycle(conf, time_db, current_time))
+        assert get_start_time(time_db) == datetime(
+            2023, 1, 2, 1, 5, 0, tzinfo=pytz.utc
+        )
+        assert count_jobs(publisher.sent) == 6
+        assert count_jobs(publisher.sent, "sync") == 6
+
+        # Published records are not summarised again, neither after a wide
+        # fetch nor after the probe
+        publisher.sent = []
+        assert runner.run(report_cycle(conf, time_db, current_time))
+        assert runner.run(report_cycle(conf, time_db, current_time, True))
+        assert publisher.sent == []
+
+        records += create_rec_list(8, conf, 2)[6:]
+        runner.client = FakeAsyncAuditorClient("records", records)
+        assert not asyncio.run(
+            runner.run_async(report_cycle(conf, time_db, current_time, True))
+        )
+        assert get_start_time(time_db) == datetime(
+            2023, 1, 2, 1, 7, 0, tzinfo=pytz.utc
+        )
+        assert count_jobs(publisher.sent) == 2
+        assert count_jobs(publisher.sent, "sync") == 8
+
+    def test_store_cycle(self):
+        conf = create_conf()
+        path = "/tmp/nonexistent_55_abc_store.db"
+        if os.path.exists(path):
+            os.remove(path)
+        conf["paths"] = {"aggregate_db_path": path}
+        conf["intervals"] = {"slice_length": "0"}
+        time_db = get_time_db("2023-01-01 00:00:00+00:00", ":memory:")
+        current_time = datetime(2023, 1, 3)
+        start_time = datetime(2023, 1, 1, 0, 0, 0, tzinfo=pytz.utc)
+        records = create_rec_list(6, conf, 2)
+        client = FakeAuditorClient("records", records)
+        publisher = FakePublisher(status_code=500)
+        runner = CycleRunner(client, None, publisher, None)
+
+        # The merge is rolled back if the summaries were not delivered
+        assert not runner.run(report_cycle(conf, time_db, current_time))
+        aggregate_db = get_aggregate_db(start_time, path)
+        assert get_aggregate_start_time(aggregate_db) == start_time
+        assert group_aggregate_db(aggregate_db) == []
+        aggregate_db.close()
+        assert get_start_time(time_db) == start_time
+
+        publisher.status_code = 200
+        publisher.sent = []
+        assert not runner.run(report_cycle(conf, time_db, current_time))
+        end_time = datetime(2023, 1, 2, 1, 5, 0, tzinfo=pytz.utc)
+        aggregate_db = get_aggregate_db(start_time, path)
+        assert get_aggregate_start_time(aggregate_db) == end_time
+        assert (
+            sum(e["jobcount"] for e in group_aggregate_db(aggregate_db)) == 6
+        )
+        aggregate_db.close()
+        assert get_start_time(time_db) == end_time
+        assert count_jobs(publisher.sent) == 6
+        assert count_jobs(publisher.sent, "sync") == 6
+
+        publisher.sent = []
+        assert runner.run(report_cycle(conf, time_db, current_time))
+        assert publisher.sent == []
+
+        # The summaries of the two changed groups carry their running totals
+        records += create_rec_list(8, conf, 2)[6:]
+        assert not runner.run(report_cycle(conf, time_db, current_time))
+        assert count_jobs(publisher.sent) == 4
+        assert count_jobs(publisher.sent, "sync") == 8
+        os.remove(path)
+
+    def test_store_cycle_slices(self):
+        conf = create_conf()
+        path = "/tmp/nonexistent_55_abc_slices.db"
+        if os.path.exists(path):
+            os.remove(path)
+        conf["paths"] = {"aggregate_db_path": path}
+        conf["intervals"] = {"slice_length": "86400"}
+        time_db = get_time_db("2023-01-01 00:00:00+00:00", ":memory:")
+        current_time = datetime(2023, 1, 4)
+        start_time = datetime(2023, 1, 1, 0, 0, 0, tzinfo=pytz.utc)
+        records = (
+            create_rec_list(4, conf, 1)
+            + create_rec_list(4, conf, 2)
+            + create_rec_list(4, conf, 3)
+        )
+        client = FakeAuditorClient("records", records)
+        publisher = FakePublisher(limit=1)
+        runner = CycleRunner(client, None, publisher, None)
+
+        # The backlog is published one day after the other and stops at the
+        # first failed slice
+        assert not runner.run(report_cycle(conf, time_db, current_time))
+        end_time = datetime(2023, 1, 1, 1, 3, 0, tzinfo=pytz.utc)
+        aggregate_db = get_aggregate_db(start_time, path)
+        assert get_aggregate_start_time(aggregate_db) == end_time
+        assert (
+            sum(e["jobcount"] for e in group_aggregate_db(aggregate_db)) == 4
+        )
+        aggregate_db.close()
+        assert get_start_time(time_db) == end_time
+        assert [count_jobs([msgs]) for msgs in publisher.sent] == [4, 8, 0]
+
+        # The next cycle resumes after the last completed slice
+        publisher.limit = None
+        publisher.sent = []
+        assert not runner.run(report_cycle(conf, time_db, current_time))
+        end_time = datetime(2023, 1, 3, 1, 3, 0, tzinfo=pytz.utc)
+        aggregate_db = get_aggregate_db(start_time, path)
+        assert get_aggregate_start_time(aggregate_db) == end_time
+        aggregate_db.close()
+        assert get_start_time(time_db) == end_time
+        assert [count_jobs([msgs]) for msgs in publisher.sent] == [8, 12, 0]
+        assert count_jobs(publisher.sent, "sync") == 12
+
+        publisher.sent = []
+        assert runner.run(report_cycle(conf, time_db, current_time))
+        assert publisher.sent == []
+        os.remove(path)
+
+    def test_republish_partitions(self):
+        path = "/tmp/nonexistent_55_abc_partitions.txt"
+        args = argparse.Namespace(partitions=path)
+
+        with open(path, "w") as f:
+            f.write("# site year month\nSITE_A 2023 1\n\nSITE_B, 2022, 12\n")
+        assert get_partitions(args) == {
+            ("SITE_A", 2023, 1),
+            ("SITE_B", 2022, 12),
+        }
+
+        bad_lines = {
+            "SITE_A 2023\n": "expected SITE YEAR MONTH",
+            "SITE_A 2023 1 2\n": "expected SITE YEAR MONTH",
+            "SITE_A 2023 jan\n": "expected SITE YEAR MONTH",
+            "SITE_A 2023 13\n": "invalid month 13",
+            "# nothing\n": "no partitions",
+        }
+        for line, message in bad_lines.items():
+            with open(path, "w") as f:
+                f.write("SITE_B 2022 12\n" * (message != "no partitions"))
+                f.write(line)
+            with pytest.raises(ValueError, match=message):
+                get_partitions(args)
+
+        # Invalid files are rejected before anything is fetched
+        argv = ["republish", "-c", "config.cfg", "-p", path]
+        with patch("sys.argv", argv):
+            with pytest.raises(SystemExit):
+                republish_main()
+        os.remove(path)
+
+        args = argparse.Namespace(
+            partitions=None, site=["SITE_A", "SITE_B"], year=2023, month=[1, 2]
+        )
+        assert len(get_partitions(args)) == 4
+
+    def test_month_range(self):
+        assert month_range("4") == [4]
+        assert month_range("1-3") == [1, 2, 3]
+        assert month_range("12-12") == [12]
+
+        for value in ["0", "13", "3-1", "jan", "1-", "1-3-5"]:
+            with pytest.raises(argparse.ArgumentTypeError):
+                month_range(value)